@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks of the RELP protocol and session hot paths.
+
+Run from the root of the repository:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --compare results.json --tolerance 0.2
+
+With `--compare`, the exit code is 1 if a throughput dropped by more
+than `tolerance` compared to the given results file.
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from relp.protocol import Frame, FrameParser, FrameWriter
+from relp.client import RelpClient
+from relp.server import handle_client
+
+PAYLOADS = {
+    'tiny': 'x',
+    '1k': 'x' * 1024,
+    '64k': 'x' * 65536,
+    'multibyte': 'été 日本語 🚀 ' * 16,
+}
+
+def measure(func, min_time):
+    '''Call `func` until `min_time` elapsed, return the number of calls per second'''
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+    return count / elapsed
+
+def percentile(values, ratio):
+    '''Return the value at `ratio` in the sorted list `values`'''
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def bench_encode(min_time):
+    results = {}
+    for name, payload in PAYLOADS.items():
+        results[f"encode/{name}"] = {'ops_per_sec': measure(lambda: Frame(1, 'syslog', payload).encode(), min_time)}
+
+        writer = FrameWriter()
+        def write():
+            for txnr in range(1, 11):
+                writer.frame(Frame(txnr, 'syslog', payload))
+            writer.clear()
+        results[f"writer/{name}"] = {'ops_per_sec': measure(write, min_time) * 10}
+
+    writer = FrameWriter()
+    def write_acks():
+        for txnr in range(1, 101):
+            writer.ack(txnr)
+        writer.clear()
+    results['writer/ack'] = {'ops_per_sec': measure(write_acks, min_time) * 100}
+    return results
+
+def frames_data(payload, count):
+    return b''.join(Frame(txnr, 'syslog', payload).encode() for txnr in range(1, count + 1))
+
+def bench_decode(min_time, count=100):
+    results = {}
+    for name, payload in PAYLOADS.items():
+        data = frames_data(payload, count)
+
+        def parse():
+            parser = FrameParser()
+            parser.feed(data)
+            assert len(parser.frames()) == count
+        results[f"parser/{name}"] = {'frames_per_sec': measure(parse, min_time) * count}
+
+        # The legacy parser counts DATALEN in characters
+        if payload.isascii():
+            text = data.decode()
+
+            def decode_batch():
+                frames, _ = Frame.decode_batch(text)
+                assert len(frames) == count
+            results[f"decode_batch/{name}"] = {'frames_per_sec': measure(decode_batch, min_time) * count}
+    return results
+
+def bench_split(min_time):
+    '''Parse frames fed in two parts, split at every possible boundary'''
+    results = {}
+    for name in ('tiny', 'multibyte'):
+        data = frames_data(PAYLOADS[name], 4)
+
+        def parse_splits():
+            for index in range(len(data) + 1):
+                parser = FrameParser()
+                parser.feed(data[:index])
+                frames = parser.frames()
+                parser.feed(data[index:])
+                assert len(frames + parser.frames()) == 4
+        results[f"parser_split/{name}"] = {'splits_per_sec': measure(parse_splits, min_time) * (len(data) + 1)}
+    return results
+
+def start_loopback_server():
+    '''Serve RELP sessions on a random local port with a no-op handler'''
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    logger = logging.getLogger('relp-bench')
+
+    def accept():
+        while True:
+            clientsocket, address = listener.accept()
+            Thread(target=handle_client, args=(clientsocket, address, lambda message: None, logger), daemon=True).start()
+    Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def bench_loopback(count):
+    '''End to end RelpClient -> server benchmark over TCP on localhost'''
+    results = {}
+    port = start_loopback_server()
+    message = PAYLOADS['1k'][:200]
+    with RelpClient('127.0.0.1', port) as client:
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(count // 10):
+            sent = time.perf_counter()
+            client.syslog(message)
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results['loopback/syslog'] = {
+            'msgs_per_sec': len(latencies) / elapsed,
+            'ack_p50_ms': percentile(latencies, 0.50) * 1000,
+            'ack_p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+        latencies = []
+        def on_ack(sent):
+            return lambda handle: latencies.append(time.perf_counter() - sent)
+        start = time.perf_counter()
+        handles = []
+        for _ in range(count):
+            handle = client.syslog_async(message)
+            handle.add_done_callback(on_ack(time.perf_counter()))
+            handles.append(handle)
+        client.session.window.wait_many(handles)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results['loopback/syslog_async'] = {
+            'msgs_per_sec': count / elapsed,
+            'ack_p50_ms': percentile(latencies, 0.50) * 1000,
+            'ack_p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+        start = time.perf_counter()
+        client.syslog_many(message for _ in range(count))
+        elapsed = time.perf_counter() - start
+        results['loopback/syslog_many'] = {'msgs_per_sec': count / elapsed}
+    return results
+
+def compare(results, baseline, tolerance):
+    '''Return the list of the throughputs that regressed compared to `baseline`'''
+    regressions = []
+    for name, metrics in baseline['results'].items():
+        for metric, value in metrics.items():
+            if not metric.endswith('_per_sec') or name not in results:
+                continue
+            current = results[name][metric]
+            if current < value * (1 - tolerance):
+                regressions.append(f"{name} {metric}: {current:.0f} < {value:.0f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed throughput drop (ratio)')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Minimum time spent per microbenchmark')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages sent by loopback benchmarks')
+    parser.add_argument('--skip-loopback', action='store_true', help='Only run the protocol microbenchmarks')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    results.update(bench_encode(args.min_time))
+    results.update(bench_decode(args.min_time))
+    results.update(bench_split(args.min_time))
+    if not args.skip_loopback:
+        results.update(bench_loopback(args.messages))
+
+    for name, metrics in results.items():
+        print(f"{name:32} " + ' '.join(f"{metric}={value:,.2f}" for metric, value in metrics.items()))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 '''Minimal RELP client'''
 
+import logging
+import sys
+
 from relp.client import RelpClient
 
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
 with RelpClient('127.0.0.1', 2514) as client:
     print("Start sending")
     for index in range(1, 50):
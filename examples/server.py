@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 '''Minimal RELP server'''
 
+import logging
+import sys
+
 from relp.server import RelpServer
 
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
 def handler(message):
     '''Handler for RELP server'''
     print(f"Received: {message}")
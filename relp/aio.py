@@ -0,0 +1,256 @@
+'''asyncio implementation of the RELP client and server'''
+
+import asyncio
+import inspect
+import logging
+
+from relp.protocol import *
+from relp.exceptions import *
+from relp.session import DEFAULT_WINDOW
+
+default_logger = logging.getLogger('relp-aio')
+
+class AsyncRelpServerProtocol(asyncio.Protocol):
+    '''
+    Server side of a RELP session running on the event loop.
+    Frames are handled in order by one task per connection, and each
+    `syslog` frame is acknowledged once the handler returned.
+    '''
+    def __init__(self, handler, logger=default_logger, max_pending=DEFAULT_WINDOW):
+        self.handler = handler
+        self.logger = logger
+        self.parser = FrameParser()
+        self.frames = asyncio.Queue()
+        self.max_pending = max_pending
+        self.transport = None
+        self.task = None
+        self.peer = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.logger.info("Starting RELP session with %s", self.peer)
+        self.task = asyncio.get_running_loop().create_task(self._process())
+
+    def connection_lost(self, exc):
+        self.logger.info("RELP session closed by %s", self.peer)
+        self.frames.put_nowait(None)
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        try:
+            frames = self.parser.frames()
+        except RelpProtocolError as err:
+            self.logger.error("Error unpacking message: %s. Closing the session", err)
+            self.transport.close()
+            return
+        for frame in frames:
+            self.frames.put_nowait(frame)
+        if self.frames.qsize() >= self.max_pending and not self.paused:
+            self.logger.debug("Handler is late, pausing reads from %s", self.peer)
+            self.paused = True
+            self.transport.pause_reading()
+
+    def _write(self, frame):
+        if not self.transport.is_closing():
+            self.transport.write(frame if isinstance(frame, bytes) else frame.encode())
+
+    async def _process(self):
+        while True:
+            frame = await self.frames.get()
+            if self.paused and self.frames.qsize() < self.max_pending // 2:
+                self.paused = False
+                self.transport.resume_reading()
+            if frame is None:
+                break
+            if frame.command in COMMANDS:
+                try:
+                    for message in frame.messages():
+                        result = self.handler(message)
+                        if inspect.isawaitable(result):
+                            await result
+                except Exception as err:
+                    self.logger.exception("Handler failed for frame %s", frame.txnr)
+                    self._write(Ack(frame.txnr, RspCode.NACK, str(err)).to_frame())
+                else:
+                    self._write(ACK_FORMAT % frame.txnr)
+            elif frame.command == 'open':
+                self.logger.info("Offered received and processed")
+                self._write(b'%d' % frame.txnr + OFFER_REPLY_TAIL)
+            elif frame.command == 'close':
+                self.logger.info("Received `close` from client. Closing the session")
+                self._write(ACK_FORMAT % frame.txnr)
+                self._write(Frame(0, 'serverclose', ''))
+                self.transport.close()
+                break
+            else:
+                self.logger.error("Unexpected RELP command: %s", frame.command)
+                self._write(Ack(frame.txnr, RspCode.NACK, 'unsupported command').to_frame())
+
+class AsyncRelpServer:
+    '''
+    RELP server running many sessions on one event loop.
+    `handler` can be a coroutine function or a regular function.
+    `ssl_context` enables TLS (see `relp.tls.server_context`).
+    '''
+    def __init__(self, listen_addr, port, handler, logger=default_logger, ssl_context=None):
+        self.listen_addr = listen_addr
+        self.port = port
+        self.handler = handler
+        self.logger = logger
+        self.ssl_context = ssl_context
+        self.server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def start(self):
+        '''Start listening for connections'''
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: AsyncRelpServerProtocol(self.handler, self.logger),
+            self.listen_addr, self.port, ssl=self.ssl_context,
+        )
+        self.logger.info("Starting listening for client connections")
+
+    async def stop(self):
+        '''Stop accepting connections'''
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        '''Accept and serve RELP connections forever'''
+        if self.server is None:
+            await self.start()
+        await self.server.serve_forever()
+
+class AsyncRelpClientProtocol(asyncio.Protocol):
+    '''Client side of a RELP session running on the event loop'''
+    def __init__(self, logger=default_logger):
+        self.logger = logger
+        self.parser = FrameParser()
+        self.transport = None
+        self.pending = {}
+        self.closed = asyncio.get_running_loop().create_future()
+        self.disconnected = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.disconnected = True
+        error = RelpSessionError(f"RELP session is closed: {exc}" if exc else "RELP session is closed")
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        try:
+            frames = self.parser.frames()
+        except RelpProtocolError as err:
+            self.logger.error("Error unpacking message: %s. Closing the session", err)
+            self.transport.close()
+            return
+        for frame in frames:
+            if frame.command == 'rsp':
+                ack = Ack.from_frame(frame)
+                future = self.pending.pop(ack.txnr, None)
+                if future is None:
+                    self.logger.warning("Received ACK for unknown TXNR %s", ack.txnr)
+                elif not future.done():
+                    future.set_result(ack)
+            elif frame.command == 'serverclose':
+                self.logger.info("Received `serverclose` from server")
+                self.transport.close()
+            else:
+                self.logger.error("Unexpected RELP command from server: %s", frame.command)
+
+    def is_closing(self):
+        '''Return True once the connection is closed, or being closed'''
+        return self.disconnected or self.transport.is_closing()
+
+    def send(self, frame):
+        '''Write a frame and return a future resolved with its `Ack`'''
+        if self.is_closing():
+            raise RelpSessionError("RELP session is closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending[frame.txnr] = future
+        self.transport.write(frame.encode())
+        return future
+
+class AsyncRelpClient:
+    '''
+    RELP client for asyncio.
+    `syslog` can be awaited by many tasks concurrently, at most `window`
+    messages are waiting for their acknowledgement at any time.
+    `ssl_context` enables TLS (see `relp.tls.client_context`).
+    '''
+    def __init__(self, address, port, logger=default_logger, window=DEFAULT_WINDOW, ssl_context=None,
+                 server_hostname=None):
+        self.address = address
+        self.port = port
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.logger = logger
+        self.window = asyncio.Semaphore(window)
+        self.protocol = None
+        self.txnr = 1
+        self.running = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def start(self):
+        '''Connect and execute the RELP offer'''
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_connection(
+            lambda: AsyncRelpClientProtocol(self.logger), self.address, self.port, ssl=self.ssl_context,
+            server_hostname=self.server_hostname if self.ssl_context is not None else None,
+        )
+        self.running = True
+        await self._send('open', Offer().message())
+        self.logger.debug("Received offer reply. Offer successful")
+
+    async def stop(self):
+        '''Close the RELP session'''
+        if not self.running:
+            return
+        self.running = False
+        if not self.protocol.is_closing():
+            try:
+                await self._send('close')
+            except RelpSessionError as err:
+                self.logger.warning("Could not close RELP session cleanly: %s", err)
+        self.protocol.transport.close()
+        await self.protocol.closed
+
+    def _frame(self, command, message):
+        frame = Frame(self.txnr, command, message)
+        self.txnr += 1
+        return frame
+
+    async def _send(self, command, message=''):
+        async with self.window:
+            ack = await self.protocol.send(self._frame(command, message))
+        if ack.code == RspCode.NACK.value:
+            raise AckError(f"NACK received: {ack.message}")
+        return ack
+
+    async def syslog(self, message: str):
+        '''Send a syslog message in RELP and wait for its acknowledgement'''
+        if not self.running:
+            raise RelpSessionError("Cannot send message while RELP session is closing")
+        return await self._send('syslog', message)
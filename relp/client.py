@@ -1,20 +1,55 @@
 '''RELP client library'''
 
-from socket import socket, AF_INET, SOCK_STREAM
-from queue import Queue
+from socket import create_connection
+from threading import Event, Thread
+from time import monotonic
 
 from relp.session import *
+from relp.tls import TlsSocket
 
 class RelpClient:
-    '''Object to manage a client connection'''
-    def __init__(self, address, port, logger=None):
-        sock = socket(AF_INET, SOCK_STREAM)
-        sock.connect((address, port))
+    '''
+    Object to manage a client connection.
 
-        self.recv_queue = Queue()
-        self.send_queue = Queue()
+    With a `relp.spool.Spool`, messages are only written to the spool by `syslog`,
+    and a background thread sends them to the server, (re)connecting every
+    `retry_interval` seconds while the server is unreachable. The connection
+    is then only opened by `start`.
 
-        self.session = RelpSession(sock)
+    Without a spool and with `reconnect`, a lost connection is opened again and
+    the messages waiting for their acknowledgement are sent again: they are
+    only failed when the client is stopped.
+
+    With `ssl_context` (see `relp.tls.client_context`), the connection uses TLS, and
+    the TLS session is resumed when reconnecting. `server_hostname` is the name checked
+    in the server certificate (`address` by default).
+    '''
+    def __init__(self, address, port, logger=default_logger, window=DEFAULT_WINDOW, metrics=None,
+                 spool=None, retry_interval=1.0, drain_timeout=5.0, reconnect=True,
+                 connect_timeout=5.0, max_reconnect_delay=MAX_RECONNECT_DELAY, ssl_context=None,
+                 server_hostname=None):
+        self.address = address
+        self.port = port
+        self.logger = logger
+        self.window = window
+        self.metrics = metrics
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.drain_timeout = drain_timeout
+        self.connect_timeout = connect_timeout
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or address
+        self.tls_session = None
+        self.session = None
+        self.drainer = None
+        self.stopping = Event()
+
+        if spool is None:
+            sock = self._open(None)
+            self.session = RelpSession(
+                sock, 'client', logger, window=window, metrics=metrics,
+                reconnect=self._reconnect if reconnect else None, max_reconnect_delay=max_reconnect_delay,
+            )
 
         self.running = False
 
@@ -27,26 +62,145 @@ class RelpClient:
 
     def start(self):
         '''Start the client'''
-        self.running = True
+        if self.spool is not None:
+            self.running = True
+            self.drainer = Thread(target=self._drain, daemon=True)
+            self.drainer.start()
+            return
         self.session.start()
         self.session.offer()
-
-        while self.running:
-            frame = self.session.recv()
-            if frame.command == 'serverclose':
-                self.stop()
-                break
-            else:
-                raise NotImplementedError(f"Client does not implement command `{frame.command}`")
+        self.running = True
 
     def stop(self):
-        '''Stop the client'''
+        '''
+        Stop the client. With a spool, wait at most `drain_timeout` seconds
+        for the spooled messages to be sent: the others stay in the spool.
+        '''
         self.running = False
-        self.session.stop()
-
-    def syslog(self, message: str):
-        '''Send a syslog message in RELP'''
-        if self.running:
-            self.session.send('syslog', message)
-        else:
-            Exception("Cannot send message while RELP session is closing")
+        if self.spool is not None:
+            deadline = monotonic() + self.drain_timeout
+            # Nothing sends the spooled messages if the client was never started
+            if self.drainer is not None:
+                while self.spool.pending() and monotonic() < deadline:
+                    self.stopping.wait(0.01)
+                self.stopping.set()
+                self.drainer.join()
+            self.spool.sync()
+            if self.session is not None:
+                # The messages not acknowledged stay in the spool: do not wait longer for the server
+                self.session.stop(max(0, deadline - monotonic()))
+            return
+        if self.session is not None:
+            self.session.stop()
+
+    def _open(self, timeout):
+        '''Connect to the server, and do the TLS handshake (resuming the previous TLS session)'''
+        sock = create_connection((self.address, self.port), timeout)
+        if self.ssl_context is not None:
+            if self.session is not None:
+                self.tls_session = getattr(self.session.socket, 'session', None)
+            sock = TlsSocket(sock, self.ssl_context, server_hostname=self.server_hostname,
+                             session=self.tls_session, logger=self.logger)
+            try:
+                sock.do_handshake(timeout)
+            except BaseException:
+                sock.close()
+                raise
+        return sock
+
+    def _reconnect(self):
+        return self._open(self.connect_timeout)
+
+    def _connect(self):
+        sock = self._open(self.retry_interval)
+        sock.settimeout(None)
+        session = RelpSession(sock, 'client', self.logger, window=self.window, metrics=self.metrics)
+        session.start()
+        try:
+            session.offer(self.retry_interval)
+        except Exception:
+            session.stop()
+            raise
+        return session
+
+    def _drain(self):
+        '''Send the messages of the spool, reconnecting when needed'''
+        self.logger.info("Starting spool drainer")
+        while not self.stopping.is_set():
+            if self.session is None or not self.session.running:
+                if self.session is not None:
+                    self.session.stop()
+                    self.tls_session = getattr(self.session.socket, 'session', None)
+                    self.session = None
+                    self.spool.rewind()
+                try:
+                    self.session = self._connect()
+                except (OSError, RelpSessionError, TimeoutError) as err:
+                    self.logger.warning("Could not connect to %s:%s: %s", self.address, self.port, err)
+                    self.stopping.wait(self.retry_interval)
+                    continue
+                self.logger.info("Connected to %s:%s, sending spooled messages", self.address, self.port)
+
+            # Wait for a free slot of the window without blocking `stop`
+            try:
+                self.session.window.wait_available(0.1)
+            except TimeoutError:
+                continue
+            token, payload = self.spool.read(timeout=0.1)
+            if token is None:
+                continue
+            try:
+                handle = self.session.send_async('syslog', payload)
+            except RelpSessionError:
+                continue
+            handle.add_done_callback(lambda handle, token=token: self._spooled(token, handle))
+        self.logger.info("Stopping spool drainer")
+
+    def _spooled(self, token, handle):
+        if handle.error is not None:
+            # Sent again after reconnecting
+            return
+        if handle.ack.code == RspCode.NACK.value:
+            self.logger.error("Spooled message was refused by the server, dropping it: %s", handle.ack.message)
+        self.spool.ack(token)
+
+    def syslog(self, message: str, timeout=None):
+        '''
+        Send a syslog message in RELP and wait for its acknowledgement.
+        With a spool, only write the message to the spool.
+        '''
+        if not self.running:
+            raise RelpSessionError("Cannot send message while RELP session is closing")
+        if self.spool is not None:
+            return self.spool.append(message)
+        return self.session.send('syslog', message, timeout)
+
+    def syslog_many(self, messages, timeout=None):
+        '''
+        Send syslog messages from any iterable (or generator) in RELP,
+        with coalesced writes, and wait for all the acknowledgements.
+        Return the number of messages sent, raise `AckError` with the
+        index of the refused messages in `nacked` if some were NACKed.
+        '''
+        if not self.running:
+            raise RelpSessionError("Cannot send message while RELP session is closing")
+        if self.spool is not None:
+            count = 0
+            for message in messages:
+                self.spool.append(message)
+                count += 1
+            return count
+        return self.session.send_many('syslog', messages, timeout)
+
+    def syslog_async(self, message: str):
+        '''
+        Send a syslog message in RELP without waiting for the acknowledgement.
+        Return an `AckHandle` resolved with the `Ack` of the message. Only block
+        when the RELP window of the session is full.
+        With a spool, only write the message to the spool and return None.
+        '''
+        if not self.running:
+            raise RelpSessionError("Cannot send message while RELP session is closing")
+        if self.spool is not None:
+            return self.spool.append(message)
+        return self.session.send_async('syslog', message)
@@ -0,0 +1,271 @@
+'''Sharded dispatch of the messages to handler processes, to use as the handler of a RelpServer'''
+
+import logging
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+from relp.exceptions import *
+from relp.protocol import pack_messages, unpack_messages
+from relp.syslog import SyslogMessage
+
+default_logger = logging.getLogger('relp-dispatch')
+
+# Largest batch of messages sent at once to a worker process
+DEFAULT_BATCH_MESSAGES = 1024
+DEFAULT_BATCH_BYTES = 1024 * 1024
+# Batches sent to a worker process and not confirmed yet
+DEFAULT_INFLIGHT_BATCHES = 4
+# Start the workers from a clean process: forking the threads of a server can deadlock
+DEFAULT_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def run_shard(conn, handler, parse_syslog):
+    '''
+    Entrypoint of a worker process: call the handler on each message of the
+    batches received, in order, and reply with the failures of each batch.
+    An empty batch stops the worker.
+    '''
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except EOFError:
+            return
+        if not data:
+            return
+        failures = []
+        for index, payload in enumerate(unpack_messages(data)):
+            message = SyslogMessage(payload) if parse_syslog else payload.decode('utf-8', 'replace')
+            try:
+                handler(message)
+            except Exception as err:
+                failures.append((index, f"{type(err).__name__}: {err}"))
+        conn.send(failures)
+
+class Shard:
+    '''A worker process and the messages sent to it, in order'''
+    def __init__(self, dispatcher, index):
+        self.dispatcher = dispatcher
+        self.index = index
+        self.condition = Condition()
+        # Encoded messages and their futures, waiting for the next batch
+        self.pending = []
+        self.futures = []
+        self.pending_bytes = 0
+        # Futures of the batches sent, in order
+        self.inflight = deque()
+        self.closed = False
+        self.conn = None
+        self.process = None
+        self.sender = Thread(target=self._send, name=f"relp-dispatch-send-{index}", daemon=True)
+        self.receiver = Thread(target=self._receive, name=f"relp-dispatch-recv-{index}", daemon=True)
+
+    def start(self):
+        '''Start the threads sending the batches and receiving the confirmations'''
+        self.sender.start()
+        self.receiver.start()
+
+    def _spawn(self):
+        dispatcher = self.dispatcher
+        self.conn, child_conn = dispatcher.context.Pipe()
+        self.process = dispatcher.context.Process(
+            target=run_shard,
+            args=(child_conn, dispatcher.handler, dispatcher.parse_syslog),
+            name=f"relp-dispatch-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        dispatcher.logger.debug("Spawned dispatch worker %i with pid %i", self.index, self.process.pid)
+
+    def submit(self, payload, future):
+        with self.condition:
+            if self.closed:
+                raise RelpError("Cannot dispatch to a closed dispatcher")
+            self.pending.append(payload)
+            self.futures.append(future)
+            self.pending_bytes += len(payload)
+            self.condition.notify_all()
+
+    def close(self):
+        '''Send the messages waiting, wait for their confirmation and stop the worker'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.sender.join()
+        self.receiver.join()
+        self.process.join()
+
+    def _take_batch(self):
+        '''Take the next batch from the pending messages'''
+        dispatcher = self.dispatcher
+        count = 0
+        size = 0
+        while count < len(self.pending) and count < dispatcher.max_batch_messages and size < dispatcher.max_batch_bytes:
+            size += len(self.pending[count])
+            count += 1
+        batch, self.pending = self.pending[:count], self.pending[count:]
+        futures, self.futures = self.futures[:count], self.futures[count:]
+        self.pending_bytes -= size
+        return batch, futures
+
+    def _send(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (
+                    self.pending and len(self.inflight) < self.dispatcher.max_inflight_batches))
+                if not self.pending:
+                    conn = self.conn
+                    break
+                batch, futures = self._take_batch()
+                self.inflight.append(futures)
+                conn = self.conn
+            if self.dispatcher.metrics is not None:
+                self.dispatcher.metrics.inc('relp_dispatch_batches_total')
+                self.dispatcher.metrics.inc('relp_dispatch_messages_total', len(batch))
+            try:
+                conn.send_bytes(pack_messages(batch))
+            except (OSError, ValueError):
+                # The worker died: the receiver fails the batch and restarts it
+                pass
+        # Everything was sent: stop the worker once the batches are confirmed
+        try:
+            conn.send_bytes(b'')
+        except (OSError, ValueError):
+            pass
+
+    def _receive(self):
+        while True:
+            with self.condition:
+                conn = self.conn
+            try:
+                failures = conn.recv()
+            except (EOFError, OSError):
+                if not self._restart():
+                    return
+                continue
+            with self.condition:
+                futures = self.inflight.popleft()
+                self.condition.notify_all()
+            failed = dict(failures)
+            for index, future in enumerate(futures):
+                if index in failed:
+                    future.set_exception(RelpError(f"Handler failed: {failed[index]}"))
+                else:
+                    future.set_result(None)
+
+    def _restart(self):
+        '''
+        The worker exited: fail the batches it did not confirm, and start it again
+        unless the shard is closed. Return True if restarted.
+        '''
+        with self.condition:
+            inflight, self.inflight = self.inflight, deque()
+            self.condition.notify_all()
+            if self.closed and not inflight and not self.pending:
+                return False
+            self.process.join()
+            self.dispatcher.logger.error("Dispatch worker %i exited with code %s, failing %i messages",
+                                         self.index, self.process.exitcode, sum(len(futures) for futures in inflight))
+            restart = not self.closed
+            if restart:
+                self.conn.close()
+                self._spawn()
+            else:
+                inflight.append(self.futures)
+                self.pending, self.futures, self.pending_bytes = [], [], 0
+        if restart and self.dispatcher.metrics is not None:
+            self.dispatcher.metrics.inc('relp_dispatch_restarts_total')
+        for futures in inflight:
+            for future in futures:
+                future.set_exception(RelpError("Dispatch worker exited"))
+        return restart
+
+class ShardedDispatcher:
+    '''
+    Run the handler of a server in `processes` worker processes (one per core by
+    default), so CPU-heavy handlers are not limited by the GIL.
+
+    Calling the dispatcher with a message returns a `Future` resolved once a worker
+    processed it (failed if the handler raised), so `RelpServer` only acknowledges
+    the messages confirmed by the workers. Each message goes to the worker given by
+    the hash of `key(message)` (for instance the hostname, with `parse_syslog=True`
+    on the server): the messages with the same key are handled in order, by the same
+    worker. Without `key`, messages are spread by their content. The messages are
+    sent to a worker in batches (at most `max_batch_messages` messages and
+    `max_batch_bytes` bytes, encoded like a `syslogbatch` frame) through a pipe,
+    with at most `max_inflight_batches` batches waiting for their confirmation.
+
+    The worker processes are started with the `start_method` of `multiprocessing`
+    (`forkserver` by default, never a fork of the threads of the server), so `handler`
+    must be picklable: a module-level function, or an object of a module-level class.
+    `key` runs in the server process. With `parse_syslog`, the handler receives
+    `relp.syslog.SyslogMessage` objects instead of `str`. Workers that die are
+    restarted, and the messages they did not confirm are NACKed.
+    '''
+    def __init__(self, handler, key=None, processes=None, parse_syslog=False,
+                 max_batch_messages=DEFAULT_BATCH_MESSAGES, max_batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_inflight_batches=DEFAULT_INFLIGHT_BATCHES, start_method=DEFAULT_START_METHOD,
+                 logger=default_logger, metrics=None):
+        self.handler = handler
+        self.key = key
+        self.processes = processes or multiprocessing.cpu_count()
+        self.parse_syslog = parse_syslog
+        self.max_batch_messages = max_batch_messages
+        self.max_batch_bytes = max_batch_bytes
+        self.max_inflight_batches = max_inflight_batches
+        self.logger = logger
+        self.metrics = metrics
+
+        self.context = multiprocessing.get_context(start_method)
+        self.shards = [Shard(self, index) for index in range(self.processes)]
+        # Every worker is started before the threads of the shards
+        for shard in self.shards:
+            shard._spawn()
+        for shard in self.shards:
+            shard.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __call__(self, message):
+        '''Dispatch a message, return a `Future` resolved once a worker processed it'''
+        return self._dispatch([message])[0]
+
+    def write_many(self, messages):
+        '''
+        Dispatch messages and wait until they are all processed.
+        Can be used as the `batch_handler` of a `RelpServer`.
+        '''
+        for future in self._dispatch(messages):
+            future.result()
+
+    def shard(self, message):
+        '''Return the index of the worker handling `message`'''
+        if self.key is None:
+            return 0 if self.processes == 1 else hash(str(message)) % self.processes
+        return hash(self.key(message)) % self.processes
+
+    def close(self):
+        '''Process the messages waiting and stop the workers'''
+        for shard in self.shards:
+            shard.close()
+
+    def _dispatch(self, messages):
+        futures = []
+        for message in messages:
+            shard = self.shards[self.shard(message)]
+            if isinstance(message, str):
+                payload = message.encode('utf-8')
+            elif isinstance(message, SyslogMessage):
+                payload = message.raw
+            else:
+                payload = message
+            future = Future()
+            shard.submit(payload, future)
+            futures.append(future)
+        return futures
@@ -1,17 +1,32 @@
 '''Module containing the custom exceptions'''
 
-class RelpProtocolError(RuntimeError):
+class RelpError(RuntimeError):
+    '''
+    Base class of the RELP exceptions
+    '''
+
+class RelpProtocolError(RelpError):
     '''
     Exceptions due to the RELP protocol related to parsing and packing
     '''
 
-class RelpSessionError(RuntimeError):
+class RelpSessionError(RelpError):
     '''
     Raised when there is an issue with messages
     that are received but unexpected.
     '''
 
-class AckError(RuntimeError):
+class AckError(RelpError):
     '''
     Raised when an message sent received a NACK.
+    With `send_many`, `nacked` is the list of the indexes of the refused
+    messages, in the order they were given.
+    '''
+    def __init__(self, message, nacked=()):
+        super().__init__(message)
+        self.nacked = list(nacked)
+
+class SpoolFullError(RelpError):
+    '''
+    Raised when a message cannot be written to a spool that reached its size limit.
     '''
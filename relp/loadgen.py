@@ -0,0 +1,341 @@
+'''
+Load generator and traffic replay for RELP servers.
+
+Send generated messages from `--sessions` concurrent sessions, at a target
+`--rate` (messages per second, as fast as possible by default):
+
+    python -m relp.loadgen 127.0.0.1 2514 --sessions 8 --duration 30 --size lognormal:300:0.8
+
+Replay a recorded syslog file with its original timing (`--speed 10` for ten times faster):
+
+    python -m relp.loadgen 127.0.0.1 2514 --replay /var/log/messages
+
+Run a server counting and discarding the messages, for capacity tests on loopback:
+
+    python -m relp.loadgen --sink 0.0.0.0 2514
+'''
+
+import argparse
+import json
+import logging
+import random
+import signal
+import sys
+
+from datetime import datetime
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from relp.client import RelpClient
+from relp.metrics import Histogram
+from relp.protocol import RspCode
+from relp.server import RelpServer
+from relp.session import DEFAULT_WINDOW
+from relp.syslog import SyslogMessage
+
+default_logger = logging.getLogger('relp-loadgen')
+
+# Finer than the default buckets, to compare the ack latency of runs
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+# Largest generated message
+MAX_MESSAGE_SIZE = 1024 * 1024
+PADDING = 'x' * MAX_MESSAGE_SIZE
+
+def size_distribution(spec):
+    '''
+    Return a function giving the size of the next message from a `random.Random`,
+    for `spec` among `SIZE`, `fixed:SIZE`, `uniform:MIN:MAX`, `normal:MEAN:STDDEV`
+    and `lognormal:MEDIAN:SIGMA`.
+    '''
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'fixed', spec
+    try:
+        values = [float(value) for value in params.split(':')]
+    except ValueError:
+        raise ValueError(f"Invalid message size distribution `{spec}`")
+    distributions = {
+        'fixed': (1, lambda rng, size: size),
+        'uniform': (2, lambda rng, low, high: rng.uniform(low, high)),
+        'normal': (2, lambda rng, mean, stddev: rng.gauss(mean, stddev)),
+        'lognormal': (2, lambda rng, median, sigma: median * rng.lognormvariate(0, sigma)),
+    }
+    if kind not in distributions or len(values) != distributions[kind][0]:
+        raise ValueError(f"Invalid message size distribution `{spec}`")
+    draw = distributions[kind][1]
+    return lambda rng: max(1, min(MAX_MESSAGE_SIZE, int(draw(rng, *values))))
+
+def make_message(session, seq, size):
+    '''Return a RFC 5424 message of about `size` bytes'''
+    header = f"<13>1 - loadgen relp-loadgen {session} {seq} - "
+    return header + PADDING[:max(0, size - len(header))]
+
+def message_time(message):
+    '''Return the timestamp of a recorded `SyslogMessage` in seconds, None if it has none'''
+    timestamp = message.timestamp
+    if timestamp is None:
+        return None
+    try:
+        if timestamp[0].isdigit():
+            return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+        return datetime.strptime(timestamp, '%b %d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+class LoadSession:
+    '''A client session of the load generator, counting its acknowledgements'''
+    def __init__(self, index, address, port, window, **client_options):
+        self.index = index
+        self.client = RelpClient(address, port, window=window, **client_options)
+        self.lock = Lock()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.sent = 0
+        self.bytes = 0
+        self.acked = 0
+        self.nacked = 0
+        self.failed = 0
+        self.last = None
+
+    def send(self, message):
+        # Count the bytes sent, not the characters
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        handle = self.client.syslog_async(payload)
+        sent = monotonic()
+        handle.add_done_callback(lambda handle: self._on_ack(handle, sent))
+        self.sent += 1
+        self.bytes += len(payload)
+        self.last = handle
+
+    def _on_ack(self, handle, sent):
+        latency = monotonic() - sent
+        with self.lock:
+            if handle.error is None:
+                self.latency.observe(latency)
+            if handle.error is not None:
+                self.failed += 1
+            elif handle.ack.code == RspCode.ACK.value:
+                self.acked += 1
+            else:
+                self.nacked += 1
+
+    def finish(self, timeout):
+        '''Wait for the acknowledgement of the messages sent, and close the session'''
+        if self.last is not None:
+            try:
+                self.last.result(timeout)
+            except Exception:
+                pass
+        self.client.stop()
+
+class LoadGenerator:
+    '''
+    Send messages to a RELP server from `sessions` sessions, and gather the throughput,
+    the acknowledgements and the ack latency histogram in `report()`.
+    '''
+    def __init__(self, address, port, sessions=1, window=DEFAULT_WINDOW, logger=default_logger, **client_options):
+        self.logger = logger
+        self.sessions = [
+            LoadSession(index, address, port, window, logger=logger, **client_options)
+            for index in range(sessions)
+        ]
+        self.started = None
+        self.elapsed = None
+
+    def generate(self, rate=None, count=None, duration=None, size='200', seed=None, ack_timeout=30.0):
+        '''
+        Send generated messages, `rate` messages per second over all the sessions
+        (as fast as the windows allow if None), until `count` messages were sent
+        or for `duration` seconds. Return the report.
+        '''
+        if count is None and duration is None:
+            raise ValueError("Either `count` or `duration` is required")
+        sizes = size_distribution(size)
+        session_rate = rate / len(self.sessions) if rate else None
+        self.started = monotonic()
+        deadline = None if duration is None else self.started + duration
+
+        def run(session):
+            rng = random.Random(None if seed is None else seed + session.index)
+            total = None
+            if count is not None:
+                total = count // len(self.sessions) + (session.index < count % len(self.sessions))
+            session.client.start()
+            while total is None or session.sent < total:
+                now = monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                if session_rate:
+                    ahead = self.started + session.sent / session_rate - now
+                    if ahead > 0.001:
+                        sleep(ahead)
+                session.send(make_message(session.index, session.sent, sizes(rng)))
+            session.finish(ack_timeout)
+
+        self._run(run)
+        return self.report()
+
+    def replay(self, lines, speed=1.0, ack_timeout=30.0):
+        '''
+        Send recorded syslog `lines` with their original timing (`speed` times faster),
+        spreading the hosts over the sessions. Lines without a timestamp are sent right
+        after the previous one. Return the report.
+        '''
+        for session in self.sessions:
+            session.client.start()
+        self.started = monotonic()
+        first = None
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            message = SyslogMessage(line.encode('utf-8'))
+            timestamp = message_time(message)
+            if timestamp is not None:
+                if first is None:
+                    first = timestamp
+                ahead = self.started + (timestamp - first) / speed - monotonic()
+                if ahead > 0.001:
+                    sleep(ahead)
+            self.sessions[hash(message.hostname) % len(self.sessions)].send(message.raw)
+        self._run(lambda session: session.finish(ack_timeout))
+        return self.report()
+
+    def _run(self, target):
+        threads = [Thread(target=target, args=(session,), daemon=True) for session in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = monotonic() - self.started
+
+    def report(self):
+        '''
+        Return the counts, throughput and histogram of the time between queuing
+        a message in the window and receiving its ACK, in the format of `MetricsRegistry.stats()`
+        '''
+        latency = Histogram(LATENCY_BUCKETS)
+        for session in self.sessions:
+            with session.lock:
+                latency.counts = [total + count for total, count in zip(latency.counts, session.latency.counts)]
+                latency.count += session.latency.count
+                latency.sum += session.latency.sum
+        sent = sum(session.sent for session in self.sessions)
+        sent_bytes = sum(session.bytes for session in self.sessions)
+        elapsed = self.elapsed or 0.0
+        return {
+            'sessions': len(self.sessions),
+            'elapsed': elapsed,
+            'sent': sent,
+            'acked': sum(session.acked for session in self.sessions),
+            'nacked': sum(session.nacked for session in self.sessions),
+            'failed': sum(session.failed for session in self.sessions),
+            'msgs_per_sec': sent / elapsed if elapsed else 0.0,
+            'bytes_per_sec': sent_bytes / elapsed if elapsed else 0.0,
+            'ack_seconds': {
+                'count': latency.count,
+                'sum': latency.sum,
+                'buckets': dict(zip(map(str, latency.bounds), latency.counts)),
+                'p50': latency.quantile(0.50),
+                'p90': latency.quantile(0.90),
+                'p99': latency.quantile(0.99),
+                'p999': latency.quantile(0.999),
+            },
+        }
+
+def format_report(report):
+    '''Return the report as text, with the ack latency histogram'''
+    lines = [
+        f"sessions: {report['sessions']}, elapsed: {report['elapsed']:.2f}s",
+        f"sent: {report['sent']}, acked: {report['acked']}, nacked: {report['nacked']}, failed: {report['failed']}",
+        f"throughput: {report['msgs_per_sec']:.0f} msg/s, {report['bytes_per_sec'] / 1024 / 1024:.2f} MiB/s",
+    ]
+    latency = report['ack_seconds']
+    if latency.get('count'):
+        lines.append(f"ack latency: mean {latency['sum'] / latency['count'] * 1000:.3f}ms, "
+                     + ', '.join(f"{name} <= {latency[name] * 1000:g}ms" for name in ('p50', 'p90', 'p99', 'p999')))
+        width = max(latency['buckets'].values())
+        for bound, count in latency['buckets'].items():
+            label = '+Inf' if bound == 'inf' else f"{float(bound) * 1000:g}ms"
+            bar = '#' * round(40 * count / width) if width else ''
+            lines.append(f"  <= {label:>8} {count:>10} {bar}".rstrip())
+    return '\n'.join(lines)
+
+class CountingSink:
+    '''Batch handler counting and discarding the messages'''
+    def __init__(self):
+        self.lock = Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def __call__(self, messages):
+        size = sum(len(message.raw) for message in messages)
+        with self.lock:
+            self.messages += len(messages)
+            self.bytes += size
+
+def run_sink(address, port, interval=1.0, logger=default_logger, **server_options):
+    '''Serve RELP, discard the messages and print the received rate every `interval` seconds'''
+    sink = CountingSink()
+    server = RelpServer(address, port, batch_handler=sink, parse_syslog=True, logger=logger, **server_options)
+    server.start()
+    print(f"Sink listening on {address}:{server.socket.getsockname()[1]}", flush=True)
+    start = last_time = monotonic()
+    last_messages = 0
+    try:
+        while True:
+            sleep(interval)
+            now = monotonic()
+            messages = sink.messages
+            print(f"{messages - last_messages} messages in {now - last_time:.2f}s "
+                  f"({(messages - last_messages) / (now - last_time):.0f} msg/s), "
+                  f"{server.session_stats()['active']} sessions", flush=True)
+            last_time, last_messages = now, messages
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    elapsed = monotonic() - start
+    print(f"Received {sink.messages} messages ({sink.bytes} bytes) in {elapsed:.2f}s")
+    return sink
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m relp.loadgen', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('address', help='Server to send to (or address to listen on, with --sink)')
+    parser.add_argument('port', type=int, help='Port of the server (or to listen on, with --sink)')
+    parser.add_argument('--sink', action='store_true', help='Run a server counting and discarding the messages')
+    parser.add_argument('--sessions', type=int, default=1, help='Concurrent sessions')
+    parser.add_argument('--rate', type=float, help='Messages per second over all the sessions (default: as fast as possible)')
+    parser.add_argument('--count', type=int, help='Messages to send')
+    parser.add_argument('--duration', type=float, help='Seconds to send for (default: 10, unless --count)')
+    parser.add_argument('--size', default='200',
+                        help='Message size: SIZE, uniform:MIN:MAX, normal:MEAN:STDDEV or lognormal:MEDIAN:SIGMA')
+    parser.add_argument('--seed', type=int, help='Seed of the message sizes')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='RELP window of each session')
+    parser.add_argument('--replay', help='Syslog file to send with its original timing')
+    parser.add_argument('--speed', type=float, default=1.0, help='Speed factor of the replay')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between the reports of the sink')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.sink:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run_sink(args.address, args.port, args.interval)
+        return 0
+
+    generator = LoadGenerator(args.address, args.port, sessions=args.sessions, window=args.window)
+    if args.replay:
+        with open(args.replay, encoding='utf-8', errors='replace') as lines:
+            report = generator.replay(lines, speed=args.speed)
+    else:
+        duration = args.duration if args.duration is not None or args.count is not None else 10.0
+        report = generator.generate(rate=args.rate, count=args.count, duration=duration,
+                                    size=args.size, seed=args.seed)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 1 if report['nacked'] or report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
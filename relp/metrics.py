@@ -0,0 +1,198 @@
+'''Metrics of RELP sessions and servers'''
+
+import logging
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from weakref import WeakSet
+
+default_logger = logging.getLogger('relp-metrics')
+
+# Upper bounds (in seconds) of the latency histograms buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+# name: (type, label, help)
+METRICS = {
+    'relp_frames_received_total': ('counter', 'command', 'RELP frames received'),
+    'relp_bytes_received_total': ('counter', 'command', 'Payload bytes received in RELP frames'),
+    'relp_frames_sent_total': ('counter', 'command', 'RELP frames sent'),
+    'relp_bytes_sent_total': ('counter', None, 'Bytes written to RELP sockets'),
+    'relp_nacks_total': ('counter', 'direction', 'NACK received from or sent to the peer'),
+    'relp_overflow_total': ('counter', 'action', 'Frames received while the receive budget was exhausted'),
+    'relp_sessions_total': ('counter', None, 'RELP sessions started'),
+    'relp_sessions_active': ('gauge', None, 'RELP sessions running'),
+    'relp_sessions_rejected_total': ('counter', 'reason', 'Connections closed by a server before starting their session'),
+    'relp_sessions_idle_total': ('counter', None, 'RELP sessions closed by a server after being idle'),
+    'relp_send_queue_depth': ('gauge', None, 'Frames waiting to be written, for all sessions'),
+    'relp_recv_queue_depth': ('gauge', None, 'Frames waiting for the handler, for all sessions'),
+    'relp_inflight_acks': ('gauge', None, 'Frames sent and waiting for their ACK, for all sessions'),
+    'relp_ack_seconds': ('histogram', None, 'Time between sending a frame and receiving its ACK'),
+    'relp_handler_seconds': ('histogram', None, 'Duration of the handler calls'),
+    'relp_sink_commits_total': ('counter', None, 'Groups of messages written and synced by file sinks'),
+    'relp_sink_messages_total': ('counter', None, 'Messages written and synced by file sinks'),
+    'relp_sink_commit_seconds': ('histogram', None, 'Duration of the write and fsync of a group by file sinks'),
+    'relp_dispatch_batches_total': ('counter', None, 'Batches of messages sent to dispatch worker processes'),
+    'relp_dispatch_messages_total': ('counter', None, 'Messages sent to dispatch worker processes'),
+    'relp_dispatch_restarts_total': ('counter', None, 'Dispatch worker processes that exited and were restarted'),
+}
+
+class Histogram:
+    '''Cumulative histogram with fixed buckets'''
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        '''Record a value'''
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, ratio):
+        '''Return the upper bound of the bucket containing the `ratio` quantile'''
+        target = self.count * ratio
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= target and total:
+                return bound
+        return 0.0
+
+class MetricsRegistry:
+    '''
+    Registry of the metrics of RELP sessions.
+    Give it to `RelpClient`, `RelpServer` or `RelpSession` with `metrics=`.
+    Sessions are not instrumented at all when no registry is given.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS, logger=default_logger):
+        self.buckets = buckets
+        self.logger = logger
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.sessions = WeakSet()
+
+    def inc(self, name, value=1, label=None):
+        '''Increment a counter'''
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        '''Record a value in a histogram'''
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def track(self, session):
+        '''Follow the queues and window of a session, for the gauges'''
+        self.inc('relp_sessions_total')
+        with self.lock:
+            self.sessions.add(session)
+
+    def gauges(self):
+        '''Compute the current value of the gauges from the tracked sessions'''
+        with self.lock:
+            sessions = [session for session in self.sessions if session.running]
+        return {
+            'relp_sessions_active': len(sessions),
+            'relp_send_queue_depth': sum(session.send_queue.qsize() for session in sessions),
+            'relp_recv_queue_depth': sum(session.recv_queue.qsize() for session in sessions),
+            'relp_inflight_acks': sum(session.window.inflight() for session in sessions),
+        }
+
+    def stats(self):
+        '''
+        Return a snapshot of all the metrics as a dict.
+        Counters with a label are dicts of label value to count, and
+        histograms are dicts with `count`, `sum`, `buckets`, `p50` and `p99`.
+        '''
+        stats = {}
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                if label is None:
+                    stats[name] = value
+                else:
+                    stats.setdefault(name, {})[label] = value
+            for name, histogram in self.histograms.items():
+                stats[name] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': dict(zip(map(str, histogram.bounds), histogram.counts)),
+                    'p50': histogram.quantile(0.50),
+                    'p99': histogram.quantile(0.99),
+                }
+        stats.update(self.gauges())
+        return stats
+
+    def prometheus(self):
+        '''Return the metrics in the Prometheus text exposition format'''
+        lines = []
+        stats = self.stats()
+        for name, (kind, label, description) in METRICS.items():
+            if name not in stats:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            value = stats[name]
+            if kind == 'histogram':
+                total = 0
+                for bound, count in value['buckets'].items():
+                    total += count
+                    bound = '+Inf' if bound == 'inf' else bound
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+                lines.append(f"{name}_sum {value['sum']}")
+                lines.append(f"{name}_count {value['count']}")
+            elif label:
+                for label_value, count in value.items():
+                    lines.append(f'{name}{{{label}="{label_value}"}} {count}')
+            else:
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+def serve_prometheus(registry, port, listen_addr='0.0.0.0'):
+    '''
+    Expose the metrics of `registry` over HTTP for Prometheus, in a daemon thread.
+    Return the `ThreadingHTTPServer` (call `shutdown` on it to stop it).
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            registry.logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((listen_addr, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def merge_stats(stats_list):
+    '''
+    Merge `MetricsRegistry.stats()` snapshots (of several processes for instance).
+    Counters, gauges and histogram buckets are added up, quantiles are the maximum.
+    '''
+    merged = {}
+    for stats in stats_list:
+        _merge(merged, stats)
+    return merged
+
+def _merge(merged, stats):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            _merge(merged.setdefault(key, {}), value)
+        elif key in ('p50', 'p99'):
+            merged[key] = max(merged.get(key, value), value)
+        else:
+            merged[key] = merged.get(key, 0) + value
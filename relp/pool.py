@@ -0,0 +1,205 @@
+'''Pool of RELP client sessions spread over several servers'''
+
+import logging
+
+from concurrent.futures import Future
+from itertools import count
+from socket import create_connection, SOL_SOCKET, SO_KEEPALIVE, SHUT_RDWR
+from threading import Condition, Event, Thread
+from time import monotonic
+
+from relp.session import *
+
+default_logger = logging.getLogger('relp-pool')
+
+class PoolMember:
+    '''A RELP session of the pool, connected to one endpoint'''
+    def __init__(self, endpoint, session):
+        self.endpoint = endpoint
+        self.session = session
+        # Last time an ACK was received (or the session became busy)
+        self.last_progress = monotonic()
+
+    def alive(self):
+        '''Return True if the session is running'''
+        return self.session.running
+
+    def inflight(self):
+        '''Return the number of messages waiting for their ACK'''
+        return self.session.window.inflight()
+
+    def __repr__(self):
+        return f"PoolMember[{self.endpoint[0]}:{self.endpoint[1]}]"
+
+class RelpClientPool:
+    '''
+    Send syslog messages over `connections` RELP sessions per endpoint.
+
+    Each message goes to the live session with the least messages waiting for
+    their ACK (`strategy='least-inflight'`) or to the next session with room in
+    its window (`strategy='round-robin'`). A health-check thread evicts the
+    sessions that are closed or did not receive any ACK for `ack_timeout` seconds,
+    and reconnects them. Messages still waiting for their ACK on an evicted session
+    are sent again on a live one, so the returned futures always resolve.
+    '''
+    def __init__(self, endpoints, connections=1, strategy='least-inflight', window=DEFAULT_WINDOW,
+                 logger=default_logger, metrics=None, health_interval=5.0, ack_timeout=30.0,
+                 connect_timeout=5.0):
+        if strategy not in ('least-inflight', 'round-robin'):
+            raise ValueError(f"Unknown strategy `{strategy}`")
+        self.endpoints = [tuple(endpoint) for endpoint in endpoints]
+        self.connections = connections
+        self.strategy = strategy
+        self.window = window
+        self.logger = logger
+        self.metrics = metrics
+        self.health_interval = health_interval
+        self.ack_timeout = ack_timeout
+        self.connect_timeout = connect_timeout
+
+        self.members = []
+        self.condition = Condition()
+        self.counter = count()
+        self.stopping = Event()
+        self.health_thread = Thread(target=self._health_check, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''Connect to the endpoints and start the health-check thread'''
+        self._fill()
+        if not self.members:
+            self.logger.error("Could not connect to any RELP endpoint, will retry")
+        self.health_thread.start()
+
+    def stop(self):
+        '''Close all the sessions, waiting for the messages in flight'''
+        self.stopping.set()
+        with self.condition:
+            members, self.members = self.members, []
+            self.condition.notify_all()
+        for member in members:
+            member.session.stop()
+        self.health_thread.join()
+
+    def _connect(self, endpoint):
+        sock = create_connection(endpoint, self.connect_timeout)
+        sock.settimeout(None)
+        sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        session = RelpSession(sock, 'client', self.logger, window=self.window, metrics=self.metrics,
+                              close_timeout=self.connect_timeout)
+        session.start()
+        try:
+            session.offer(self.connect_timeout)
+        except Exception:
+            session.stop()
+            raise
+        return PoolMember(endpoint, session)
+
+    def _fill(self):
+        '''Open sessions to the endpoints that have less than `connections` of them'''
+        for endpoint in self.endpoints:
+            with self.condition:
+                missing = self.connections - sum(1 for member in self.members if member.endpoint == endpoint)
+            for _ in range(missing):
+                if self.stopping.is_set():
+                    return
+                try:
+                    member = self._connect(endpoint)
+                except (OSError, RelpSessionError, TimeoutError) as err:
+                    self.logger.warning("Could not connect to %s:%s: %s", *endpoint, err)
+                    break
+                self.logger.info("Connected to %s:%s", *endpoint)
+                with self.condition:
+                    self.members.append(member)
+                    self.condition.notify_all()
+
+    def _evict(self, member, reason):
+        '''Remove a session from the pool. Its pending messages are sent again.'''
+        with self.condition:
+            if member not in self.members:
+                return
+            self.members.remove(member)
+        self.logger.warning("Evicting %s: %s", member, reason)
+        try:
+            member.session.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        # Joining the session threads could wait on this thread
+        Thread(target=member.session.stop, daemon=True).start()
+
+    def _health_check(self):
+        while not self.stopping.wait(self.health_interval):
+            now = monotonic()
+            with self.condition:
+                members = list(self.members)
+            for member in members:
+                if not member.alive():
+                    self._evict(member, "session closed")
+                elif member.inflight() and now - member.last_progress > self.ack_timeout:
+                    self._evict(member, f"no ACK received for {self.ack_timeout}s")
+            self._fill()
+
+    def _choose(self, timeout=None):
+        '''Return the member that should send the next message'''
+        with self.condition:
+            ready = lambda: self.stopping.is_set() or any(member.alive() for member in self.members)
+            if not self.condition.wait_for(ready, timeout):
+                raise RelpSessionError(f"No RELP session available after {timeout}s")
+            if self.stopping.is_set():
+                raise RelpSessionError("RELP client pool is stopped")
+            members = [member for member in self.members if member.alive()]
+        if self.strategy == 'round-robin':
+            start = next(self.counter)
+            for index in range(len(members)):
+                member = members[(start + index) % len(members)]
+                if member.inflight() < self.window:
+                    return member
+        return min(members, key=PoolMember.inflight)
+
+    def _submit(self, message, future, timeout=None):
+        while True:
+            member = self._choose(timeout)
+            if not member.inflight():
+                member.last_progress = monotonic()
+            try:
+                handle = member.session.send_async('syslog', message)
+            except RelpSessionError:
+                continue
+            handle.add_done_callback(lambda handle: self._done(member, message, future, handle))
+            return
+
+    def _done(self, member, message, future, handle):
+        error = handle.exception()
+        if error is None:
+            member.last_progress = monotonic()
+            future.set_result(handle.ack)
+            return
+        self._evict(member, error)
+        self.logger.debug("Sending again message of TXNR %s from %s", handle.txnr, member)
+        try:
+            self._submit(message, future, self.ack_timeout)
+        except RelpSessionError as err:
+            future.set_exception(err)
+
+    def syslog_async(self, message: str, timeout=None):
+        '''
+        Send a syslog message on one of the sessions of the pool.
+        Return a `Future` resolved with the `Ack` of the message.
+        Wait at most `timeout` seconds for a session to be available.
+        '''
+        future = Future()
+        self._submit(message, future, timeout)
+        return future
+
+    def syslog(self, message: str, timeout=None):
+        '''Send a syslog message and wait for its acknowledgement'''
+        ack = self.syslog_async(message, timeout).result(timeout)
+        if ack.code == RspCode.NACK.value:
+            raise AckError(f"NACK received: {ack.message}")
+        return ack
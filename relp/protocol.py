@@ -2,7 +2,6 @@
 
 import logging
 import re
-import sys
 
 from collections import namedtuple
 from enum import Enum
@@ -10,27 +9,97 @@ from enum import Enum
 from relp.exceptions import *
 
 default_logger = logging.getLogger('relp-protocol')
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 VERSION = '0'
 SOFTWARE = 'python-relp'
-COMMANDS = ['syslog']
+# `syslogbatch` is an extension of python-relp: one frame (and one ACK) carrying
+# many messages. It is only used when both peers list it in their offer.
+BATCH_COMMAND = 'syslogbatch'
+COMMANDS = ['syslog', BATCH_COMMAND]
+
+# TXNR wraps back to 1 after this value
+MAX_TXNR = 999999999
+
+# Largest possible header: TXNR (9 digits), command (32 chars),
+# DATALEN (9 digits) and the separators.
+MAX_HEADER_SIZE = 9 + 1 + 32 + 1 + 9 + 1
+HEADER_REGEX = re.compile(rb'([0-9]{1,9}) ([a-zA-Z]{1,32}) ([0-9]{1,9})[ \n]')
+TRAILER = 0x0a
+
+# Encoded names of the commands, to format headers without encoding them each time
+COMMAND_BYTES = {command: command.encode('ascii') for command in ['open', 'rsp', 'close', 'serverclose'] + COMMANDS}
+
+def command_bytes(command):
+    '''Return the command name as bytes'''
+    data = COMMAND_BYTES.get(command)
+    if data is None:
+        data = command.encode('ascii')
+    return data
 
 class Frame:
-    '''Define a RELP frame'''
+    '''
+    Define a RELP frame.
+    The message can be given as `str` or as `bytes`. Received frames keep the raw
+    payload and only decode it to `str` when `message` is accessed.
+    '''
+    __slots__ = ('txnr', 'command', '_message', '_payload')
     logger = default_logger
 
-    def __init__(self, txnr: int, command: str, message: str):
+    def __init__(self, txnr: int, command: str, message=''):
         self.txnr = txnr
         self.command = command
-        self.message = message
+        if isinstance(message, str):
+            self._message = message
+            self._payload = None
+        else:
+            self._message = None
+            self._payload = message
+
+    @property
+    def message(self):
+        '''The payload of the frame, decoded as UTF-8'''
+        if self._message is None:
+            self._message = self._payload.decode('utf-8', 'replace')
+        return self._message
+
+    @property
+    def payload(self):
+        '''The raw payload of the frame, as bytes'''
+        if self._payload is None:
+            self._payload = self._message.encode('utf-8')
+        return self._payload
 
     def encode(self):
-        '''Create a RELP message frame'''
-        return f"{self.txnr} {self.command} {len(self.message)} {self.message}\n"
+        '''Create a RELP message frame, with the DATALEN counted in octets'''
+        payload = self.payload
+        if payload:
+            return b'%d %s %d %s\n' % (self.txnr, command_bytes(self.command), len(payload), payload)
+        return b'%d %s 0\n' % (self.txnr, command_bytes(self.command))
+
+    def encode_into(self, out):
+        '''Append the encoded frame to the `bytearray` `out`, copying the payload only once'''
+        payload = self.payload
+        if payload:
+            out += b'%d %s %d ' % (self.txnr, command_bytes(self.command), len(payload))
+            out += payload
+            out.append(TRAILER)
+        else:
+            out += b'%d %s 0\n' % (self.txnr, command_bytes(self.command))
 
     def __repr__(self):
-        return 'Frame[' + repr(self.encode()).strip("'") + ']'
+        return 'Frame[' + repr(self.encode())[2:-1] + ']'
+
+    def messages(self):
+        '''Return the list of the syslog messages carried by the frame'''
+        if self.command == BATCH_COMMAND:
+            return [message.decode('utf-8', 'replace') for message in unpack_messages(self.payload)]
+        return [self.message]
+
+    def payloads(self):
+        '''Return the list of the syslog messages carried by the frame, as bytes'''
+        if self.command == BATCH_COMMAND:
+            return unpack_messages(self.payload)
+        return [self.payload]
 
     @classmethod
     def decode(cls, data: str):
@@ -47,7 +116,9 @@ class Frame:
     @classmethod
     def decode_batch(cls, data: str):
         '''
-        Parse a batch of RELP frames
+        Parse a batch of RELP frames from a `str`.
+        Legacy parser, counting DATALEN in characters. `FrameParser` should
+        be used on data read from a socket.
         '''
         frames = []
         while data:
@@ -75,6 +146,80 @@ class Frame:
                 raise err
         return frames, ''
 
+class FrameParser:
+    '''
+    Incremental RELP frame parser working on bytes.
+
+    Data is appended to a single `bytearray` (with `feed` or `read_from`, which
+    reads from a socket into a reusable buffer) and `frames` returns every
+    complete frame. Consumed data is dropped once per call, so frames split
+    across reads and large messages are never copied more than once.
+    '''
+    logger = default_logger
+
+    def __init__(self, bufsize=65536):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.chunk = bytearray(bufsize)
+        self.chunk_view = memoryview(self.chunk)
+        # Header of the frame waiting for its payload: (txnr, command, length, start)
+        self.pending = None
+
+    def feed(self, data):
+        '''Append raw data to the parser buffer'''
+        self.buffer += data
+
+    def read_from(self, sock):
+        '''
+        Read available data from a socket into the parser buffer.
+        Return the number of bytes read (0 when the peer closed the connection).
+        '''
+        size = sock.recv_into(self.chunk)
+        if size:
+            self.buffer += self.chunk_view[:size]
+        return size
+
+    def frames(self):
+        '''Return the list of complete frames available in the buffer'''
+        frames = []
+        buffer = self.buffer
+        end = len(buffer)
+        with memoryview(buffer) as view:
+            while True:
+                if self.pending is None:
+                    match = HEADER_REGEX.match(buffer, self.offset)
+                    if not match:
+                        if end - self.offset >= MAX_HEADER_SIZE or buffer.find(b'\n', self.offset) >= 0:
+                            header = bytes(view[self.offset:self.offset + MAX_HEADER_SIZE])
+                            raise RelpProtocolError(f"Invalid RELP frame header: {header}")
+                        break
+                    txnr, command, length = int(match[1]), match[2].decode('ascii'), int(match[3])
+                    if buffer[match.end() - 1] == TRAILER:
+                        if length:
+                            raise RelpProtocolError(f"Frame {txnr} announces {length} bytes but has no data")
+                        frames.append(Frame(txnr, command, b''))
+                        self.offset = match.end()
+                        continue
+                    self.pending = (txnr, command, length, match.end())
+
+                txnr, command, length, start = self.pending
+                stop = start + length
+                if stop >= end:
+                    break
+                if buffer[stop] != TRAILER:
+                    raise RelpProtocolError(f"Message should be terminated with \\n, received: {buffer[stop:stop + 1]}")
+                frames.append(Frame(txnr, command, bytes(view[start:stop])))
+                self.pending = None
+                self.offset = stop + 1
+
+        if self.offset:
+            if self.pending:
+                txnr, command, length, start = self.pending
+                self.pending = (txnr, command, length, start - self.offset)
+            del buffer[:self.offset]
+            self.offset = 0
+        return frames
+
 class RspCode(Enum):
     '''Enum for rsp message code'''
     ACK = 200
@@ -82,6 +227,8 @@ class RspCode(Enum):
 
 class Ack:
     '''Ack message in RELP'''
+    __slots__ = ('txnr', 'code', 'message')
+
     def __init__(self, txnr: int, code: RspCode = RspCode.ACK, message: str = 'OK'):
         self.txnr = txnr
         self.code = code
@@ -94,22 +241,24 @@ class Ack:
     @staticmethod
     def from_frame(frame):
         '''Create an ACK object from a Frame object'''
-        code, message = frame.message.split(' ', 2)
+        code, _, message = frame.message.partition(' ')
         code = int(code)
         return Ack(frame.txnr, code, message)
 
 class Offer:
     '''RELP offer'''
-    def __init__(self, version=VERSION, software=SOFTWARE, commands=','.join(COMMANDS)):
+    __slots__ = ('version', 'software', 'commands')
+
+    def __init__(self, version=VERSION, software=SOFTWARE, commands=COMMANDS):
         self.version = version
         self.software = software
-        self.commands = commands
+        self.commands = commands.split(',') if isinstance(commands, str) else list(commands)
 
     def message(self):
         message = '\n'.join([
             f"relp_version={self.version}",
             f"relp_software={self.software}",
-            f"commands={self.commands}",
+            f"commands={','.join(self.commands)}",
         ])
         return message
 
@@ -118,19 +267,117 @@ class Offer:
         return Frame(txnr, 'open', self.message())
 
     @staticmethod
-    def from_frame(frame):
-        '''Create an Offer object from a Frame'''
+    def parse(message):
+        '''
+        Create an Offer object from the data of an `open` frame, or from the
+        message of its `rsp` (which can start with a `200 OK` line)
+        '''
         header_dict = {}
-        _, *headers = frame.message.split('\n')
-        for header in headers:
-            key, value = header.split('=', 2)
-            header_dict[key] = value
+        for header in message.split('\n'):
+            key, sep, value = header.partition('=')
+            if sep:
+                header_dict[key.strip()] = value.strip()
+        commands = header_dict.get('commands')
         return Offer(
             header_dict.get('relp_version'),
             header_dict.get('relp_software'),
-            header_dict.get('commands').split(','),
+            commands.split(',') if commands else [],
         )
 
+    @staticmethod
+    def from_frame(frame):
+        '''Create an Offer object from a Frame'''
+        return Offer.parse(frame.message)
+
+    def negotiate(self, commands=COMMANDS):
+        '''Return the commands of `commands` also supported by the peer that sent this offer'''
+        return [command for command in commands if command in self.commands]
+
+def pack_messages(messages):
+    '''Encode messages (`str` or `bytes`) as the data of a `syslogbatch` frame'''
+    data = bytearray()
+    for message in messages:
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        data += b'%d ' % len(message)
+        data += message
+    return bytes(data)
+
+def unpack_messages(data):
+    '''Decode the data of a `syslogbatch` frame to the list of messages (as bytes)'''
+    messages = []
+    offset = 0
+    end = len(data)
+    with memoryview(data) as view:
+        while offset < end:
+            space = data.find(b' ', offset, offset + 10)
+            if space < 0 or not data[offset:space].isdigit():
+                raise RelpProtocolError(f"Invalid message length in batch at offset {offset}")
+            start = space + 1
+            offset = start + int(data[offset:space])
+            if offset > end:
+                raise RelpProtocolError(f"Truncated message in batch at offset {start}")
+            messages.append(bytes(view[start:offset]))
+    return messages
+
+def count_messages(data):
+    '''Return the number of messages in the data of a `syslogbatch` frame, without decoding them'''
+    count = 0
+    offset = 0
+    end = len(data)
+    while offset < end:
+        space = data.find(b' ', offset, offset + 10)
+        if space < 0 or not data[offset:space].isdigit():
+            raise RelpProtocolError(f"Invalid message length in batch at offset {offset}")
+        offset = space + 1 + int(data[offset:space])
+        count += 1
+    return count
+
+# Everything after the TXNR in the `rsp` frames of an ACK and of the reply to the default offer
+ACK_FORMAT = b'%d rsp 6 200 OK\n'
+OFFER_REPLY_TAIL = Ack(0, message=Offer().message()).to_frame().encode()[1:]
+
+class FrameWriter:
+    '''
+    Encoder of frames into a single `bytearray`, reused for each write.
+    ACK and offer replies are only the TXNR formatted before a constant tail.
+    '''
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def frame(self, frame):
+        '''Encode a `Frame`'''
+        frame.encode_into(self.buffer)
+
+    def data(self, data):
+        '''Append already encoded frames'''
+        self.buffer += data
+
+    def ack(self, txnr):
+        '''Encode the ACK of `txnr`'''
+        self.buffer += ACK_FORMAT % txnr
+
+    def rsp(self, txnr, code, message):
+        '''Encode a `rsp` frame with any code and message'''
+        if code is RspCode.ACK and message == 'OK':
+            self.buffer += ACK_FORMAT % txnr
+        else:
+            Ack(txnr, code, message).to_frame().encode_into(self.buffer)
+
+    def offer_reply(self, txnr):
+        '''Encode the ACK of an `open` frame, with the default offer'''
+        self.buffer += b'%d' % txnr
+        self.buffer += OFFER_REPLY_TAIL
+
+    def clear(self):
+        '''Forget the encoded data, once written'''
+        del self.buffer[:]
+
 def parse_frame(data):
     '''
     Parse a frame to extract the information.
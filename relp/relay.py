@@ -0,0 +1,83 @@
+'''RELP relay: forward the messages received by a server to downstream servers'''
+
+import logging
+
+from concurrent.futures import Future
+
+from relp.exceptions import AckError
+from relp.pool import RelpClientPool
+from relp.protocol import RspCode
+from relp.server import RelpServer
+from relp.session import DEFAULT_WINDOW
+
+default_logger = logging.getLogger('relp-relay')
+
+class RelpRelay:
+    '''
+    RELP server forwarding every message it receives to a `RelpClientPool` of
+    downstream `endpoints`.
+
+    A message is acknowledged upstream only once a downstream server acknowledged
+    it, and NACKed if it was NACKed downstream: a relay that crashes loses nothing,
+    the upstream clients send again the messages not acknowledged (at least once
+    delivery). Both sides are pipelined: each upstream session forwards up to
+    `max_inflight` messages (the downstream windows of all the sessions of the
+    pool by default) before waiting for downstream ACKs, and ACKs are sent
+    upstream in order. Messages are forwarded as the bytes received, unchanged.
+    `ssl_context` and `handshake_timeout` are given to the `RelpServer`, `connections`,
+    `strategy`, `window`, `health_interval` and `ack_timeout` to the `RelpClientPool`.
+    '''
+    def __init__(self, listen_addr, port, endpoints, connections=1, strategy='least-inflight',
+                 window=DEFAULT_WINDOW, max_inflight=None, logger=default_logger, metrics=None,
+                 health_interval=5.0, ack_timeout=30.0, ssl_context=None, handshake_timeout=10.0):
+        if max_inflight is None:
+            max_inflight = window * connections * len(endpoints)
+        self.logger = logger
+        self.pool = RelpClientPool(endpoints, connections, strategy, window, logger, metrics,
+                                   health_interval, ack_timeout)
+        self.server = RelpServer(listen_addr, port, self.forward, logger, metrics=metrics,
+                                 max_inflight=max_inflight, ssl_context=ssl_context,
+                                 handshake_timeout=handshake_timeout, parse_syslog=True)
+        self.socket = self.server.socket
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        '''Connect to the downstream servers, and start accepting connections in a different thread'''
+        self.pool.start()
+        self.server.start()
+
+    def stop(self):
+        '''Close the downstream sessions, waiting for the messages in flight'''
+        self.server.stop()
+        self.pool.stop()
+
+    def forward(self, message):
+        '''
+        Send a message (a `relp.syslog.SyslogMessage`) downstream. Return a `Future` resolved with its `Ack`,
+        or failed with `AckError` if it was NACKed.
+        '''
+        future = Future()
+
+        def done(sent):
+            error = sent.exception()
+            if error is None:
+                ack = sent.result()
+                if ack.code == RspCode.NACK.value:
+                    error = AckError(f"NACK received from downstream: {ack.message}")
+                else:
+                    future.set_result(ack)
+                    return
+            future.set_exception(error)
+        self.pool.syslog_async(message.raw).add_done_callback(done)
+        return future
+
+    def serve_forever(self):
+        '''Relay RELP connections forever'''
+        self.pool.start()
+        self.server.serve_forever()
@@ -1,60 +1,518 @@
 '''A RELP TCP server'''
 
 import logging
-import ssl
-import sys
+import os
+import subprocess
 
-from socketserver import TCPServer, StreamRequestHandler
-from socket import socket, AF_INET, SOCK_STREAM
+from select import select
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
+from time import monotonic
 
 from relp.protocol import *
-from relp.session import RelpSession
+from relp.session import DEFAULT_WINDOW, RateLimit, ReceiveBudget, RelpSession
+from relp.syslog import SyslogMessage
+from relp.tls import TlsSocket
 
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 default_logger = logging.getLogger('relp-server')
 
-def handle_client(clientsocket, address, handler, logger):
-    '''Handler for RELP session for server'''
+DEFAULT_BATCH_SIZE = 1024
+
+# Payload bytes received by a session and not yet given to the handler
+DEFAULT_SESSION_BYTES = 8 * 1024 * 1024
+
+# Time given to the sessions to finish the frames already received when stopping
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+# What to do with new connections when `max_sessions` sessions are running
+ADMISSION_POLICIES = ('reject', 'queue', 'grow')
+
+# Environment variable giving the listening socket to a replacement process
+LISTEN_FD_VARIABLE = 'RELP_LISTEN_FD'
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+class OrderedAcks:
+    '''
+    Acknowledge the frames of a session in the order they were received,
+    each once its processing finished (or NACK it if the processing failed).
+    At most `max_inflight` frames are processed and not acknowledged at any time:
+    `begin` blocks (and the session stops reading) while the limit is reached.
+    '''
+    def __init__(self, session, max_inflight=DEFAULT_WINDOW, logger=default_logger, metrics=None):
+        self.session = session
+        self.max_inflight = max_inflight
+        self.logger = logger
+        self.metrics = metrics
+        self.condition = Condition()
+        # [txnr, finished, error, start] of the frames not acknowledged, in order
+        self.pending = deque()
+
+    def begin(self, txnr):
+        '''Register a received frame, waiting for room. Return the entry to give to `finish`'''
+        entry = [txnr, False, None, monotonic()]
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pending) < self.max_inflight)
+            self.pending.append(entry)
+        return entry
+
+    def finish(self, entry, error=None):
+        '''Mark a frame as processed, and send the ACK of the frames processed in order'''
+        if self.metrics is not None:
+            self.metrics.observe('relp_handler_seconds', monotonic() - entry[3])
+        with self.condition:
+            entry[1] = True
+            entry[2] = error
+            acked = []
+            # Sent while holding the condition, so ACK are queued in order
+            while self.pending and self.pending[0][1]:
+                txnr, _, error, _ = self.pending.popleft()
+                if error is None:
+                    acked.append(txnr)
+                    continue
+                if acked:
+                    self.session.ack(acked)
+                    acked = []
+                self.session.ack([txnr], RspCode.NACK, str(error))
+            if acked:
+                self.session.ack(acked)
+            self.condition.notify_all()
+
+    def call(self, handler, messages, entry):
+        '''
+        Call the handler for each message of a frame, and finish the entry with the
+        result. If the handler returns futures, the entry is only finished once
+        they are all done.
+        '''
+        futures = []
+        try:
+            for message in messages:
+                result = handler(message)
+                if hasattr(result, 'add_done_callback'):
+                    futures.append(result)
+        except Exception as err:
+            self.logger.exception("Handler failed for frame %s", entry[0])
+            self.finish(entry, err)
+            return
+        if not futures:
+            self.finish(entry)
+            return
+
+        lock = Lock()
+        state = {'remaining': len(futures), 'error': None}
+
+        def done(future):
+            with lock:
+                state['error'] = state['error'] or future.exception()
+                state['remaining'] -= 1
+                if state['remaining']:
+                    return
+            self.finish(entry, state['error'])
+        for future in futures:
+            future.add_done_callback(done)
+
+    def wait(self, timeout=None):
+        '''Wait until all the registered frames are acknowledged. Return False on timeout'''
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout)
+
+class FairQueue:
+    '''The tasks of one session in a `FairExecutor`, with the interface of an `Executor`'''
+    def __init__(self, executor, weight=1):
+        self.executor = executor
+        self.weight = weight
+        self.credit = weight
+        self.tasks = deque()
+        # Tasks queued or running
+        self.pending = 0
+
+    def submit(self, function, *args):
+        '''Queue a call of `function(*args)`'''
+        self.executor._submit(self, function, args)
+
+    def shutdown(self, wait=True):
+        '''Wait for the tasks of the session to finish (with `wait`)'''
+        if wait:
+            with self.executor.condition:
+                self.executor.condition.wait_for(lambda: not self.pending)
+
+class FairExecutor:
+    '''
+    Pool of `workers` threads running the tasks of many sessions. Sessions with tasks
+    waiting are served in turn, `weight` tasks at a time (weighted round-robin), so a
+    session with many messages does not delay the messages of the others.
+    '''
+    def __init__(self, workers, logger=default_logger):
+        self.logger = logger
+        self.condition = Condition()
+        # Queues with tasks waiting, the one being served first
+        self.active = deque()
+        self.stopped = False
+        self.threads = [Thread(target=self._worker, name='relp-handler', daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def queue(self, weight=1):
+        '''Return the queue of a new session'''
+        return FairQueue(self, weight)
+
+    def _submit(self, queue, function, args):
+        with self.condition:
+            if not queue.tasks:
+                self.active.append(queue)
+            queue.tasks.append((function, args))
+            queue.pending += 1
+            self.condition.notify()
+
+    def _next(self):
+        '''Take the next task, from the session being served'''
+        queue = self.active[0]
+        task = queue.tasks.popleft()
+        queue.credit -= 1
+        if not queue.tasks:
+            self.active.popleft()
+            queue.credit = queue.weight
+        elif queue.credit <= 0:
+            queue.credit = queue.weight
+            self.active.rotate(-1)
+        return queue, task
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.active or self.stopped)
+                if self.stopped:
+                    return
+                queue, (function, args) = self._next()
+            try:
+                function(*args)
+            except Exception:
+                self.logger.exception("Handler task failed")
+            with self.condition:
+                queue.pending -= 1
+                if not queue.pending:
+                    self.condition.notify_all()
+
+    def shutdown(self):
+        '''Stop the threads once they finished their current task'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+class SessionRegistry:
+    '''The sessions running in a server, drained as soon as they start once the server is stopping'''
+    def __init__(self):
+        self.condition = Condition()
+        self.sessions = set()
+        self.draining = False
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session):
+        with self.condition:
+            self.sessions.add(session)
+            draining = self.draining
+        if draining:
+            session.drain()
+
+    def discard(self, session):
+        with self.condition:
+            self.sessions.discard(session)
+            self.condition.notify_all()
+
+    def drain(self):
+        '''Drain all the sessions, and the ones added later'''
+        with self.condition:
+            self.draining = True
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.drain()
+
+    def wait(self, timeout=None):
+        '''Wait until all the sessions finished. Return False on timeout'''
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.sessions, timeout)
+
+def frame_messages(frame, parse_syslog=False):
+    '''Return the messages of a frame, as `str` or as `SyslogMessage` with `parse_syslog`'''
+    if parse_syslog:
+        return [SyslogMessage(payload) for payload in frame.payloads()]
+    return frame.messages()
+
+def handle_client(clientsocket, address, handler, logger, metrics=None, workers=0, max_inflight=DEFAULT_WINDOW,
+                  budgets=(), overflow='block', parse_syslog=False, sessions=None, drain_timeout=None,
+                  idle_timeout=None, scheduler=None, weight=1):
+    '''
+    Handler for RELP session for server.
+    Each `syslog` frame is acknowledged once `handler` returned (or once the future it
+    returned is done), and NACKed if it raised. With `workers`, the handler calls of
+    the session run in a pool of `workers` threads, or with `scheduler` (a `FairExecutor`)
+    in a pool shared with other sessions, with the given `weight`. At most `max_inflight` frames are
+    processed at the same time, and the ACK are always sent in order.
+    `budgets` and `overflow` limit the frames waiting for the handler (see `RelpSession`).
+    With `parse_syslog`, the handler receives `SyslogMessage` objects instead of `str`.
+    The session is registered in `sessions` (a `SessionRegistry`) while it runs. Once the
+    session is closed or drained, the frames already received are still acknowledged,
+    waiting at most `drain_timeout` seconds for their handlers. The session is drained
+    when no frame was received for `idle_timeout` seconds.
+    '''
     logger.debug("Handling client connection")
     logger.info("Starting RELP session with %s", address)
-    with RelpSession(clientsocket, 'server', logger) as session:
+    if scheduler is not None:
+        executor = scheduler.queue(weight)
+    elif workers:
+        executor = ThreadPoolExecutor(workers, thread_name_prefix='relp-handler')
+    else:
+        executor = None
+    with RelpSession(clientsocket, 'server', logger, auto_ack=False, metrics=metrics,
+                     budgets=budgets, overflow=overflow) as session:
+        if sessions is not None:
+            sessions.add(session)
+        acks = OrderedAcks(session, max_inflight, logger, metrics)
+        drained = True
         try:
             while True:
                 logger.debug("Waiting for messages")
-                frame = session.recv()
-                if frame.command == 'syslog':
+                try:
+                    frame = session.recv(idle_timeout)
+                except TimeoutError:
+                    close_idle(session, address, idle_timeout, logger, metrics)
+                    continue
+                if frame is None:
+                    logger.info("RELP session closed by %s", address)
+                    drained = acks.wait(drain_timeout)
+                    if not drained:
+                        logger.warning("Handlers of %s did not finish after %ss, frames left unacknowledged",
+                                       address, drain_timeout)
+                    break
+                elif frame.command in COMMANDS:
                     logger.debug("Handling frame: %s", frame)
-                    handler(frame.message)
+                    entry = acks.begin(frame.txnr)
+                    messages = frame_messages(frame, parse_syslog)
+                    if executor is None:
+                        acks.call(handler, messages, entry)
+                    else:
+                        executor.submit(acks.call, handler, messages, entry)
                 elif frame.command == 'open':
                     logger.info("Offered received and processed")
                 elif frame.command == 'close':
                     logger.info("Received `close` from client. Stopping the server")
+                    acks.wait()
+                    session.ack([frame.txnr])
                     break
                 else:
                     raise RelpSessionError(f"Unexpected RELP command: {frame.command}")
-        except Exception as err:
-            raise err
         finally:
+            if executor is not None:
+                executor.shutdown(wait=drained)
             # Hint for client to close the RELP socket
             frame = Frame(0, 'serverclose', '')
             session.send_frame(frame)
+            if sessions is not None:
+                sessions.discard(session)
     logger.debug('Stopping client handler for %s', address)
 
+def handle_client_batch(clientsocket, address, batch_handler, logger, batch_size=DEFAULT_BATCH_SIZE, batch_timeout=0,
+                        metrics=None, budgets=(), overflow='block', parse_syslog=False, sessions=None,
+                        idle_timeout=None):
+    '''
+    Handler for RELP session for server, in batch mode.
+    `batch_handler` receives the list of messages read together (up to `batch_size`
+    frames, waiting at most `batch_timeout` seconds, a `syslogbatch` frame giving
+    all its messages). The whole batch is
+    acknowledged in one send once the handler returns, or NACKed if it raised.
+    With `parse_syslog`, the messages are `SyslogMessage` objects instead of `str`.
+    The session is registered in `sessions` (a `SessionRegistry`) while it runs, and
+    drained when no frame was received for `idle_timeout` seconds.
+    '''
+    logger.debug("Handling client connection in batch mode")
+    logger.info("Starting RELP session with %s", address)
+    with RelpSession(clientsocket, 'server', logger, auto_ack=False, metrics=metrics,
+                     budgets=budgets, overflow=overflow) as session:
+        if sessions is not None:
+            sessions.add(session)
+        try:
+            while True:
+                logger.debug("Waiting for messages")
+                try:
+                    frames = session.recv_batch(batch_size, batch_timeout, idle_timeout)
+                except TimeoutError:
+                    close_idle(session, address, idle_timeout, logger, metrics)
+                    continue
+                # Only the last frame of a batch can be something else than `syslog` or `syslogbatch`
+                last = frames.pop()
+                if last is not None and last.command in COMMANDS:
+                    frames.append(last)
+                    last = False
+
+                if frames:
+                    logger.debug("Handling batch of %i frames", len(frames))
+                    txnrs = [frame.txnr for frame in frames]
+                    start = monotonic()
+                    try:
+                        batch_handler([message for frame in frames for message in frame_messages(frame, parse_syslog)])
+                    except Exception as err:
+                        logger.exception("Batch handler failed, sending NACK for %i frames", len(txnrs))
+                        session.ack(txnrs, RspCode.NACK, str(err))
+                    else:
+                        session.ack(txnrs)
+                    if metrics is not None:
+                        metrics.observe('relp_handler_seconds', monotonic() - start)
+
+                if last is False:
+                    continue
+                elif last is None:
+                    logger.info("RELP session closed by %s", address)
+                    break
+                elif last.command == 'open':
+                    logger.info("Offered received and processed")
+                elif last.command == 'close':
+                    logger.info("Received `close` from client. Stopping the server")
+                    session.ack([last.txnr])
+                    break
+                else:
+                    raise RelpSessionError(f"Unexpected RELP command: {last.command}")
+        finally:
+            # Hint for client to close the RELP socket
+            frame = Frame(0, 'serverclose', '')
+            session.send_frame(frame)
+            if sessions is not None:
+                sessions.discard(session)
+    logger.debug('Stopping client handler for %s', address)
+
+def close_idle(session, address, idle_timeout, logger, metrics=None):
+    '''Drain a session that did not receive anything for `idle_timeout` seconds'''
+    logger.info("RELP session with %s idle for %ss, closing it", address, idle_timeout)
+    if metrics is not None:
+        metrics.inc('relp_sessions_idle_total')
+    session.drain()
+
+def inherited_socket():
+    '''
+    Return the listening socket given by the process that started this one, with
+    `RelpServer.spawn_replacement` or by systemd socket activation, None if there is none.
+    '''
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and int(os.environ.get('LISTEN_FDS', 0)) >= 1:
+        fd = SD_LISTEN_FDS_START
+    elif LISTEN_FD_VARIABLE in os.environ:
+        fd = int(os.environ[LISTEN_FD_VARIABLE])
+    else:
+        return None
+    # Not given again to the processes started by this one
+    for variable in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES', LISTEN_FD_VARIABLE):
+        os.environ.pop(variable, None)
+    return socket(fileno=fd)
+
+def listening_socket(listen_addr, port, reuse_port=False, backlog=None):
+    '''Create a TCP socket listening on `listen_addr:port`, with `backlog` pending connections at most'''
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        from socket import SO_REUSEPORT
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((listen_addr, port))
+    if backlog is None:
+        sock.listen()
+    else:
+        sock.listen(backlog)
+    return sock
+
 class RelpServer:
-    '''RELP server'''
-    def __init__(self, listen_addr, port, handler, logger=default_logger):
+    '''
+    RELP server.
+    Messages are given one by one to `handler`, or by list to `batch_handler`
+    (see `handle_client_batch`) when it is given instead.
+    `metrics` is an optional `relp.metrics.MetricsRegistry` shared by all the sessions.
+    With `handler_workers`, the handler calls of each session run in a pool of threads,
+    with at most `max_inflight` messages processed at the same time (see `handle_client`).
+    Each session holds at most `max_session_messages` frames and `max_session_bytes`
+    bytes of payload not yet given to the handler, and all the sessions together
+    at most `max_messages` and `max_bytes` (None for no limit). When a limit is
+    reached, the session stops reading its socket, or NACKs the new messages
+    with `overflow='nack'`.
+    With `ssl_context` (see `relp.tls.server_context`), clients connect with TLS. The
+    handshake is done by the thread of the session (not by the accept loop), and
+    fails after `handshake_timeout` seconds.
+    With `parse_syslog`, handlers receive `relp.syslog.SyslogMessage` objects, parsing the
+    syslog header only when its fields are accessed, instead of `str`.
+    With `reuse_port`, the socket is bound with `SO_REUSEPORT` so several processes
+    can listen on the same port. An already listening socket can be given with `sock`
+    (`listen_addr` and `port` are then ignored), like the one of `inherited_socket()`.
+    `stop` stops accepting connections and drains the sessions: they finish the frames
+    already received (for at most `drain_timeout` seconds), send `serverclose` and close.
+    Each session runs in its own thread. With `max_sessions`, new connections beyond that
+    many sessions are closed right away with `admission='reject'`, wait at most
+    `admission_timeout` seconds for a session to finish with `admission='queue'`, or are
+    served anyway (with a warning) with `admission='grow'`. Sessions that did not receive
+    anything for `idle_timeout` seconds are closed. `backlog` is the size of the queue of
+    connections not accepted yet (see `socket.listen`).
+    The messages received are limited to `session_messages_rate` messages and
+    `session_bytes_rate` bytes per second for each session, and `address_messages_rate`
+    and `address_bytes_rate` for all the sessions from the same address (token buckets,
+    with bursts of one second). Like the memory limits, sessions over their rate stop
+    reading their socket, or NACK with `overflow='nack'`.
+    With `fair_scheduling`, the `handler_workers` threads are shared by all the sessions,
+    which are served in turn, `session_weight(address)` messages at a time (1 by default).
+    '''
+    def __init__(self, listen_addr, port, handler=None, logger=default_logger,
+                 batch_handler=None, batch_size=DEFAULT_BATCH_SIZE, batch_timeout=0, metrics=None,
+                 reuse_port=False, sock=None, handler_workers=0, max_inflight=DEFAULT_WINDOW,
+                 max_session_messages=None, max_session_bytes=DEFAULT_SESSION_BYTES, max_messages=None, max_bytes=None,
+                 overflow='block', ssl_context=None, handshake_timeout=10.0, parse_syslog=False,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, max_sessions=None, admission='reject', admission_timeout=5.0,
+                 idle_timeout=None, backlog=None, session_messages_rate=None, session_bytes_rate=None,
+                 address_messages_rate=None, address_bytes_rate=None, fair_scheduling=False, session_weight=None):
+        if (handler is None) == (batch_handler is None):
+            raise ValueError("Exactly one of `handler` or `batch_handler` should be given")
+        if admission not in ADMISSION_POLICIES:
+            raise ValueError(f"Unknown admission policy `{admission}`")
+        if fair_scheduling and not handler_workers:
+            raise ValueError("`fair_scheduling` needs `handler_workers`")
         self.handler = handler
+        self.batch_handler = batch_handler
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
         self.logger = logger
+        self.metrics = metrics
+        self.handler_workers = handler_workers
+        self.max_inflight = max_inflight
+        self.max_session_messages = max_session_messages
+        self.max_session_bytes = max_session_bytes
+        self.budget = ReceiveBudget(max_messages, max_bytes) if max_messages or max_bytes else None
+        self.overflow = overflow
+        self.ssl_context = ssl_context
+        self.handshake_timeout = handshake_timeout
+        self.parse_syslog = parse_syslog
+        self.drain_timeout = drain_timeout
+        self.max_sessions = max_sessions
+        self.admission = admission
+        self.admission_timeout = admission_timeout
+        self.idle_timeout = idle_timeout
+        self.session_messages_rate = session_messages_rate
+        self.session_bytes_rate = session_bytes_rate
+        self.address_messages_rate = address_messages_rate
+        self.address_bytes_rate = address_bytes_rate
+        self.session_weight = session_weight
+        self.scheduler = FairExecutor(handler_workers, logger) if fair_scheduling else None
+        # Rate limit of each address, and the number of its sessions
+        self.address_limits = {}
 
-        self.client_threads = []
+        self.slots = BoundedSemaphore(max_sessions) if max_sessions else None
+        self.counters_lock = Lock()
+        self.queued = 0
+        self.rejected = 0
+        self.sessions = SessionRegistry()
+        self.stopping = Event()
+        # Wakes up the listener, without touching a socket that may be shared with other processes
+        self.wakeup, self.wakeup_writer = socketpair()
 
-        # Starting socket
-        self.socket = socket(AF_INET, SOCK_STREAM)
-        self.socket.bind((listen_addr, port))
-        self.socket.listen()
+        if sock is None:
+            sock = listening_socket(listen_addr, port, reuse_port, backlog)
+        self.socket = sock
 
         self.main_thread = Thread(target=self._listener)
 
@@ -62,18 +520,185 @@ class RelpServer:
         '''Start the RELP server in a different thread and return'''
         self.main_thread.start()
 
-    def stop(self):
-        '''Stop the RELP server'''
-        pass
+    def stop(self, timeout=None):
+        '''
+        Stop accepting connections and drain the sessions, waiting at most `timeout`
+        seconds (`drain_timeout` by default) for them to finish.
+        Return False if some sessions were still running.
+        '''
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        self.logger.info("Stopping RELP server, draining %i sessions", len(self.sessions))
+        self.stopping.set()
+        self.wakeup_writer.send(b'\0')
+        self.sessions.drain()
+        stopped = self.sessions.wait(timeout)
+        if self.main_thread.is_alive():
+            self.main_thread.join(max(deadline - monotonic(), 0))
+        if not stopped:
+            self.logger.warning("%i sessions still running after %ss", len(self.sessions), timeout)
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        self.socket.close()
+        self.wakeup.close()
+        self.wakeup_writer.close()
+        return stopped
+
+    def session_stats(self):
+        '''Return the number of sessions running, of connections waiting to start one, and of rejected connections'''
+        with self.counters_lock:
+            return {'active': len(self.sessions), 'queued': self.queued, 'rejected': self.rejected}
+
+    def spawn_replacement(self, args, **kwargs):
+        '''
+        Start a new process (`args` and `kwargs` are given to `subprocess.Popen`) inheriting
+        the listening socket, which it gets with `inherited_socket()`. Connections are
+        accepted by both processes until this one is stopped, so none is refused.
+        '''
+        fd = self.socket.fileno()
+        env = dict(kwargs.pop('env', os.environ))
+        for variable in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            env.pop(variable, None)
+        env[LISTEN_FD_VARIABLE] = str(fd)
+        self.logger.info("Starting replacement process, giving it the listening socket (fd %i)", fd)
+        return subprocess.Popen(args, pass_fds=(fd,), env=env, **kwargs)
+
+    def _address_limit(self, host, sessions):
+        '''Count a session from `host` (or one less with `sessions=-1`), return the rate limit of the address'''
+        with self.counters_lock:
+            limit, count = self.address_limits.get(host, (None, 0))
+            if limit is None:
+                limit = RateLimit(self.address_messages_rate, self.address_bytes_rate)
+            if count + sessions:
+                self.address_limits[host] = (limit, count + sessions)
+            else:
+                del self.address_limits[host]
+            return limit
+
+    def _budgets(self, address):
+        '''Return the receive budgets of a new session from `address`'''
+        budgets = []
+        # Rate limits first: their tokens are not given back when a later budget NACKs the frame
+        if self.session_messages_rate or self.session_bytes_rate:
+            budgets.append(RateLimit(self.session_messages_rate, self.session_bytes_rate))
+        if self.address_messages_rate or self.address_bytes_rate:
+            budgets.append(self._address_limit(address[0], 1))
+        if self.max_session_messages or self.max_session_bytes:
+            budgets.append(ReceiveBudget(self.max_session_messages, self.max_session_bytes))
+        if self.budget is not None:
+            budgets.append(self.budget)
+        return budgets
+
+    def _serve(self, clientsocket, address):
+        '''Serve the RELP session of an accepted connection'''
+        if self.ssl_context is not None:
+            clientsocket = TlsSocket(clientsocket, self.ssl_context, server_side=True, logger=self.logger)
+            try:
+                clientsocket.do_handshake(self.handshake_timeout)
+            except (OSError, ValueError) as err:
+                self.logger.warning("TLS handshake with %s failed: %s", address, err)
+                clientsocket.close()
+                return
+        budgets = self._budgets(address)
+        try:
+            if self.batch_handler:
+                handle_client_batch(
+                    clientsocket, address, self.batch_handler, self.logger,
+                    batch_size=self.batch_size,
+                    batch_timeout=self.batch_timeout,
+                    metrics=self.metrics,
+                    budgets=budgets,
+                    overflow=self.overflow,
+                    parse_syslog=self.parse_syslog,
+                    sessions=self.sessions,
+                    idle_timeout=self.idle_timeout,
+                )
+            else:
+                handle_client(
+                    clientsocket, address, self.handler, self.logger,
+                    metrics=self.metrics,
+                    workers=self.handler_workers,
+                    max_inflight=self.max_inflight,
+                    budgets=budgets,
+                    overflow=self.overflow,
+                    parse_syslog=self.parse_syslog,
+                    sessions=self.sessions,
+                    drain_timeout=self.drain_timeout,
+                    idle_timeout=self.idle_timeout,
+                    scheduler=self.scheduler,
+                    weight=self.session_weight(address) if self.session_weight else 1,
+                )
+        finally:
+            if self.address_messages_rate or self.address_bytes_rate:
+                self._address_limit(address[0], -1)
+
+    def _admit(self, clientsocket, address):
+        '''Start the session of an accepted connection, or queue or reject it when the server is full'''
+        if self.slots is None:
+            slot = False
+        elif self.slots.acquire(blocking=False):
+            slot = True
+        elif self.admission == 'reject':
+            self._reject(clientsocket, address, 'full')
+            return
+        elif self.admission == 'grow':
+            self.logger.warning("%i sessions running, serving %s anyway", len(self.sessions), address)
+            slot = False
+        else:
+            slot = None
+            with self.counters_lock:
+                self.queued += 1
+        Thread(target=self._session, args=(clientsocket, address, slot), name=f"relp-session-{address}",
+               daemon=True).start()
+
+    def _session(self, clientsocket, address, slot):
+        '''
+        Thread of a session. `slot` tells if it holds one of the `max_sessions` slots,
+        None to wait for one first.
+        '''
+        if slot is None:
+            slot = self.slots.acquire(timeout=self.admission_timeout)
+            with self.counters_lock:
+                self.queued -= 1
+            if not slot:
+                self._reject(clientsocket, address, 'timeout')
+                return
+        try:
+            self._serve(clientsocket, address)
+        except Exception:
+            self.logger.exception("RELP session with %s failed", address)
+        finally:
+            if slot:
+                self.slots.release()
+
+    def _reject(self, clientsocket, address, reason):
+        '''Close a connection without serving it. The client should connect again later'''
+        self.logger.warning("Rejecting connection from %s (%s): %i sessions running",
+                            address, reason, len(self.sessions))
+        with self.counters_lock:
+            self.rejected += 1
+        if self.metrics is not None:
+            self.metrics.inc('relp_sessions_rejected_total', label=reason)
+        try:
+            if self.ssl_context is None:
+                clientsocket.sendall(Frame(0, 'serverclose', '').encode())
+        except OSError:
+            pass
+        clientsocket.close()
 
     def _listener(self):
         self.logger.info("Starting listening for client connections")
         try:
-            with ThreadPoolExecutor() as threadpool:
-                while True:
-                    clientsocket, address = self.socket.accept()
-                    self.logger.debug("New connection from %s", address)
-                    threadpool.submit(handle_client, clientsocket, address, self.handler, self.logger)
+            while not self.stopping.is_set():
+                readable, _, _ = select([self.socket, self.wakeup], [], [])
+                if self.stopping.is_set():
+                    break
+                if self.socket not in readable:
+                    continue
+                clientsocket, address = self.socket.accept()
+                self.logger.debug("New connection from %s", address)
+                self._admit(clientsocket, address)
+            self.logger.info("Stopped listening for client connections")
         except Exception as e:
             raise e
 
@@ -1,88 +1,427 @@
 '''Manage a RELP session'''
 
 import logging
-import sys
+import random
 
-from threading import Event, Thread
-from queue import Queue
+from threading import Condition, Event, Lock, Thread, current_thread
+from collections import deque
+from queue import Empty, Queue
+from time import monotonic, sleep
 
 from relp.protocol import *
 from relp.exceptions import *
 
 from socket import SHUT_RD, SHUT_RDWR
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 default_logger = logging.getLogger('relp-session')
 
-class AckManager():
+# Default number of frames that can be sent without having received
+# their acknowledgement (same default as rsyslog's RELP window).
+DEFAULT_WINDOW = 128
+
+# Maximum number of queued frames written with a single send, and
+# size of the buffers built by `send_many`.
+MAX_COALESCED_FRAMES = 1024
+MAX_COALESCED_BYTES = 256 * 1024
+
+# Largest `syslogbatch` frames built by `send_many`
+MAX_BATCH_MESSAGES = 1024
+MAX_BATCH_BYTES = 64 * 1024
+
+# Time to wait for the ACK of `close` when stopping a client session
+DEFAULT_CLOSE_TIMEOUT = 10.0
+
+# Delays (in seconds) between reconnection attempts, doubled after each failure
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 30.0
+
+# Queued after the frames sent again on a new connection: the frames
+# queued before it were for the previous connection
+_RESYNC = object()
+
+class AckHandle:
     '''
-    Manage ACK between threads and allow to wait
-    for a specific ACK number to arrive.
+    Handle on the acknowledgement of a frame sent in a `AckWindow`.
+    Mimic the interface of `concurrent.futures.Future`.
     '''
-    default_logger = logging.getLogger('AckManager')
+    __slots__ = ('window', 'txnr', 'frame', 'ack', 'error', 'callbacks', 'finished', 'sent')
+
+    def __init__(self, window, txnr):
+        self.window = window
+        self.txnr = txnr
+        self.frame = None
+        self.ack = None
+        self.error = None
+        self.callbacks = None
+        self.finished = False
+        self.sent = None
+
+    def done(self):
+        '''Return True if the ACK arrived or the session failed'''
+        return self.finished
+
+    def result(self, timeout=None):
+        '''Wait for the `Ack` of the frame and return it'''
+        if not self.finished:
+            with self.window.condition:
+                if not self.window.condition.wait_for(self.done, timeout):
+                    raise TimeoutError(f"No ACK received for TXNR {self.txnr} after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.ack
+
+    def exception(self, timeout=None):
+        '''Wait for the frame to be acknowledged and return the failure if any'''
+        try:
+            self.result(timeout)
+        except TimeoutError:
+            raise
+        except Exception as err:
+            return err
+        return None
+
+    def add_done_callback(self, callback):
+        '''Call `callback(handle)` once the ACK arrived (or the session failed)'''
+        with self.window.condition:
+            if not self.finished:
+                if self.callbacks is None:
+                    self.callbacks = []
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def _run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, None
+        for callback in callbacks or ():
+            try:
+                callback(self)
+            except Exception:
+                self.window.logger.exception("Error in ACK callback for TXNR %s", self.txnr)
 
-    def __init__(self, logger=default_logger):
-        self.events = {}
-        self.values = {}
-        self.logger = logger
-        self.logger.debug("Created AckManager object")
+class AckWindow:
+    '''
+    Bounded window of frames waiting for their ACK.
 
-    def prepare(self, key):
+    Frames get consecutive TXNR and are stored in a ring buffer of `size` slots,
+    indexed by their offset from the oldest frame still waiting. Reserving a slot
+    blocks while the window is full, so the memory used does not depend on
+    the age of the session. A single condition guards the window and is used
+    for all the waits.
+    '''
+    default_logger = logging.getLogger('AckWindow')
+
+    def __init__(self, size=DEFAULT_WINDOW, logger=default_logger, metrics=None):
+        self.size = size
+        self.logger = logger
+        self.metrics = metrics
+        self.slots = [None] * size
+        self.condition = Condition()
+        # Sequence numbers of the oldest frame waiting and of the next frame
+        self.base = 0
+        self.next = 0
+        # TXNR of the frame of sequence number 0
+        self.origin = 1
+        self.count = 0
+        self.error = None
+
+    def _txnr(self, seq):
+        return (self.origin + seq - 1) % MAX_TXNR + 1
+
+    def _reserve(self):
+        handle = AckHandle(self, self._txnr(self.next))
+        self.slots[self.next % self.size] = handle
+        self.next += 1
+        self.count += 1
+        return handle
+
+    def reserve(self, timeout=None):
         '''
-        Prepare a future get
+        Reserve the next TXNR, waiting for a free slot if the window is full.
+        Return the `AckHandle` that will be resolved with the ACK.
         '''
-        if key in self.events:
-            raise Exception(f"Another process is already waiting for ACK {key}")
-        event = Event()
-        self.events[key] = event
-        return event
-
-    def get(self, key, timeout=None):
+        with self.condition:
+            self.wait_available(timeout)
+            if self.error:
+                raise self.error
+            return self._reserve()
+
+    def try_reserve(self):
+        '''Reserve the next TXNR, or return None if the window is full'''
+        with self.condition:
+            if self.error:
+                raise self.error
+            if self.next - self.base >= self.size:
+                return None
+            return self._reserve()
+
+    def put(self, txnr, ack):
         '''
-        Wait for an ACK to be received.
+        Resolve the handle of `txnr` with its ACK.
+        Return False if no frame is waiting for this TXNR.
         '''
-        event = self.events.get(key) or self.prepare(key)
-        self.logger.debug("[get/%s] Waiting for event to be triggered", key)
-        event.wait(timeout)
-        value = self.values.pop(key)
-        return value
-
-    def put(self, key, value):
+        with self.condition:
+            offset = (txnr - self._txnr(self.base)) % MAX_TXNR
+            handle = None
+            if offset < self.next - self.base:
+                index = (self.base + offset) % self.size
+                handle = self.slots[index]
+            if handle is None:
+                self.logger.warning("Received ACK for unknown TXNR %s", txnr)
+                return False
+            self.slots[index] = None
+            self.count -= 1
+            while self.base < self.next and self.slots[self.base % self.size] is None:
+                self.base += 1
+            handle.ack = ack
+            handle.frame = None
+            handle.finished = True
+            self.condition.notify_all()
+        if handle.sent is not None:
+            self.metrics.observe('relp_ack_seconds', monotonic() - handle.sent)
+        if handle.callbacks:
+            handle._run_callbacks()
+        return True
+
+    def fail(self, error):
+        '''Fail every frame waiting for an ACK, and the future reservations'''
+        with self.condition:
+            self.error = error
+            handles = [handle for handle in self.slots if handle is not None]
+            self.slots = [None] * self.size
+            self.base = self.next
+            self.count = 0
+            for handle in handles:
+                self.logger.debug("[fail/%s] Failing handle: %s", handle.txnr, error)
+                handle.error = error
+                handle.frame = None
+                handle.finished = True
+            self.condition.notify_all()
+        for handle in handles:
+            if handle.callbacks:
+                handle._run_callbacks()
+
+    def wait_available(self, timeout=None):
+        '''Wait until a slot of the window is free (or the window failed)'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.error or self.next - self.base < self.size, timeout):
+                raise TimeoutError(f"RELP window still full after {timeout}s")
+
+    def wait_many(self, handles, timeout=None):
+        '''Wait for all the given handles to be resolved, and return their `Ack`'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: all(handle.finished for handle in handles), timeout):
+                raise TimeoutError(f"Not all ACK were received after {timeout}s")
+        return [handle.result() for handle in handles]
+
+    def pending(self):
+        '''Return the handles waiting for an ACK, ordered by TXNR'''
+        with self.condition:
+            return [
+                self.slots[seq % self.size]
+                for seq in range(self.base, self.next)
+                if self.slots[seq % self.size] is not None
+            ]
+
+    def renumber(self, txnr, commands=None):
         '''
-        Insert a new key in the ACK manager.
+        Give new consecutive TXNR, starting at `txnr`, to the frames waiting
+        for an ACK (to send them again on a new connection).
+        With `commands`, the frames of other commands are failed instead.
+        Return the handles of the frames to send, in order.
         '''
-        self.values[key] = value
-        self.logger.debug("[put/%s] Put value %s", key, value)
-        event = self.events.get(key)
-        if not event:
-            self.logger.error("Could not find event for key %s, (%s)", key, type(key))
-            raise Exception(f"Could not find event for key {key}")
-
-        self.logger.debug("[put/%s] Triggering event", key)
-        event.set()
-        self.logger.debug("[put/%s] Set the event to trigger `get`", key)
-
-    def size(self):
-        '''Return the number of ACK that are expected'''
-        return len(self.events)
+        with self.condition:
+            handles = [
+                self.slots[seq % self.size]
+                for seq in range(self.base, self.next)
+                if self.slots[seq % self.size] is not None
+            ]
+            if commands is not None:
+                failed = [handle for handle in handles if handle.frame.command not in commands]
+                handles = [handle for handle in handles if handle.frame.command in commands]
+                for handle in failed:
+                    handle.error = RelpSessionError(f"Command `{handle.frame.command}` not supported by the server")
+                    handle.frame = None
+                    handle.finished = True
+                    self.count -= 1
+                self.condition.notify_all()
+            else:
+                failed = []
+            self.slots = [None] * self.size
+            self.origin = txnr
+            self.base = 0
+            self.next = 0
+            for handle in handles:
+                handle.txnr = self._txnr(self.next)
+                handle.frame.txnr = handle.txnr
+                self.slots[self.next] = handle
+                self.next += 1
+        for handle in failed:
+            if handle.callbacks:
+                handle._run_callbacks()
+        return handles
+
+    def inflight(self):
+        '''Return the number of frames waiting for an ACK'''
+        return self.count
+
+class ReceiveBudget:
+    '''
+    Limit on the frames received and not yet taken by the handler:
+    at most `max_messages` frames and `max_bytes` bytes of payload (None for no limit).
+    A budget can be shared by all the sessions of a server.
+    A single frame larger than `max_bytes` is accepted when nothing else is held.
+    '''
+    def __init__(self, max_messages=None, max_bytes=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.bytes = 0
+        self.condition = Condition()
+
+    def _fits(self, size):
+        if self.max_messages is not None and self.messages >= self.max_messages:
+            return False
+        if self.max_bytes is not None and self.bytes and self.bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def acquire(self, size, timeout=None):
+        '''Hold a frame of `size` bytes, waiting at most `timeout` seconds. Return False on timeout'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._fits(size), timeout):
+                return False
+            self.messages += 1
+            self.bytes += size
+            return True
+
+    def release(self, size):
+        '''Release a frame of `size` bytes'''
+        with self.condition:
+            self.messages -= 1
+            self.bytes -= size
+            self.condition.notify_all()
+
+class RateLimit:
+    '''
+    Token buckets limiting the messages received to `messages_rate` messages and
+    `bytes_rate` bytes of payload per second (None for no limit), with bursts of
+    `burst` seconds of traffic. Can be given in the budgets of a session like a
+    `ReceiveBudget`: tokens are taken when a frame is received (one per message of
+    a `syslogbatch` frame), and never given back. A frame larger than the burst is
+    accepted once the buckets are full.
+    '''
+    def __init__(self, messages_rate=None, bytes_rate=None, burst=1.0):
+        self.messages_rate = messages_rate
+        self.bytes_rate = bytes_rate
+        self.messages_capacity = messages_rate * burst if messages_rate else None
+        self.bytes_capacity = bytes_rate * burst if bytes_rate else None
+        self.messages = self.messages_capacity
+        self.bytes = self.bytes_capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.messages_rate:
+            self.messages = min(self.messages_capacity, self.messages + elapsed * self.messages_rate)
+        if self.bytes_rate:
+            self.bytes = min(self.bytes_capacity, self.bytes + elapsed * self.bytes_rate)
+
+    def _delay(self, size, count):
+        '''Return the time to wait before a frame of `count` messages and `size` bytes can be taken'''
+        delay = 0
+        if self.messages_rate:
+            needed = min(count, self.messages_capacity)
+            if self.messages < needed:
+                delay = (needed - self.messages) / self.messages_rate
+        if self.bytes_rate:
+            needed = min(size, self.bytes_capacity)
+            if self.bytes < needed:
+                delay = max(delay, (needed - self.bytes) / self.bytes_rate)
+        return delay
+
+    def acquire(self, size, timeout=None, count=1):
+        '''
+        Take the tokens of a frame of `count` messages and `size` bytes,
+        waiting at most `timeout` seconds. Return False on timeout
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                delay = self._delay(size, count)
+                if delay <= 0:
+                    if self.messages_rate:
+                        self.messages -= count
+                    if self.bytes_rate:
+                        self.bytes -= size
+                    return True
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            sleep(delay)
+
+    def release(self, size):
+        '''Tokens are not given back: they refill with time'''
 
 class RelpSession:
     '''
-    A RELP session object that uses a socket to communicate with a client.
+    A RELP session object that uses a socket (or a `relp.tls.TlsSocket`) to communicate with a client.
     Expose `send` and `recv` methods for communications, while the acknowledgments
     and session setup are handled by this class.
+
+    `window` is the maximum number of frames sent and not yet acknowledged.
+    With `auto_ack` disabled, received `syslog` and `close` frames are not
+    acknowledged on reception: the owner of the session has to call `ack`.
+    `metrics` is an optional `relp.metrics.MetricsRegistry` to instrument the session.
+
+    Received frames are held in memory until taken by `recv`, within the limits of
+    the `ReceiveBudget` objects in `budgets` (for instance one for the session and
+    one shared by the whole server), and of the `RateLimit` objects limiting the
+    ingest rate. When a budget is exhausted, the session stops
+    reading the socket (`overflow='block'`, so TCP slows the peer down), or
+    immediately NACKs the `syslog` frames that do not fit (`overflow='nack'`).
+
+    In client mode, `reconnect` is a function returning a new connected socket.
+    When the connection is lost, it is called again with an exponential backoff
+    (up to `max_reconnect_delay` seconds), a new offer is done and all the frames
+    waiting for their ACK are sent again, in order. Senders waiting for the window
+    just wait longer.
     '''
-    def __init__(self, socket, mode, logger=default_logger):
+    def __init__(self, socket, mode, logger=default_logger, window=DEFAULT_WINDOW, auto_ack=True, metrics=None,
+                 reconnect=None, max_reconnect_delay=MAX_RECONNECT_DELAY, close_timeout=DEFAULT_CLOSE_TIMEOUT,
+                 budgets=(), overflow='block'):
+        if overflow not in ('block', 'nack'):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
         self.socket = socket
+        self.budgets = tuple(budgets)
+        self.overflow = overflow
+        self.reconnect = reconnect
+        self.max_reconnect_delay = max_reconnect_delay
+        self.close_timeout = close_timeout
+        self.stopping = Event()
+        self.write_lock = Lock()
+        self.resyncing = False
+        self.reconnecting = False
+        # Commands supported by both peers, known after the offer
+        self.peer_commands = ['syslog']
+        self.auto_ack = auto_ack
+        self.metrics = metrics
         self.logger = logger
         self.mode = mode
-        self.txnr = 1
         self.running = False
+        self.stopped = False
         self.send_queue = Queue()
         self.recv_queue = Queue()
-        self.ackmanager = AckManager()
+        self.window = AckWindow(window, logger, metrics)
+        self.send_lock = Lock()
         self.send_thread = Thread(target=self._sender, daemon=True)
         self.recv_thread = Thread(target=self._receiver, daemon=True)
+        if metrics is not None:
+            metrics.track(self)
 
     def __enter__(self):
         self.start()
@@ -100,144 +439,495 @@ class RelpSession:
         self.send_thread.start()
         self.recv_thread.start()
 
-    def stop(self):
-        '''Stop the session'''
+    def stop(self, timeout=None):
+        '''
+        Stop the session. In client mode, wait at most `timeout` seconds
+        (`close_timeout` by default) for the ACK of the `close` command.
+        '''
+        if self.stopped:
+            return
+        self.stopped = True
         self.logger.info("Stopping RELP session")
 
-        if self.mode == 'server':
-            self.send('close')
-        elif self.mode == 'client':
-            serverclose = Frame(0, 'serverclose', '')
-            self.send_frame(serverclose)
+        if self.mode == 'client' and self.running and not self.reconnecting:
+            try:
+                self.send('close', timeout=self.close_timeout if timeout is None else timeout)
+            except (RelpSessionError, AckError, TimeoutError) as err:
+                self.logger.warning("Could not close RELP session cleanly: %s", err)
+        self.stopping.set()
 
         self.running = False
+        self.logger.debug("Waiting for sender to stop")
+        self.send_queue.put(None)
+        if current_thread() is not self.send_thread:
+            self.send_thread.join()
+
         self.logger.debug("Shutting down the socket")
-        self.socket.shutdown(SHUT_RDWR)
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
 
         self.logger.debug("Waiting for receiver to stop")
-        self.recv_thread.join()
-        self.logger.debug("Waiting for sender to stop")
-        self.send_queue.put(None)
-        self.send_thread.join()
+        if current_thread() is not self.recv_thread:
+            self.recv_thread.join()
 
         self.logger.debug("Closing the socket")
         self.socket.close()
 
-    def offer(self):
+        if self.budgets:
+            # Give back the budget of the frames never taken by the handler
+            while True:
+                try:
+                    self._release(self.recv_queue.get_nowait())
+                except Empty:
+                    break
+            self.recv_queue.put(None)
+
+    def drain(self):
+        '''
+        Stop reading the socket. `recv` still returns the frames already received,
+        then None, and their ACK can still be sent.
+        '''
+        self.logger.info("Draining RELP session")
+        try:
+            self.socket.shutdown(SHUT_RD)
+        except OSError:
+            pass
+
+    def offer(self, timeout=None):
         '''Do the RELP offer at the start and parse the response'''
         self.logger.info("Executing RELP OFFER")
         offer = Offer()
         self.logger.debug("Offer sent: %s", offer)
-        frame = offer.to_frame(self.txnr)
         try:
             self.logger.debug("Sending offer, waiting for reply...")
-            self.send('open', frame.message)
+            ack = self.send('open', offer.message(), timeout)
         except Exception as err:
-            raise Exception(f"Error during RELP offer: {err}")
-        self.logger.debug("Received offer reply. Offer successful")
+            raise RelpSessionError(f"Error during RELP offer: {err}")
+        self.peer_commands = Offer.parse(ack.message).negotiate()
+        self.logger.debug("Received offer reply. Offer successful, commands: %s", self.peer_commands)
 
     def _handle_frame(self, frame):
         self.logger.debug("Received frame: %s", frame)
+        if self.metrics is not None:
+            self.metrics.inc('relp_frames_received_total', label=frame.command)
+            self.metrics.inc('relp_bytes_received_total', len(frame.payload), label=frame.command)
 
         # ACK and NACK
         if frame.command == 'rsp':
             ack = Ack.from_frame(frame)
-            self.ackmanager.put(ack.txnr, ack)
+            if ack.code == RspCode.NACK.value and self.metrics is not None:
+                self.metrics.inc('relp_nacks_total', label='received')
+            self.window.put(ack.txnr, ack)
 
         # Supported commands
         elif frame.command in ['close'] + COMMANDS:
-            self._ack(frame.txnr)
+            if self.budgets and not self._hold(frame):
+                return
+            if self.auto_ack:
+                self._ack(frame.txnr)
             self.recv_queue.put(frame)
 
         elif frame.command == 'open':
-            self._ack_offer(frame.txnr)
+            self._ack_offer(frame)
             self.recv_queue.put(frame)
 
-        elif frame.command == 'close':
-            if self.mode == 'server':
-                self._ack(frame.txnr)
-                self.stop()
-            else:
-                raise NotImplementedError(f"Received `close` command while running session in {self.mode} mode")
-
         elif frame.command == 'serverclose':
-            if self.mode == 'client':
-                self.stop()
+            if self.mode == 'client' and self._can_reconnect():
+                self.logger.info("Received `serverclose` from server, will reconnect")
+                try:
+                    self.socket.shutdown(SHUT_RDWR)
+                except OSError:
+                    # Already closed by the server
+                    pass
+            elif self.mode == 'client':
+                self.logger.info("Received `serverclose` from server")
+                self._disconnect(RelpSessionError("Server closed the RELP session"))
             else:
-                raise NotImplementedError(f"Received `serverclose` command while running session in {self.mode} mode")
+                raise RelpProtocolError(f"Received `serverclose` command while running session in {self.mode} mode")
 
         else:
-            raise RelpProtocolError(f"Unsupported command received: `{frame.command}`")
+            self.logger.warning("Unsupported command received: `%s`, sending NACK", frame.command)
+            self.ack([frame.txnr], RspCode.NACK, 'unsupported command')
+
+    def _hold(self, frame):
+        '''
+        Take the frame from the budgets before queuing it. Return False
+        if the frame was NACKed or the session stopped in the meantime.
+        '''
+        size = len(frame.payload)
+        count = count_messages(frame.payload) if frame.command == BATCH_COMMAND else 1
+        held = []
+        for budget in self.budgets:
+            # Rate limits count the messages of batches, the other budgets hold frames
+            args = (size, 0, count) if isinstance(budget, RateLimit) else (size, 0)
+            if not budget.acquire(*args):
+                if self.overflow == 'nack' and frame.command != 'close':
+                    for other in held:
+                        other.release(size)
+                    self.logger.warning("Receive budget exhausted, sending NACK for frame %s", frame.txnr)
+                    if self.metrics is not None:
+                        self.metrics.inc('relp_overflow_total', label='nacked')
+                    self.ack([frame.txnr], RspCode.NACK, 'server busy')
+                    return False
+                self.logger.debug("Receive budget exhausted, waiting before reading more")
+                if self.metrics is not None:
+                    self.metrics.inc('relp_overflow_total', label='blocked')
+                while not budget.acquire(size, 0.1, *args[2:]):
+                    if not self.running:
+                        for other in held:
+                            other.release(size)
+                        return False
+            held.append(budget)
+        return True
+
+    def _release(self, frame):
+        if self.budgets and frame is not None and frame.command in ['close'] + COMMANDS:
+            size = len(frame.payload)
+            for budget in self.budgets:
+                budget.release(size)
+
+    def _disconnect(self, error):
+        '''Mark the session as finished and release everyone waiting on it'''
+        self.running = False
+        self.window.fail(error)
+        self.recv_queue.put(None)
 
     def _receiver(self):
         self.logger.info("Starting receiver thread")
-        frame_buffer = ''
+        parser = FrameParser()
         while self.running:
-            data = self.socket.recv(4096)
-            self.logger.debug("Received data: %s", data)
-            frame_buffer += data.decode()
-            if data == '':
-                self.logger.warning("Client disconnect")
-                self.stop()
+            try:
+                size = parser.read_from(self.socket)
+            except OSError as err:
+                self.logger.debug("Socket closed: %s", err)
+                size = 0
+            self.logger.debug("Received %i bytes", size)
+            if not size:
+                self.logger.info("Peer disconnected")
+                if self._can_reconnect() and self._reconnect():
+                    parser = FrameParser()
+                    continue
                 break
 
             try:
-                frames , frame_buffer = Frame.decode_batch(frame_buffer)
-            except Exception as e:
-                self.logger.warning("Error unpacking message: %s. Will ignore", e)
-                continue
-            for frame in frames:
-                self._handle_frame(frame)
+                frames = parser.frames()
+            except RelpProtocolError as err:
+                self.logger.error("Error unpacking message: %s. Closing the session", err)
+                break
+            try:
+                for frame in frames:
+                    self._handle_frame(frame)
+            except Exception as err:
+                # Malformed `rsp`, unexpected command...: the session cannot go on
+                self.logger.error("Error handling frame: %s. Closing the session", err)
+                break
+        self._disconnect(RelpSessionError("RELP session is closed"))
         self.logger.info("Stopping receiver thread")
 
+    def _can_reconnect(self):
+        return self.mode == 'client' and self.reconnect is not None and not self.stopped
+
+    def _reconnect(self):
+        '''
+        Open a new connection, do the offer and send again the frames waiting for an ACK.
+        Return False if the session was stopped in the meantime.
+        '''
+        delay = RECONNECT_DELAY
+        self.reconnecting = True
+        while not self.stopping.is_set():
+            try:
+                sock = self.reconnect()
+                self._reopen(sock)
+                self.reconnecting = False
+                return True
+            except (OSError, RelpError) as err:
+                # Jitter avoids all the clients of a server reconnecting at the same time
+                wait = delay * random.uniform(0.5, 1.0)
+                self.logger.warning("Could not reconnect: %s. Retrying in %.1fs", err, wait)
+                self.stopping.wait(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        return False
+
+    def _reopen(self, sock):
+        '''Do the offer on a new socket, then use it to send again the frames waiting for an ACK'''
+        try:
+            with self.send_lock:
+                sock.sendall(Frame(1, 'open', Offer().message()).encode())
+                parser = FrameParser()
+                frames = []
+                while not frames:
+                    if not parser.read_from(sock):
+                        raise RelpSessionError("Connection closed during the offer")
+                    frames = parser.frames()
+                if frames[0].command != 'rsp' or frames[0].txnr != 1 or Ack.from_frame(frames[0]).code != RspCode.ACK.value:
+                    raise RelpSessionError(f"Offer refused: {frames[0]}")
+                sock.settimeout(None)
+
+                # The new server may not support the same commands
+                self.peer_commands = Offer.parse(Ack.from_frame(frames[0]).message).negotiate()
+                handles = self.window.renumber(2, ['open', 'close'] + self.peer_commands)
+                self.logger.info("Reconnected, sending again %i frames", len(handles))
+                with self.write_lock:
+                    if handles:
+                        writer = FrameWriter()
+                        for handle in handles:
+                            writer.frame(handle.frame)
+                        sock.sendall(writer.buffer)
+                    previous, self.socket = self.socket, sock
+                    self.resyncing = True
+                    self.send_queue.put(_RESYNC)
+        except BaseException:
+            sock.close()
+            raise
+        previous.close()
+
     def _sender(self):
         self.logger.info("Starting sender thread")
-        while self.running:
+        writer = FrameWriter()
+        running = True
+        while running:
             frame = self.send_queue.get()
             if frame is None:
                 break
-            self._send_frame(frame)
+            # Coalesce everything already queued in one write
+            frames = [frame]
+            while len(frames) < MAX_COALESCED_FRAMES:
+                try:
+                    frame = self.send_queue.get_nowait()
+                except Empty:
+                    break
+                if frame is None:
+                    running = False
+                    break
+                frames.append(frame)
+            try:
+                with self.write_lock:
+                    if self.resyncing:
+                        frames = self._resync(frames)
+                    if frames:
+                        self._send_frames(frames, writer)
+            except OSError as err:
+                self.logger.warning("Could not send %i frames: %s", len(frames), err)
         self.logger.info("Stopping sender thread")
 
+    def _resync(self, frames):
+        '''Drop the frames queued for the previous connection (they were sent again)'''
+        for index, frame in enumerate(frames):
+            if frame is _RESYNC:
+                self.resyncing = False
+                return frames[index + 1:]
+        return []
+
     def _ack(self, txnr):
         self.logger.debug("Sending ACK for: %s", txnr)
-        ack = Ack(txnr)
-        self._send_frame(ack.to_frame())
-
-    def _ack_offer(self, txnr):
-        offer = Offer()
-        ack = Ack(txnr, message=offer.message())
-        self._send_frame(ack.to_frame())
-
-    def _send_frame(self, frame):
-        self.logger.debug("Sending frame: %s", frame)
-        data = frame.encode().encode('utf-8')
-        self.socket.send(data)
+        # The sender encodes an int as the ACK of this TXNR
+        if self.metrics is not None:
+            self.metrics.inc('relp_frames_sent_total', label='rsp')
+        self.send_queue.put(txnr)
+
+    def _ack_offer(self, frame):
+        '''Reply to an offer with the commands supported by both peers'''
+        if self.metrics is not None:
+            self.metrics.inc('relp_frames_sent_total', label='rsp')
+        self.peer_commands = Offer.from_frame(frame).negotiate()
+        if self.peer_commands == COMMANDS:
+            self.send_queue.put(b'%d' % frame.txnr + OFFER_REPLY_TAIL)
+        else:
+            self.send_queue.put(Ack(frame.txnr, message=Offer(commands=self.peer_commands).message()).to_frame())
+
+    def _send_frames(self, frames, writer):
+        '''Encode queued frames, ACK (TXNR) and encoded frames, and write them at once'''
+        self.logger.debug("Sending frames: %s", frames)
+        for frame in frames:
+            if isinstance(frame, int):
+                writer.ack(frame)
+            elif isinstance(frame, Frame):
+                writer.frame(frame)
+            else:
+                writer.data(frame)
+        try:
+            self.socket.sendall(writer.buffer)
+            if self.metrics is not None:
+                self.metrics.inc('relp_bytes_sent_total', len(writer))
+        finally:
+            writer.clear()
 
-    def send(self, command, message=''):
+    def ack(self, txnrs, code=RspCode.ACK, message='OK'):
+        '''
+        Acknowledge (or NACK with `RspCode.NACK`) received frames.
+        All the `rsp` frames are written with a single send.
+        '''
+        self.logger.debug("Sending %s for: %s", code.name, txnrs)
+        writer = FrameWriter()
+        for txnr in txnrs:
+            writer.rsp(txnr, code, message)
+        self.send_queue.put(writer.buffer)
+        if self.metrics is not None:
+            self.metrics.inc('relp_frames_sent_total', len(txnrs), label='rsp')
+            if code == RspCode.NACK:
+                self.metrics.inc('relp_nacks_total', len(txnrs), label='sent')
+
+    def send_async(self, command, message='', timeout=None):
+        '''
+        Send a RELP message without waiting for the ack.
+        Return an `AckHandle` resolved with the `Ack` (or failing if the session
+        is closed before the ack arrives). Block only when the window is full.
+        '''
+        handle = None
+        while handle is None:
+            if not self.running:
+                raise RelpSessionError("Cannot send message on a closed RELP session")
+            self.window.wait_available(timeout)
+            with self.send_lock:
+                handle = self.window.try_reserve()
+                if handle is None:
+                    continue
+                frame = Frame(handle.txnr, command, message)
+                handle.frame = frame
+                if self.metrics is not None:
+                    handle.sent = monotonic()
+                self.logger.debug("Sending frame to send queue: %s", frame)
+                self.send_frame(frame)
+        return handle
+
+    def send_many(self, command, messages, timeout=None):
+        '''
+        Send every message of an iterable, and wait for all the acks.
+        Frames are encoded in large buffers written at once, and at most
+        `window` messages wait for their ack at any time.
+        Return the number of messages sent, raise `AckError` with the index
+        of the refused messages (in the iterable) in `nacked` if some were NACKed.
+        When the peer supports it, `syslog` messages are sent in `syslogbatch`
+        frames: one frame and one ACK for many messages.
+        '''
+        if command == 'syslog' and BATCH_COMMAND in self.peer_commands:
+            command = BATCH_COMMAND
+            payloads = self._batches(messages)
+        else:
+            payloads = ((message, 1) for message in messages)
+        # Handles, with the index of their first message and their number of messages
+        handles = deque()
+        nacked = []
+        count = 0
+
+        def collect(block):
+            while handles and (block or handles[0][0].done()):
+                handle, first, size = handles.popleft()
+                if handle.result(timeout).code == RspCode.NACK.value:
+                    nacked.extend(range(first, first + size))
+
+        end = object()
+        writer = FrameWriter()
+        buffered = 0
+        payload = next(payloads, end)
+        while payload is not end:
+            if not self.running:
+                raise RelpSessionError("Cannot send message on a closed RELP session")
+            with self.send_lock:
+                while payload is not end and len(writer) < MAX_COALESCED_BYTES:
+                    handle = self.window.try_reserve()
+                    if handle is None:
+                        break
+                    frame = Frame(handle.txnr, command, payload[0])
+                    handle.frame = frame
+                    if self.metrics is not None:
+                        handle.sent = monotonic()
+                    handles.append((handle, count, payload[1]))
+                    writer.frame(frame)
+                    buffered += 1
+                    count += payload[1]
+                    payload = next(payloads, end)
+                if buffered:
+                    if self.metrics is not None:
+                        self.metrics.inc('relp_frames_sent_total', buffered, label=command)
+                    # The buffer now belongs to the sender thread
+                    self.send_queue.put(writer.buffer)
+                    writer = FrameWriter()
+                    buffered = 0
+            collect(block=False)
+            if payload is not end:
+                # Window is full, wait for an ack to free a slot
+                self.window.wait_available(timeout)
+        collect(block=True)
+
+        if nacked:
+            raise AckError(f"{len(nacked)} messages out of {count} were NACKed", nacked)
+        return count
+
+    @staticmethod
+    def _batches(messages):
+        '''Pack messages in `syslogbatch` payloads, yielded with their number of messages'''
+        batch = bytearray()
+        count = 0
+        for message in messages:
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            batch += b'%d ' % len(message)
+            batch += message
+            count += 1
+            if count >= MAX_BATCH_MESSAGES or len(batch) >= MAX_BATCH_BYTES:
+                yield batch, count
+                batch = bytearray()
+                count = 0
+        if count:
+            yield batch, count
+
+    def send(self, command, message='', timeout=None):
         '''Send a RELP message and wait for the ack'''
-        txnr = self.txnr
-        frame = Frame(txnr, command, message)
-
-        self.ackmanager.prepare(txnr)
-
-        self.logger.debug("Sending frame to send queue: %s", frame)
-        self.send_frame(frame)
-        self.txnr += 1
-
-        self.logger.debug("Waiting for ACK for TXNR=%i", txnr)
-        ack = self.ackmanager.get(txnr)
-        self.logger.debug("Received ACK TXNR = %i", txnr)
-        if ack.code == 200:
-            pass
-        elif ack.code == 500:
-            raise Exception(f"NACK received: {ack.message}")
+        handle = self.send_async(command, message, timeout)
+        ack = handle.result(timeout)
+        self.logger.debug("Received ACK TXNR = %i", ack.txnr)
+        if ack.code == RspCode.NACK.value:
+            raise AckError(f"NACK received: {ack.message}")
+        return ack
 
     def send_frame(self, frame):
         '''Send an exact RELP frame'''
+        if self.metrics is not None:
+            self.metrics.inc('relp_frames_sent_total', label=frame.command)
         self.send_queue.put(frame)
 
-    def recv(self):
-        '''Receive a message in RELP'''
-        frame = self.recv_queue.get()
+    def _get(self, timeout):
+        try:
+            return self.recv_queue.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError(f"No frame received for {timeout}s")
+
+    def recv(self, timeout=None):
+        '''
+        Receive a message in RELP.
+        Return `None` when the session is closed, raise `TimeoutError`
+        if no frame was received for `timeout` seconds.
+        '''
+        frame = self._get(timeout)
+        self._release(frame)
         return frame
+
+    def recv_batch(self, max_messages, timeout=0, idle_timeout=None):
+        '''
+        Receive up to `max_messages` frames. Block for the first frame (at most
+        `idle_timeout` seconds, then raise `TimeoutError`), then take every frame
+        already received, waiting at most `timeout` seconds for more. The batch ends
+        early after a frame that is not a `syslog` (or `syslogbatch`) frame,
+        or `None` when the session is closed.
+        '''
+        frame = self._get(idle_timeout)
+        self._release(frame)
+        frames = [frame]
+        deadline = monotonic() + timeout
+        while frame is not None and frame.command in COMMANDS and len(frames) < max_messages:
+            try:
+                frame = self.recv_queue.get_nowait()
+            except Empty:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    frame = self.recv_queue.get(timeout=remaining)
+                except Empty:
+                    break
+            self._release(frame)
+            frames.append(frame)
+        return frames
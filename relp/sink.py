@@ -0,0 +1,228 @@
+'''Group-commit file sink, to use as the handler of a RelpServer'''
+
+import bz2
+import gzip
+import logging
+import lzma
+import os
+import shutil
+
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import monotonic, strftime
+
+from relp.exceptions import *
+from relp.syslog import SyslogMessage
+
+default_logger = logging.getLogger('relp-sink')
+
+# Largest group of messages written and synced at once
+DEFAULT_GROUP_MESSAGES = 16384
+DEFAULT_GROUP_BYTES = 8 * 1024 * 1024
+
+# Compression of the rotated files: (open function, suffix)
+COMPRESSORS = {
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+}
+
+class FileSink:
+    '''
+    Append the messages of all the sessions of a server to the file `path`, one per line.
+
+    Calling the sink with a message returns a `Future` resolved once the message is
+    written and synced to disk, so `RelpServer` only acknowledges durable messages.
+    A writer thread takes all the messages waiting (at most `max_group_messages`
+    messages and `max_group_bytes` bytes), writes them in one write and calls `fsync`
+    once, then resolves their futures together. The messages arriving meanwhile form
+    the next group. With `commit_delay`, the writer waits at most that many seconds
+    for a group to fill up. If the write fails, the messages of the group are NACKed.
+
+    The file is rotated once it reaches `max_file_bytes` bytes or was opened
+    `max_file_age` seconds ago (checked before each write): it is renamed with
+    a timestamp suffix, and compressed in the background with `compress`
+    (`gzip`, `bz2` or `xz`). The directory is synced after a file is created or
+    renamed. If the new file cannot be opened, the current one is kept and the
+    rotation is tried again before the next write.
+    '''
+    def __init__(self, path, max_group_messages=DEFAULT_GROUP_MESSAGES, max_group_bytes=DEFAULT_GROUP_BYTES,
+                 commit_delay=0, max_file_bytes=None, max_file_age=None, compress=None,
+                 logger=default_logger, metrics=None):
+        if compress is not None and compress not in COMPRESSORS:
+            raise ValueError(f"Unknown compression `{compress}`")
+        self.path = path
+        self.max_group_messages = max_group_messages
+        self.max_group_bytes = max_group_bytes
+        self.commit_delay = commit_delay
+        self.max_file_bytes = max_file_bytes
+        self.max_file_age = max_file_age
+        self.compress = compress
+        self.logger = logger
+        self.metrics = metrics
+
+        self.condition = Condition()
+        # Encoded messages and their futures, waiting for the writer
+        self.pending = []
+        self.futures = []
+        self.pending_bytes = 0
+        self.closed = False
+        self.compressors = []
+
+        self._open()
+        self.writer = Thread(target=self._run, name='relp-sink', daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __call__(self, message):
+        '''Queue a message, return a `Future` resolved once it is on disk'''
+        return self._append([message])[0]
+
+    def write_many(self, messages):
+        '''
+        Queue messages and wait until they are all on disk.
+        Can be used as the `batch_handler` of a `RelpServer`.
+        '''
+        for future in self._append(messages):
+            future.result()
+
+    def close(self):
+        '''Write the messages waiting, close the file and wait for the compressions'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.file.close()
+        for thread in self.compressors:
+            thread.join()
+
+    def _append(self, messages):
+        futures = []
+        with self.condition:
+            for message in messages:
+                if isinstance(message, str):
+                    message = message.encode('utf-8')
+                elif isinstance(message, SyslogMessage):
+                    message = message.raw
+                # Wait while a full group is already waiting for the writer
+                self.condition.wait_for(lambda: self.closed or (
+                    len(self.pending) < self.max_group_messages and self.pending_bytes < self.max_group_bytes))
+                if self.closed:
+                    raise RelpError("Cannot write to a closed file sink")
+                future = Future()
+                self.pending.append(message + b'\n')
+                self.futures.append(future)
+                self.pending_bytes += len(message) + 1
+                futures.append(future)
+                if self._group_full():
+                    self.condition.notify_all()
+            self.condition.notify_all()
+        return futures
+
+    def _group_full(self):
+        return len(self.pending) >= self.max_group_messages or self.pending_bytes >= self.max_group_bytes
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                if self.commit_delay:
+                    self.condition.wait_for(lambda: self.closed or self._group_full(), self.commit_delay)
+                group, self.pending = self.pending, []
+                futures, self.futures = self.futures, []
+                self.pending_bytes = 0
+                self.condition.notify_all()
+            self._commit(group, futures)
+
+    def _commit(self, group, futures):
+        '''Write and sync a group of messages, then resolve their futures'''
+        start = monotonic()
+        data = b''.join(group)
+        try:
+            self._rotate_if_needed(len(data))
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+        except (OSError, ValueError) as err:
+            self.logger.error("Could not write %i messages to %s: %s", len(futures), self.path, err)
+            for future in futures:
+                future.set_exception(err)
+            return
+        if self.metrics is not None:
+            self.metrics.inc('relp_sink_commits_total')
+            self.metrics.inc('relp_sink_messages_total', len(futures))
+            self.metrics.observe('relp_sink_commit_seconds', monotonic() - start)
+        for future in futures:
+            future.set_result(None)
+
+    def _open(self):
+        new_file = open(self.path, 'ab')
+        try:
+            # Make the creation of the file durable too
+            self._sync_directory()
+        except OSError:
+            new_file.close()
+            raise
+        self.file = new_file
+        self.size = new_file.tell()
+        self.opened = monotonic()
+
+    def _sync_directory(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _rotate_if_needed(self, incoming):
+        if not self.size:
+            return
+        if self.max_file_bytes is not None and self.size + incoming > self.max_file_bytes:
+            self._rotate()
+        elif self.max_file_age is not None and monotonic() - self.opened >= self.max_file_age:
+            self._rotate()
+
+    def _rotate(self):
+        '''Rename the current file with a timestamp suffix and open a new one'''
+        target = f"{self.path}.{strftime('%Y%m%d-%H%M%S')}"
+        index = 1
+        while any(os.path.exists(name) for name in self._names(target)):
+            target = f"{self.path}.{strftime('%Y%m%d-%H%M%S')}.{index}"
+            index += 1
+        old_file = self.file
+        os.rename(self.path, target)
+        try:
+            self._open()
+        except OSError:
+            # Keep writing to the current file, the rotation is tried again on the next group
+            os.rename(target, self.path)
+            raise
+        old_file.close()
+        self.logger.info("Rotated %s to %s", self.path, target)
+        if self.compress is not None:
+            thread = Thread(target=self._compress, args=(target,), name='relp-sink-compress')
+            thread.start()
+            self.compressors = [thread for thread in self.compressors if thread.is_alive()] + [thread]
+
+    def _names(self, target):
+        '''Names a rotated file can have'''
+        if self.compress is None:
+            return [target]
+        return [target, target + COMPRESSORS[self.compress][1]]
+
+    def _compress(self, path):
+        opener, suffix = COMPRESSORS[self.compress]
+        try:
+            with open(path, 'rb') as source, opener(path + suffix, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            os.unlink(path)
+        except OSError as err:
+            self.logger.error("Could not compress %s: %s", path, err)
@@ -0,0 +1,250 @@
+'''Disk spool of messages, for clients that must not wait for the server'''
+
+import logging
+import mmap
+import os
+import struct
+
+from collections import deque
+from threading import Condition
+from time import monotonic
+
+from relp.exceptions import *
+
+default_logger = logging.getLogger('relp-spool')
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Each record is a 4 bytes header followed by the payload. The header is the
+# payload length with the high bit set, so an unwritten header reads 0.
+HEADER = struct.Struct('>I')
+RECORD_FLAG = 0x80000000
+SEGMENT_END = 0xFFFFFFFF
+CHECKPOINT = 'checkpoint'
+
+class Segment:
+    '''A memory-mapped segment file of the spool'''
+    def __init__(self, path, size=None):
+        self.path = path
+        mode = 'r+b' if size is None else 'w+b'
+        self.file = open(path, mode)
+        if size is not None:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mmap = mmap.mmap(self.file.fileno(), self.size)
+
+    def header(self, offset):
+        '''Return the record header at `offset`, SEGMENT_END past the end of the segment'''
+        if offset + HEADER.size > self.size:
+            return SEGMENT_END
+        return HEADER.unpack_from(self.mmap, offset)[0]
+
+    def close(self):
+        '''Unmap and close the segment'''
+        self.mmap.close()
+        self.file.close()
+
+class Spool:
+    '''
+    Append-only spool of messages stored in memory-mapped segment files.
+
+    `append` writes a message at memory speed. `read` returns the messages in order,
+    with a token to give to `ack` once the message is delivered. Segments are
+    deleted once all their messages are acknowledged, and the position of the
+    oldest message not acknowledged is saved in a checkpoint file at most every
+    `checkpoint_interval` seconds: after a restart, the messages after the
+    checkpoint are read again (at least once delivery).
+    With `max_segments`, `append` raises `SpoolFullError` instead of using more disk.
+    '''
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, max_segments=None,
+                 checkpoint_interval=1.0, logger=default_logger):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.checkpoint_interval = checkpoint_interval
+        self.logger = logger
+        self.condition = Condition()
+        self.segments = {}
+        self.outstanding = deque()
+        self.last_checkpoint = monotonic()
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.committed = self._load_checkpoint()
+        existing = self._existing()
+        for seq in existing:
+            if seq < self.committed[0]:
+                os.unlink(self._path(seq))
+        existing = [seq for seq in existing if seq >= self.committed[0]]
+        if existing and existing[0] > self.committed[0]:
+            self.committed = (existing[0], 0)
+
+        if existing:
+            self.write_seq = existing[-1]
+            offset = self.committed[1] if self.write_seq == self.committed[0] else 0
+            self.write_offset = self._scan(self.write_seq, offset)
+        else:
+            self.write_seq = self.committed[0]
+            self.segments[self.write_seq] = Segment(self._path(self.write_seq), segment_size)
+            self.write_offset = 0
+        self.read_seq, self.read_offset = self.committed
+        self._skip_end()
+        self.logger.info("Opened spool %s at segment %i, offset %i", directory, *self.committed)
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq:012d}.spool")
+
+    def _existing(self):
+        return sorted(
+            int(name[len('segment-'):-len('.spool')])
+            for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.spool')
+        )
+
+    def _segment(self, seq):
+        segment = self.segments.get(seq)
+        if segment is None:
+            segment = self.segments[seq] = Segment(self._path(seq))
+        return segment
+
+    def _release(self, seq):
+        '''Unmap a segment that is neither read nor written anymore'''
+        if seq not in (self.read_seq, self.write_seq) and seq in self.segments:
+            self.segments.pop(seq).close()
+
+    def _skip_end(self):
+        '''Move the read position to the next segment if the current one is finished'''
+        while self.read_seq < self.write_seq and self._segment(self.read_seq).header(self.read_offset) == SEGMENT_END:
+            previous = self.read_seq
+            self.read_seq += 1
+            self.read_offset = 0
+            self._release(previous)
+
+    def _scan(self, seq, offset):
+        '''Return the offset of the end of the records of a segment'''
+        segment = self._segment(seq)
+        while True:
+            header = segment.header(offset)
+            if header == 0 or header == SEGMENT_END:
+                return offset
+            offset += HEADER.size + (header & ~RECORD_FLAG)
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as checkpoint:
+                seq, offset = checkpoint.read().split()
+                return int(seq), int(offset)
+        except FileNotFoundError:
+            existing = self._existing()
+            return (existing[0] if existing else 0), 0
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'w') as checkpoint:
+            checkpoint.write('%i %i\n' % self.committed)
+        os.replace(path + '.tmp', path)
+        self.last_checkpoint = monotonic()
+
+    def append(self, message):
+        '''Write a message (`str` or `bytes`) at the end of the spool'''
+        data = message.encode('utf-8') if isinstance(message, str) else message
+        size = HEADER.size + len(data)
+        with self.condition:
+            if self.closed:
+                raise RelpSessionError("Spool is closed")
+            segment = self.segments[self.write_seq]
+            if self.write_offset + size > segment.size:
+                if self.max_segments and self.write_seq - self.committed[0] + 1 >= self.max_segments:
+                    raise SpoolFullError(f"Spool {self.directory} is full ({self.max_segments} segments)")
+                if self.write_offset + HEADER.size <= segment.size:
+                    HEADER.pack_into(segment.mmap, self.write_offset, SEGMENT_END)
+                previous = self.write_seq
+                self.write_seq += 1
+                self.write_offset = 0
+                segment = Segment(self._path(self.write_seq), max(self.segment_size, size + HEADER.size))
+                self.segments[self.write_seq] = segment
+                self._release(previous)
+                self._skip_end()
+            offset = self.write_offset
+            segment.mmap[offset + HEADER.size:offset + size] = data
+            # Header written last: a record is only visible once complete
+            HEADER.pack_into(segment.mmap, offset, len(data) | RECORD_FLAG)
+            self.write_offset += size
+            self.condition.notify_all()
+
+    def read(self, timeout=None):
+        '''
+        Return the next message to send, as `(token, payload)`, or `(None, None)`
+        if no message was appended within `timeout` seconds.
+        '''
+        with self.condition:
+            available = lambda: self.closed or (self.read_seq, self.read_offset) != (self.write_seq, self.write_offset)
+            if not self.condition.wait_for(available, timeout) or self.closed:
+                return None, None
+            segment = self._segment(self.read_seq)
+            start = self.read_offset
+            header = segment.header(start)
+            end = start + HEADER.size + (header & ~RECORD_FLAG)
+            payload = bytes(segment.mmap[start + HEADER.size:end])
+            self.read_offset = end
+            token = [self.read_seq, start, False]
+            self.outstanding.append(token)
+            self._skip_end()
+            return token, payload
+
+    def ack(self, token):
+        '''Mark a message returned by `read` as delivered'''
+        with self.condition:
+            if token[2] is None:
+                # Message read before a `rewind`
+                return
+            token[2] = True
+            while self.outstanding and self.outstanding[0][2]:
+                self.outstanding.popleft()
+            if self.outstanding:
+                committed = tuple(self.outstanding[0][:2])
+            else:
+                committed = (self.read_seq, self.read_offset)
+            if committed == self.committed:
+                return
+            for seq in range(self.committed[0], committed[0]):
+                self._release(seq)
+                os.unlink(self._path(seq))
+            self.committed = committed
+            if monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+                self._save_checkpoint()
+
+    def rewind(self):
+        '''Read again all the messages not acknowledged (after a connection loss)'''
+        with self.condition:
+            for token in self.outstanding:
+                token[2] = None
+            self.outstanding.clear()
+            previous = self.read_seq
+            self.read_seq, self.read_offset = self.committed
+            self._release(previous)
+            self._skip_end()
+            self.condition.notify_all()
+
+    def pending(self):
+        '''Return True if some messages are not acknowledged yet'''
+        with self.condition:
+            return bool(self.outstanding) or (self.read_seq, self.read_offset) != (self.write_seq, self.write_offset)
+
+    def sync(self):
+        '''Flush the written segment to disk and save the checkpoint'''
+        with self.condition:
+            self.segments[self.write_seq].mmap.flush()
+            self._save_checkpoint()
+
+    def close(self):
+        '''Save the checkpoint and unmap all the segments'''
+        with self.condition:
+            if self.closed:
+                return
+            self.sync()
+            self.closed = True
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
+            self.condition.notify_all()
@@ -0,0 +1,169 @@
+'''Lazy view over the syslog messages (RFC 5424 and RFC 3164) received in RELP frames'''
+
+import re
+
+NILVALUE = b'-'
+BOM = b'\xef\xbb\xbf'
+
+# `<PRI>`, then the RFC 5424 header up to the structured data
+PRI_REGEX = re.compile(rb'<([0-9]{1,3})>')
+RFC5424_REGEX = re.compile(rb'([0-9]{1,2}) (\S+) (\S+) (\S+) (\S+) (\S+) ')
+# `Mmm dd hh:mm:ss HOSTNAME TAG[PID]: `
+RFC3164_REGEX = re.compile(rb'([A-Z][a-z]{2} [ 0-9][0-9] [0-9]{2}:[0-9]{2}:[0-9]{2}) (\S+) ([^:\[\s]+)(?:\[([^\]\s]*)\])?: ?')
+
+# Decoded hostnames and app-names, shared by all the messages
+MAX_INTERNED = 4096
+_interned = {}
+
+def intern_field(data):
+    '''Decode a header field, returning the same `str` for the same bytes'''
+    value = _interned.get(data)
+    if value is None:
+        if len(_interned) >= MAX_INTERNED:
+            _interned.clear()
+        value = _interned[data] = data.decode('utf-8', 'replace')
+    return value
+
+class SyslogMessage:
+    '''
+    Read-only view over the raw bytes of a syslog message.
+
+    The header is only parsed when one of its fields is accessed, and each field is
+    only decoded when accessed. Missing fields (NILVALUE, or not in the format) are
+    None. Messages that are neither RFC 5424 nor RFC 3164 only have `msg`.
+    `str()` gives the whole message.
+    '''
+    __slots__ = ('raw', '_spans', '_rfc', '_text')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._spans = None
+        self._rfc = None
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self.raw.decode('utf-8', 'replace')
+        return self._text
+
+    def __repr__(self):
+        return f"SyslogMessage({self.raw!r})"
+
+    def _parse(self):
+        '''Find the positions of the header fields'''
+        # pri, timestamp, hostname, app_name, procid, msgid, structured_data, msg
+        spans = [None] * 8
+        data = self.raw
+        end = len(data)
+        match = PRI_REGEX.match(data)
+        position = 0
+        if match:
+            spans[0] = match.span(1)
+            position = match.end()
+            header = RFC5424_REGEX.match(data, position)
+            if header:
+                self._rfc = 5424
+                for index in range(1, 6):
+                    start, stop = header.span(index + 1)
+                    if data[start:stop] != NILVALUE:
+                        spans[index] = (start, stop)
+                position = header.end()
+                sd_end = self._structured_data_end(position)
+                if sd_end > position:
+                    spans[6] = (position, sd_end)
+                    position = sd_end
+                elif data.startswith(NILVALUE, position):
+                    position += 1
+                if data.startswith(b' ', position):
+                    position += 1
+                if data.startswith(BOM, position):
+                    position += len(BOM)
+            else:
+                header = RFC3164_REGEX.match(data, position)
+                if header:
+                    self._rfc = 3164
+                    spans[1] = header.span(1)
+                    spans[2] = header.span(2)
+                    spans[3] = header.span(3)
+                    if header.start(4) >= 0:
+                        spans[4] = header.span(4)
+                    position = header.end()
+        spans[7] = (position, end)
+        self._spans = spans
+
+    def _structured_data_end(self, position):
+        '''Return the end of the SD-ELEMENTs starting at `position`'''
+        data = self.raw
+        while data.startswith(b'[', position):
+            position += 1
+            while position < len(data) and data[position] != 0x5d:  # `]`
+                # `\]`, `\"` and `\\` are escaped in PARAM-VALUE
+                position += 2 if data[position] == 0x5c else 1
+            position += 1
+        return min(position, len(data))
+
+    def _span(self, index):
+        if self._spans is None:
+            self._parse()
+        return self._spans[index]
+
+    def _field(self, index):
+        span = self._span(index)
+        if span is None:
+            return None
+        return self.raw[span[0]:span[1]].decode('utf-8', 'replace')
+
+    @property
+    def rfc(self):
+        '''5424 or 3164 depending on the format of the header, None if not recognized'''
+        self._span(0)
+        return self._rfc
+
+    @property
+    def pri(self):
+        span = self._span(0)
+        return None if span is None else int(self.raw[span[0]:span[1]])
+
+    @property
+    def facility(self):
+        pri = self.pri
+        return None if pri is None else pri >> 3
+
+    @property
+    def severity(self):
+        pri = self.pri
+        return None if pri is None else pri & 7
+
+    @property
+    def timestamp(self):
+        '''The timestamp, as written in the message'''
+        return self._field(1)
+
+    @property
+    def hostname(self):
+        span = self._span(2)
+        return None if span is None else intern_field(self.raw[span[0]:span[1]])
+
+    @property
+    def app_name(self):
+        '''The APP-NAME, or the TAG of RFC 3164 messages'''
+        span = self._span(3)
+        return None if span is None else intern_field(self.raw[span[0]:span[1]])
+
+    @property
+    def procid(self):
+        return self._field(4)
+
+    @property
+    def msgid(self):
+        return self._field(5)
+
+    @property
+    def structured_data(self):
+        '''The SD-ELEMENTs, as written in the message'''
+        return self._field(6)
+
+    @property
+    def msg(self):
+        '''The message after the header'''
+        return self._field(7)
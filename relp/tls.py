@@ -0,0 +1,165 @@
+'''TLS transport for RELP sessions'''
+
+import logging
+import ssl
+
+from socket import SHUT_RD
+from threading import Lock
+
+default_logger = logging.getLogger('relp-tls')
+
+# Size of the reads from the TCP socket. TLS records (up to 16k) do not
+# line up with the reads, so read large chunks and decrypt all of them.
+READ_SIZE = 256 * 1024
+
+def server_context(certfile, keyfile=None, cafile=None):
+    '''
+    Create the TLS context of a server.
+    With `cafile`, clients must present a certificate signed by this CA (mutual TLS).
+    '''
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+def client_context(cafile=None, certfile=None, keyfile=None):
+    '''
+    Create the TLS context of a client, verifying the server with `cafile`
+    (the system CA otherwise). `certfile` is the client certificate for mutual TLS.
+    '''
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+class TlsSocket:
+    '''
+    TLS connection over a connected TCP socket, with the interface of a socket
+    used by `RelpSession` (`recv_into`, `sendall`, `shutdown`, `close`...).
+
+    The TLS state is kept in memory buffers and guarded by a lock, so a thread
+    can read while another one writes (which an `ssl.SSLSocket` does not allow).
+    `session` can be the `ssl.SSLSession` of a previous connection to the same
+    server, to resume it instead of doing a full handshake.
+    '''
+    def __init__(self, sock, context, server_side=False, server_hostname=None, session=None,
+                 logger=default_logger):
+        self.sock = sock
+        self.logger = logger
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side, server_hostname, session=session)
+        # `lock` guards the TLS state, `write_lock` keeps the encrypted data in order on the socket
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.raw = bytearray(READ_SIZE)
+        self.raw_view = memoryview(self.raw)
+
+    def do_handshake(self, timeout=None):
+        '''Do the TLS handshake, in at most `timeout` seconds'''
+        previous = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                try:
+                    with self.lock:
+                        self.tls.do_handshake()
+                    break
+                except ssl.SSLWantReadError:
+                    self._flush()
+                    if not self._read_raw():
+                        raise ConnectionError("Connection closed during the TLS handshake")
+            self._flush()
+        finally:
+            self.sock.settimeout(previous)
+        self.logger.debug("TLS handshake done with %s (%s, resumed: %s)",
+                          self.getpeername(), self.tls.version(), self.tls.session_reused)
+
+    def _read_raw(self):
+        size = self.sock.recv_into(self.raw)
+        if size:
+            with self.lock:
+                self.incoming.write(self.raw_view[:size])
+        return size
+
+    def _flush(self):
+        '''Write the pending encrypted data (handshake, tickets, alerts...)'''
+        with self.write_lock:
+            with self.lock:
+                data = self.outgoing.read()
+            if data:
+                self.sock.sendall(data)
+
+    def recv_into(self, buffer):
+        '''Read decrypted data into `buffer`. Return 0 when the peer closed the connection'''
+        while True:
+            try:
+                with self.lock:
+                    size = self.tls.read(len(buffer), buffer)
+            except ssl.SSLWantReadError:
+                size = None
+            except ssl.SSLZeroReturnError:
+                return 0
+            if self.outgoing.pending:
+                self._flush()
+            if size is not None:
+                return size
+            if not self._read_raw():
+                return 0
+
+    def sendall(self, data):
+        '''Encrypt and write all the data'''
+        with self.write_lock:
+            with self.lock:
+                self.tls.write(data)
+                encrypted = self.outgoing.read()
+            self.sock.sendall(encrypted)
+
+    def shutdown(self, how):
+        '''
+        Send the TLS close notification, then shut down the TCP socket.
+        With `SHUT_RD`, only stop reading: the session can still send data.
+        '''
+        if how == SHUT_RD:
+            self.sock.shutdown(how)
+            return
+        try:
+            with self.lock:
+                self.tls.unwrap()
+        except (ssl.SSLError, ValueError):
+            pass
+        try:
+            self._flush()
+        except OSError:
+            pass
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def getpeercert(self):
+        '''Return the certificate of the peer, as given by `ssl.SSLSocket.getpeercert`'''
+        return self.tls.getpeercert()
+
+    @property
+    def session(self):
+        '''TLS session, to resume in the next connection'''
+        return self.tls.session
+
+    @property
+    def session_reused(self):
+        return self.tls.session_reused
@@ -0,0 +1,152 @@
+'''Multi-process RELP server, to use all the cores of a host'''
+
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from multiprocessing.connection import wait
+from queue import Empty
+from threading import Event, Thread
+from time import monotonic
+
+from relp.metrics import MetricsRegistry, merge_stats
+from relp.server import DEFAULT_DRAIN_TIMEOUT, RelpServer, listening_socket
+
+default_logger = logging.getLogger('relp-workers')
+
+# Minimum delay between two restarts of the same worker
+RESTART_DELAY = 1.0
+
+def run_worker(index, listen_addr, port, sock, stats_queue, stats_interval, logger, server_options):
+    '''
+    Entrypoint of a worker process: serve RELP and report stats periodically.
+    On SIGTERM, the sessions are drained before exiting.
+    '''
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    metrics = MetricsRegistry()
+    reuse_port = sock is None
+    server = RelpServer(listen_addr, port, logger=logger, metrics=metrics,
+                        reuse_port=reuse_port, sock=sock, **server_options)
+    server.main_thread.daemon = True
+    server.start()
+    logger.info("Worker %i (pid %i) started", index, os.getpid())
+    while server.main_thread.is_alive() and not stopping.is_set():
+        stopping.wait(stats_interval)
+        stats_queue.put((index, metrics.stats()))
+    if stopping.is_set():
+        logger.info("Worker %i (pid %i) stopping", index, os.getpid())
+        server.stop()
+        os._exit(0)
+    logger.error("Worker %i listener stopped", index)
+    os._exit(1)
+
+class MultiProcessRelpServer:
+    '''
+    RELP server running `workers` processes, each with its own accept loop
+    and handlers. Takes the same `handler` (or `batch_handler`, ...) arguments
+    as `RelpServer`.
+
+    With `reuse_port` (the default, when the platform supports it), each worker
+    binds its own socket with `SO_REUSEPORT` and the kernel spreads the
+    connections. Otherwise the listening socket is created once and shared.
+    The supervisor restarts the workers that exit, and gathers their stats.
+    '''
+    def __init__(self, listen_addr, port, handler=None, workers=None, logger=default_logger,
+                 reuse_port=hasattr(socket, 'SO_REUSEPORT'), stats_interval=5.0, **server_options):
+        self.listen_addr = listen_addr
+        self.port = port
+        self.workers = workers or os.cpu_count()
+        self.logger = logger
+        self.reuse_port = reuse_port
+        self.stats_interval = stats_interval
+        self.server_options = dict(server_options, handler=handler)
+
+        self.context = multiprocessing.get_context('fork')
+        self.stats_queue = self.context.Queue()
+        self.processes = {}
+        self.started = {}
+        self.restarts = {}
+        self.worker_stats = {}
+        self.stopping = Event()
+        self.socket = None
+        if not reuse_port:
+            self.socket = listening_socket(listen_addr, port, backlog=server_options.get('backlog'))
+        self.stats_thread = Thread(target=self._collect_stats, daemon=True)
+
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.listen_addr, self.port, self.socket, self.stats_queue,
+                  self.stats_interval, self.logger, self.server_options),
+            name=f"relp-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = monotonic()
+        self.logger.debug("Spawned worker %i with pid %i", index, process.pid)
+
+    def start(self):
+        '''Start the workers and return'''
+        for index in range(self.workers):
+            self.restarts[index] = 0
+            self._spawn(index)
+        self.stats_thread.start()
+
+    def _collect_stats(self):
+        while not self.stopping.is_set():
+            try:
+                index, stats = self.stats_queue.get(timeout=1)
+            except (Empty, EOFError, OSError):
+                continue
+            self.worker_stats[index] = stats
+
+    def supervise(self):
+        '''Wait for workers to exit and restart them, until `stop` is called'''
+        while not self.stopping.is_set():
+            sentinels = {process.sentinel: index for index, process in self.processes.items()}
+            for sentinel in wait(list(sentinels), timeout=1):
+                index = sentinels[sentinel]
+                process = self.processes[index]
+                process.join()
+                if self.stopping.is_set():
+                    break
+                self.logger.error("Worker %i (pid %i) exited with code %s, restarting it",
+                                  index, process.pid, process.exitcode)
+                delay = self.started[index] + RESTART_DELAY - monotonic()
+                if delay > 0:
+                    self.stopping.wait(delay)
+                self.restarts[index] += 1
+                self._spawn(index)
+
+    def serve_forever(self):
+        '''Start the workers and supervise them forever'''
+        self.start()
+        self.supervise()
+
+    def stop(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        '''Stop all the workers, waiting at most `timeout` seconds for them to drain their sessions'''
+        self.stopping.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        if self.socket is not None:
+            self.socket.close()
+
+    def stats(self):
+        '''
+        Return the last stats reported by each worker, their sum in `total`,
+        and the number of restarts of each worker.
+        '''
+        workers = dict(self.worker_stats)
+        return {
+            'workers': workers,
+            'total': merge_stats(workers.values()),
+            'restarts': dict(self.restarts),
+        }
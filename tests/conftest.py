@@ -0,0 +1,67 @@
+import logging
+
+import pytest
+
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+from threading import Thread
+
+from relp.server import handle_client
+from relp.session import RelpSession
+
+log = logging.getLogger('test')
+
+@pytest.fixture
+def listen():
+    '''
+    Start TCP servers on localhost, calling `serve(clientsocket, address)` in a thread
+    for each connection. Return their address. They are closed after the test.
+    '''
+    listeners = []
+
+    def listen(serve):
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        listeners.append(listener)
+
+        def accept():
+            while True:
+                try:
+                    clientsocket, address = listener.accept()
+                except OSError:
+                    return
+                Thread(target=serve, args=(clientsocket, address), daemon=True).start()
+        Thread(target=accept, daemon=True).start()
+        return listener.getsockname()
+
+    yield listen
+    for listener in listeners:
+        listener.close()
+
+@pytest.fixture
+def relp_server(listen):
+    '''Start RELP servers calling `handler` (see `handle_client` for the options), return their address'''
+    def relp_server(handler, **options):
+        return listen(lambda clientsocket, address: handle_client(clientsocket, address, handler, log, **options))
+    return relp_server
+
+@pytest.fixture
+def send_to_handler():
+    '''
+    Send messages to a server session calling `handler` (see `handle_client` for the
+    options) through a socketpair, close it, and return the ACK codes of the messages.
+    '''
+    def send_to_handler(handler, messages, **options):
+        client_sock, server_sock = socketpair()
+        thread = Thread(target=handle_client, args=(server_sock, 'socketpair', handler, log),
+                        kwargs=options, daemon=True)
+        thread.start()
+        client = RelpSession(client_sock, 'client')
+        client.start()
+        client.offer()
+        handles = [client.send_async('syslog', message) for message in messages]
+        codes = [handle.result(timeout=10).code for handle in handles]
+        client.stop()
+        thread.join()
+        return codes
+    return send_to_handler
@@ -0,0 +1,84 @@
+import pytest
+
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+from relp.protocol import MAX_TXNR
+from relp.session import AckWindow
+from relp.exceptions import RelpSessionError
+
+log = getLogger('test-ack-window')
+
+class TestAckWindow:
+    def test_process(self):
+        window = AckWindow(4)
+        handle = window.reserve()
+        assert handle.txnr == 1
+
+        def put_handler(key, value):
+            log.debug("[put] Started put")
+            window.put(key, value)
+            log.debug("[put] Finished putting data")
+
+        with ThreadPoolExecutor() as threadpool:
+            future = threadpool.submit(handle.result, 5)
+            threadpool.submit(put_handler, 1, 123)
+            assert future.result() == 123
+        assert window.inflight() == 0
+
+    def test_full_window(self):
+        window = AckWindow(2)
+        first, second = window.reserve(), window.reserve()
+        assert window.try_reserve() is None
+        with pytest.raises(TimeoutError):
+            window.reserve(timeout=0.01)
+        # Out of order ACK does not move the window
+        window.put(second.txnr, 'second')
+        assert window.try_reserve() is None
+        window.put(first.txnr, 'first')
+        third = window.try_reserve()
+        assert third.txnr == 3
+        assert window.wait_many([first, second]) == ['first', 'second']
+
+    def test_callbacks(self):
+        window = AckWindow(2)
+        handle = window.reserve()
+        called = []
+        handle.add_done_callback(lambda h: called.append(h.result()))
+        window.put(handle.txnr, 'ack')
+        handle.add_done_callback(lambda h: called.append('late'))
+        assert called == ['ack', 'late']
+
+    def test_unknown_txnr(self):
+        window = AckWindow(2)
+        window.reserve()
+        assert window.put(2, 'ack') is False
+        assert window.put(1, 'ack') is True
+        assert window.put(1, 'ack') is False
+
+    def test_memory_is_bounded(self):
+        window = AckWindow(8)
+        for _ in range(10000):
+            handle = window.reserve()
+            window.put(handle.txnr, 'ack')
+        assert len(window.slots) == 8
+        assert window.inflight() == 0
+
+    def test_txnr_wraps(self):
+        window = AckWindow(4)
+        window.origin = MAX_TXNR - 1
+        txnrs = []
+        for _ in range(4):
+            handle = window.reserve()
+            txnrs.append(handle.txnr)
+            window.put(handle.txnr, 'ack')
+        assert txnrs == [MAX_TXNR - 1, MAX_TXNR, 1, 2]
+
+    def test_fail(self):
+        window = AckWindow(2)
+        handle = window.reserve()
+        window.fail(RelpSessionError('closed'))
+        with pytest.raises(RelpSessionError):
+            handle.result()
+        with pytest.raises(RelpSessionError):
+            window.reserve()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from relp.aio import AsyncRelpClient, AsyncRelpServer
+from relp.exceptions import AckError, RelpSessionError
+from relp.server import RelpServer
+
+import pytest
+
+def test_async_loopback():
+    received = []
+
+    async def handler(message):
+        if message == 'fail':
+            raise ValueError('refused')
+        received.append(message)
+
+    async def main():
+        async with AsyncRelpServer('127.0.0.1', 0, handler) as server:
+            port = server.server.sockets[0].getsockname()[1]
+            async with AsyncRelpClient('127.0.0.1', port, window=8) as client:
+                acks = await asyncio.gather(*(client.syslog(f"message #{i}") for i in range(50)))
+                assert {ack.code for ack in acks} == {200}
+                with pytest.raises(AckError):
+                    await client.syslog('fail')
+
+    asyncio.run(main())
+    assert received == [f"message #{i}" for i in range(50)]
+
+def test_serverclose():
+    server = RelpServer('127.0.0.1', 0, lambda message: None, logging.getLogger('test-aio'))
+    server.main_thread.daemon = True
+    server.start()
+    port = server.socket.getsockname()[1]
+
+    async def main():
+        client = AsyncRelpClient('127.0.0.1', port)
+        await client.start()
+        await client.syslog('a')
+        # The server drains its sessions and sends `serverclose`
+        await asyncio.get_running_loop().run_in_executor(None, server.stop)
+        await asyncio.wait_for(client.protocol.closed, 5)
+        with pytest.raises(RelpSessionError):
+            await asyncio.wait_for(client.syslog('b'), 5)
+        await asyncio.wait_for(client.stop(), 5)
+
+    asyncio.run(main())
+
+def test_disconnect():
+    async def main():
+        async with AsyncRelpServer('127.0.0.1', 0, lambda message: None) as server:
+            port = server.server.sockets[0].getsockname()[1]
+            client = AsyncRelpClient('127.0.0.1', port)
+            await client.start()
+            client.protocol.transport.close()
+            # Before and after `connection_lost`
+            with pytest.raises(RelpSessionError):
+                await asyncio.wait_for(client.syslog('a'), 5)
+            await asyncio.wait_for(client.protocol.closed, 5)
+            with pytest.raises(RelpSessionError):
+                await asyncio.wait_for(client.syslog('b'), 5)
+            await asyncio.wait_for(client.stop(), 5)
+
+    asyncio.run(main())
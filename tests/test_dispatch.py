@@ -0,0 +1,49 @@
+import os
+
+from relp.dispatch import ShardedDispatcher
+from relp.metrics import MetricsRegistry
+
+class Recorder:
+    '''Handler appending the pid of the worker and the message to a file'''
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, message):
+        if message.msg == 'fail':
+            raise ValueError("refused")
+        if message.msg == 'crash':
+            os._exit(1)
+        with open(self.path, 'a') as output:
+            output.write(f"{os.getpid()} {message.hostname} {message.msg}\n")
+
+class TestShardedDispatcher:
+    def test_order_per_key(self, tmp_path, send_to_handler):
+        path = tmp_path / 'handled.log'
+        metrics = MetricsRegistry()
+        messages = [f"<13>1 - host{index % 5} app - - - {index}" for index in range(500)]
+        with ShardedDispatcher(Recorder(str(path)), key=lambda message: message.hostname, processes=3,
+                               parse_syslog=True, max_batch_messages=16, metrics=metrics) as dispatcher:
+            assert send_to_handler(dispatcher, messages, parse_syslog=True) == [200] * 500
+        handled = {}
+        pids = {}
+        for line in path.read_text().splitlines():
+            pid, host, index = line.split()
+            handled.setdefault(host, []).append(int(index))
+            pids.setdefault(host, set()).add(pid)
+        # Each host is handled by one worker, in the order the messages were received
+        assert all(len(workers) == 1 for workers in pids.values())
+        assert handled == {f"host{key}": list(range(key, 500, 5)) for key in range(5)}
+        stats = metrics.stats()
+        assert stats['relp_dispatch_messages_total'] == 500
+        assert stats['relp_dispatch_batches_total'] >= 500 // 16
+
+    def test_failures_are_nacked(self, tmp_path, send_to_handler):
+        path = tmp_path / 'handled.log'
+        metrics = MetricsRegistry()
+        with ShardedDispatcher(Recorder(str(path)), processes=1, parse_syslog=True, metrics=metrics) as dispatcher:
+            assert send_to_handler(dispatcher, ['<13>1 - host app - - - fail', '<13>1 - host app - - - ok']) == [500, 200]
+            # A worker that dies NACKs the messages it did not confirm, and is restarted
+            assert send_to_handler(dispatcher, ['<13>1 - host app - - - crash'])[0] == 500
+            assert send_to_handler(dispatcher, ['<13>1 - host app - - - after']) == [200]
+        assert [line.split()[2] for line in path.read_text().splitlines()] == ['ok', 'after']
+        assert metrics.stats()['relp_dispatch_restarts_total'] == 1
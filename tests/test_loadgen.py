@@ -0,0 +1,70 @@
+import logging
+import random
+
+import pytest
+
+from relp.loadgen import CountingSink, LoadGenerator, format_report, make_message, size_distribution
+from relp.server import RelpServer
+
+log = logging.getLogger('test-loadgen')
+
+@pytest.fixture
+def sink():
+    '''Server discarding the messages, with the port in `sink.port`'''
+    counter = CountingSink()
+    server = RelpServer('127.0.0.1', 0, batch_handler=counter, parse_syslog=True, logger=log)
+    server.main_thread.daemon = True
+    server.start()
+    counter.port = server.socket.getsockname()[1]
+    yield counter
+    server.stop(timeout=5)
+
+class TestSizes:
+    def test_distributions(self):
+        rng = random.Random(1)
+        assert size_distribution('300')(rng) == 300
+        assert {size_distribution('fixed:10')(rng) for _ in range(10)} == {10}
+        assert all(100 <= size_distribution('uniform:100:200')(rng) <= 200 for _ in range(100))
+        sizes = [size_distribution('lognormal:500:0.5')(rng) for _ in range(1000)]
+        assert 400 < sorted(sizes)[500] < 600
+        with pytest.raises(ValueError):
+            size_distribution('pareto:1')
+
+    def test_message_size(self):
+        assert len(make_message(3, 42, 200)) == 200
+
+class TestLoadGenerator:
+    def test_generate(self, sink):
+        generator = LoadGenerator('127.0.0.1', sink.port, sessions=3, logger=log)
+        report = generator.generate(count=1000, size='uniform:50:500', seed=1)
+        assert (report['sent'], report['acked'], report['nacked'], report['failed']) == (1000, 1000, 0, 0)
+        assert report['ack_seconds']['count'] == 1000
+        assert sink.messages == 1000
+        assert 'ack latency' in format_report(report)
+
+    def test_rate(self, sink):
+        generator = LoadGenerator('127.0.0.1', sink.port, sessions=2, logger=log)
+        report = generator.generate(rate=200, count=100)
+        assert report['acked'] == 100
+        assert 0.4 < report['elapsed'] < 2
+
+    def test_replay(self, sink):
+        lines = [
+            '<13>1 2024-05-01T10:00:00.000Z web01 nginx - - - first\n',
+            '<13>1 2024-05-01T10:00:00.200Z web02 nginx - - - second\n',
+            'no timestamp\n',
+            '<13>1 2024-05-01T10:00:00.400Z web01 nginx - - - third\n',
+        ]
+        generator = LoadGenerator('127.0.0.1', sink.port, sessions=2, logger=log)
+        report = generator.replay(lines, speed=2)
+        assert report['acked'] == 4
+        # 400ms of traffic, twice as fast
+        assert 0.19 < report['elapsed'] < 1
+        assert sink.messages == 4
+
+    def test_bytes(self, sink):
+        '''The throughput counts the bytes sent, not the characters'''
+        lines = ['<13>1 - web01 app - - - café\n', '<13>1 - web02 app - - - 日本語\n']
+        generator = LoadGenerator('127.0.0.1', sink.port, sessions=2, logger=log)
+        generator.replay(lines)
+        assert sum(session.bytes for session in generator.sessions) == sink.bytes == 62
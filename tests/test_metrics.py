@@ -0,0 +1,32 @@
+from socket import socketpair
+
+from relp.metrics import MetricsRegistry
+from relp.session import RelpSession
+
+class TestMetrics:
+    def test_session_metrics(self):
+        metrics = MetricsRegistry()
+        client_sock, server_sock = socketpair()
+        server = RelpSession(server_sock, 'server', metrics=metrics)
+        client = RelpSession(client_sock, 'client', metrics=metrics)
+        server.start()
+        client.start()
+        client.offer()
+        client.send_many('syslog', ['message'] * 10)
+
+        stats = metrics.stats()
+        assert stats['relp_sessions_active'] == 2
+        # Both peers support `syslogbatch`: the 10 messages are sent in one frame
+        assert stats['relp_frames_sent_total']['syslogbatch'] == 1
+        assert stats['relp_frames_received_total']['syslogbatch'] == 1
+        assert stats['relp_bytes_received_total']['syslogbatch'] == 90
+        assert stats['relp_ack_seconds']['count'] == 2
+        assert stats['relp_inflight_acks'] == 0
+
+        text = metrics.prometheus()
+        assert 'relp_frames_received_total{command="syslogbatch"} 1' in text
+        assert 'relp_ack_seconds_bucket{le="+Inf"} 2' in text
+
+        client.stop()
+        server.stop()
+        assert metrics.stats()['relp_sessions_active'] == 0
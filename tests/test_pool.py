@@ -0,0 +1,22 @@
+from relp.pool import RelpClientPool
+from relp.protocol import Ack, FrameParser, Offer
+
+def blackhole(clientsocket, address):
+    '''Accept the RELP offer, then never acknowledge anything'''
+    parser = FrameParser()
+    while parser.read_from(clientsocket):
+        for frame in parser.frames():
+            if frame.command == 'open':
+                clientsocket.sendall(Ack(frame.txnr, message=Offer().message()).to_frame().encode())
+
+class TestRelpClientPool:
+    def test_failover(self, listen, relp_server):
+        received = []
+        good = relp_server(received.append)
+        bad = listen(blackhole)
+        pool = RelpClientPool([bad, good], strategy='round-robin', health_interval=0.05, ack_timeout=0.2)
+        with pool:
+            assert len(pool.members) == 2
+            futures = [pool.syslog_async(f"message #{index}") for index in range(20)]
+            assert {future.result(timeout=10).code for future in futures} == {200}
+        assert sorted(received) == sorted(f"message #{index}" for index in range(20))
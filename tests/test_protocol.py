@@ -0,0 +1,86 @@
+import pytest
+
+from relp.protocol import Ack, Frame, FrameParser, FrameWriter, Offer, RspCode, pack_messages, unpack_messages
+from relp.exceptions import RelpProtocolError
+
+FRAMES = [
+    Frame(1, 'open', 'relp_version=0\nrelp_software=python-relp\ncommands=syslog'),
+    Frame(2, 'syslog', 'ascii message'),
+    Frame(3, 'syslog', 'multibyte message: été 日本語 🚀'),
+    Frame(4, 'close', ''),
+]
+
+class TestFrameParser:
+    def test_encode_octet_length(self):
+        assert Frame(3, 'syslog', 'é').encode() == b'3 syslog 2 \xc3\xa9\n'
+        assert Frame(0, 'serverclose', '').encode() == b'0 serverclose 0\n'
+
+    def test_writer(self):
+        writer = FrameWriter()
+        for frame in FRAMES:
+            writer.frame(frame)
+        writer.ack(5)
+        writer.rsp(6, RspCode.NACK, 'refused')
+        writer.offer_reply(7)
+        expected = b''.join(frame.encode() for frame in FRAMES) + b''.join([
+            Ack(5).to_frame().encode(),
+            Ack(6, RspCode.NACK, 'refused').to_frame().encode(),
+            Ack(7, message=Offer().message()).to_frame().encode(),
+        ])
+        assert bytes(writer.buffer) == expected
+        writer.clear()
+        assert len(writer) == 0
+
+    def test_split_at_every_boundary(self):
+        data = b''.join(frame.encode() for frame in FRAMES)
+        for index in range(len(data) + 1):
+            parser = FrameParser()
+            parser.feed(data[:index])
+            frames = parser.frames()
+            parser.feed(data[index:])
+            frames += parser.frames()
+            assert [(f.txnr, f.command, f.message) for f in frames] == \
+                [(f.txnr, f.command, f.message) for f in FRAMES]
+            assert not parser.buffer
+
+    def test_large_message_in_chunks(self):
+        message = 'x' * (4 * 1024 * 1024)
+        data = Frame(7, 'syslog', message).encode()
+        parser = FrameParser()
+        frames = []
+        for start in range(0, len(data), 65536):
+            parser.feed(data[start:start + 65536])
+            frames += parser.frames()
+        assert len(frames) == 1
+        assert frames[0].payload == message.encode()
+
+    def test_empty_message_with_space(self):
+        parser = FrameParser()
+        parser.feed(b'0 serverclose 0 \n')
+        frame, = parser.frames()
+        assert (frame.txnr, frame.command, frame.payload) == (0, 'serverclose', b'')
+
+    @pytest.mark.parametrize('data', [
+        b'abc syslog 3 foo\n',
+        b'1 syslog 3 foox',
+        b'1 sys_log 3 foo\n',
+    ])
+    def test_invalid_frames(self, data):
+        parser = FrameParser()
+        parser.feed(data)
+        with pytest.raises(RelpProtocolError):
+            parser.frames()
+
+class TestOffer:
+    def test_parse_reply(self):
+        offer = Offer.parse('OK\nrelp_version=0\nrelp_software=rsyslog\ncommands=syslog')
+        assert offer.software == 'rsyslog'
+        assert offer.negotiate() == ['syslog']
+        assert Offer.from_frame(Offer().to_frame(1)).negotiate() == ['syslog', 'syslogbatch']
+
+    def test_batch_messages(self):
+        messages = ['ascii', '', 'multibyte: été 🚀', 'with spaces and\nnew line']
+        frame = Frame(1, 'syslogbatch', pack_messages(messages))
+        assert frame.messages() == messages
+        with pytest.raises(RelpProtocolError):
+            unpack_messages(b'10 short')
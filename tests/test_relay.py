@@ -0,0 +1,46 @@
+import logging
+
+import pytest
+
+from relp.client import RelpClient
+from relp.exceptions import AckError
+from relp.relay import RelpRelay
+
+log = logging.getLogger('test-relay')
+
+def make_relay(endpoints):
+    relay = RelpRelay('127.0.0.1', 0, endpoints, window=8, logger=log)
+    relay.server.main_thread.daemon = True
+    return relay
+
+class TestRelpRelay:
+    def test_forward(self, relp_server):
+        received = []
+        relay = make_relay([relp_server(received.append), relp_server(received.append)])
+        with relay:
+            with RelpClient('127.0.0.1', relay.socket.getsockname()[1]) as client:
+                messages = [f"message #{index}" for index in range(500)]
+                assert client.syslog_many(messages) == 500
+                # Acknowledged upstream once acknowledged downstream
+                assert sorted(received) == sorted(messages)
+
+    def test_downstream_nack(self, relp_server):
+        def handler(message):
+            if message == 'bad':
+                raise ValueError("refused")
+        relay = make_relay([relp_server(handler)])
+        with relay:
+            with RelpClient('127.0.0.1', relay.socket.getsockname()[1]) as client:
+                client.syslog('good')
+                with pytest.raises(AckError):
+                    client.syslog('bad')
+
+    def test_bytes_unchanged(self, relp_server):
+        received = []
+        relay = make_relay([relp_server(lambda message: received.append(message.raw), parse_syslog=True)])
+        messages = [b'<13>1 - host app - - - latin-1 \xe9t\xe9', b'invalid \xff\xfe utf-8']
+        with relay:
+            with RelpClient('127.0.0.1', relay.socket.getsockname()[1]) as client:
+                for message in messages:
+                    client.syslog(message)
+        assert received == messages
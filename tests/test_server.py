@@ -0,0 +1,245 @@
+import pytest
+
+import os
+import time
+
+from concurrent.futures import Future
+from socket import create_connection, socketpair
+from threading import Event, Thread, Timer
+
+from relp.client import RelpClient
+from relp.metrics import MetricsRegistry
+from relp.protocol import Ack, FrameParser
+from relp.server import FairExecutor, RelpServer, handle_client, handle_client_batch, inherited_socket
+from relp.session import RelpSession
+from relp.exceptions import AckError, RelpSessionError
+
+import logging
+
+log = logging.getLogger('test-server')
+
+def start_server(handler, target=handle_client_batch, **kwargs):
+    client_sock, server_sock = socketpair()
+    thread = Thread(
+        target=target,
+        args=(server_sock, 'socketpair', handler, log),
+        kwargs=kwargs,
+        daemon=True,
+    )
+    thread.start()
+    client = RelpSession(client_sock, 'client')
+    client.start()
+    client.offer()
+    return client, thread
+
+class TestBatchHandler:
+    def test_batches_are_acked(self):
+        batches = []
+        client, thread = start_server(batches.append, batch_size=10, batch_timeout=0.01)
+        futures = [client.send_async('syslog', f"message #{index}") for index in range(100)]
+        assert {future.result(timeout=5).code for future in futures} == {200}
+        client.stop()
+        thread.join()
+        assert max(len(batch) for batch in batches) <= 10
+        assert [m for batch in batches for m in batch] == [f"message #{index}" for index in range(100)]
+
+    def test_failed_batch_is_nacked(self):
+        def batch_handler(messages):
+            raise ValueError("database is down")
+        client, thread = start_server(batch_handler)
+        with pytest.raises(AckError):
+            client.send('syslog', 'message')
+        client.stop()
+        thread.join()
+
+class TestHandler:
+    def test_ack_after_handler(self):
+        received = []
+        def handler(message):
+            time.sleep(0.01)
+            received.append(message)
+        client, thread = start_server(handler, target=handle_client)
+        client.send('syslog', 'message')
+        assert received == ['message']
+        client.stop()
+        thread.join()
+
+    def test_concurrent_handlers(self):
+        received = []
+        def handler(message):
+            time.sleep(0.1)
+            received.append(message)
+        client, thread = start_server(handler, target=handle_client, workers=16, max_inflight=32)
+        start = time.monotonic()
+        futures = [client.send_async('syslog', f"message #{index}") for index in range(32)]
+        acks = [future.result(timeout=5) for future in futures]
+        assert time.monotonic() - start < 1
+        assert [ack.code for ack in acks] == [200] * 32
+        assert sorted(received) == sorted(f"message #{index}" for index in range(32))
+        client.stop()
+        thread.join()
+
+    def test_failed_handler_is_nacked(self):
+        def handler(message):
+            if message == 'bad':
+                raise ValueError("invalid message")
+        client, thread = start_server(handler, target=handle_client, workers=4)
+        futures = [client.send_async('syslog', message) for message in ['good', 'bad', 'good']]
+        assert [future.result(timeout=5).code for future in futures] == [200, 500, 200]
+        client.stop()
+        thread.join()
+
+    def test_future_handler(self):
+        def handler(message):
+            future = Future()
+            Timer(0.05, future.set_result, (None,)).start()
+            return future
+        client, thread = start_server(handler, target=handle_client)
+        futures = [client.send_async('syslog', f"message #{index}") for index in range(10)]
+        assert [future.result(timeout=5).code for future in futures] == [200] * 10
+        client.stop()
+        thread.join()
+
+class TestDrain:
+    def test_handoff(self, monkeypatch):
+        '''A replacement server takes over the listening socket while the first one drains'''
+        first, second = [], []
+        def slow_handler(message):
+            time.sleep(0.01)
+            first.append(message)
+        old = RelpServer('127.0.0.1', 0, slow_handler, log, handler_workers=4)
+        old.start()
+        port = old.socket.getsockname()[1]
+        client = RelpClient('127.0.0.1', port, window=16)
+        client.start()
+        futures = [client.syslog_async(f"message #{index}") for index in range(50)]
+
+        monkeypatch.setenv('RELP_LISTEN_FD', str(os.dup(old.socket.fileno())))
+        new = RelpServer('127.0.0.1', 0, second.append, log, sock=inherited_socket())
+        assert 'RELP_LISTEN_FD' not in os.environ
+        assert new.socket.getsockname()[1] == port
+        new.start()
+        assert old.stop(timeout=5)
+        assert not old.main_thread.is_alive()
+
+        futures += [client.syslog_async(f"message #{index}") for index in range(50, 100)]
+        assert {future.result(timeout=10).code for future in futures} == {200}
+        client.stop()
+        assert len(second) > 0
+        assert set(first) | set(second) == {f"message #{index}" for index in range(100)}
+        new.stop(timeout=5)
+
+    def test_unknown_command(self):
+        '''A peer sending an unknown command does not keep the server from draining'''
+        received = []
+        server = RelpServer('127.0.0.1', 0, received.append, log, max_sessions=1)
+        server.start()
+        peer = create_connection(server.socket.getsockname())
+        peer.settimeout(5)
+        peer.sendall(b'1 open 0\n2 bogus 3 abc\n3 syslog 5 hello\n')
+        parser = FrameParser()
+        acks = []
+        while len(acks) < 3 and parser.read_from(peer):
+            acks += [Ack.from_frame(frame) for frame in parser.frames()]
+        assert [(ack.txnr, ack.code) for ack in acks[1:]] == [(2, 500), (3, 200)]
+        start = time.monotonic()
+        assert server.stop(timeout=1)
+        assert time.monotonic() - start < 1
+        assert server.session_stats()['active'] == 0
+        assert received == ['hello']
+        peer.close()
+
+class TestAdmission:
+    def test_many_sessions(self):
+        '''More sessions than the threads of a default ThreadPoolExecutor are all served'''
+        received = []
+        server = RelpServer('127.0.0.1', 0, received.append, log)
+        server.start()
+        port = server.socket.getsockname()[1]
+        clients = [RelpClient('127.0.0.1', port) for _ in range(40)]
+        for index, client in enumerate(clients):
+            client.start()
+            client.syslog(f"message #{index}")
+        assert server.session_stats()['active'] == 40
+        for client in clients:
+            client.stop()
+        assert server.stop(timeout=5)
+        assert len(received) == 40
+
+    def test_reject_and_idle(self):
+        metrics = MetricsRegistry()
+        server = RelpServer('127.0.0.1', 0, lambda message: None, log, metrics=metrics,
+                            max_sessions=1, idle_timeout=0.2)
+        server.start()
+        port = server.socket.getsockname()[1]
+        first = RelpSession(create_connection(('127.0.0.1', port)), 'client')
+        first.start()
+        first.offer()
+        second = RelpSession(create_connection(('127.0.0.1', port)), 'client')
+        second.start()
+        with pytest.raises(RelpSessionError):
+            second.offer(timeout=1)
+        assert server.session_stats()['rejected'] == 1
+        # The first session is closed once idle, which frees its slot
+        first.recv_thread.join(timeout=5)
+        assert not first.running
+        with RelpClient('127.0.0.1', port) as client:
+            client.syslog('message')
+        first.stop()
+        server.stop(timeout=5)
+        stats = metrics.stats()
+        # The client may have been rejected (and reconnected) before the idle session released its slot
+        assert stats['relp_sessions_rejected_total']['full'] >= 1
+        assert stats['relp_sessions_idle_total'] >= 1
+
+    def test_queue(self):
+        server = RelpServer('127.0.0.1', 0, lambda message: None, log, max_sessions=1, admission='queue')
+        server.start()
+        port = server.socket.getsockname()[1]
+        first = RelpClient('127.0.0.1', port)
+        first.start()
+        Timer(0.2, first.stop).start()
+        # Served once the first session finished
+        with RelpClient('127.0.0.1', port) as second:
+            second.syslog('message')
+        assert server.session_stats()['rejected'] == 0
+        server.stop(timeout=5)
+
+class TestFairness:
+    def test_fair_executor(self):
+        executor = FairExecutor(1)
+        order = []
+        busy, quiet = executor.queue(weight=2), executor.queue()
+        started = Event()
+        release = Event()
+        busy.submit(lambda: (started.set(), release.wait()))
+        started.wait()
+        for index in range(10):
+            busy.submit(order.append, f"busy #{index}")
+        quiet.submit(order.append, 'quiet')
+        release.set()
+        busy.shutdown()
+        quiet.shutdown()
+        executor.shutdown()
+        # The quiet session does not wait for all the tasks of the busy one
+        assert order.index('quiet') <= 2
+
+    def test_address_rate_limit(self):
+        received = []
+        server = RelpServer('127.0.0.1', 0, received.append, log, address_messages_rate=200,
+                            handler_workers=2, fair_scheduling=True)
+        server.start()
+        port = server.socket.getsockname()[1]
+        start = time.monotonic()
+        with RelpClient('127.0.0.1', port) as first, RelpClient('127.0.0.1', port) as second:
+            first.syslog_many(f"first #{index}" for index in range(150))
+            second.syslog_many(f"second #{index}" for index in range(150))
+        # 300 messages at 200 per second from the same address, after a burst of 200
+        assert time.monotonic() - start > 0.4
+        assert len(received) == 300
+        # The limit of the address is dropped once its sessions are done
+        deadline = time.monotonic() + 5
+        while server.address_limits and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server.address_limits == {}
+        server.stop(timeout=5)
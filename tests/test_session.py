@@ -0,0 +1,277 @@
+import pytest
+
+from socket import socketpair, create_connection, socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from logging import getLogger
+from time import monotonic
+
+from relp.session import MAX_BATCH_MESSAGES, RateLimit, ReceiveBudget, RelpSession
+from relp.protocol import Ack, COMMANDS, Frame, FrameParser, Offer
+from relp.server import handle_client
+from relp.exceptions import AckError, RelpSessionError
+
+log = getLogger('test-session')
+
+def serve(session, received):
+    '''Handle the frames received by a server session, and acknowledge them once handled'''
+    while True:
+        frame = session.recv()
+        if frame is None:
+            break
+        if frame.command in COMMANDS:
+            received.extend(frame.messages())
+        if frame.command in ['close'] + COMMANDS:
+            session.ack([frame.txnr])
+        if frame.command == 'close':
+            break
+
+@pytest.fixture
+def sessions():
+    client_sock, server_sock = socketpair()
+    server = RelpSession(server_sock, 'server', auto_ack=False)
+    client = RelpSession(client_sock, 'client', window=4)
+    received = []
+    server.start()
+    thread = Thread(target=serve, args=(server, received), daemon=True)
+    thread.start()
+    client.start()
+    client.offer()
+    yield client, server, received
+    client.stop()
+    thread.join()
+    server.stop()
+
+def flaky_server(received, acked=3):
+    '''Serve a first connection that is dropped after acknowledging `acked` messages, then serve normally'''
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+
+    def accept():
+        clientsocket, _ = listener.accept()
+        parser = FrameParser()
+        count = 0
+        while count < acked * 2 and parser.read_from(clientsocket):
+            for frame in parser.frames():
+                if frame.command == 'open':
+                    clientsocket.sendall(Ack(frame.txnr, message=Offer().message()).to_frame().encode())
+                elif count < acked:
+                    clientsocket.sendall(Ack(frame.txnr).to_frame().encode())
+                count += frame.command == 'syslog'
+        clientsocket.close()
+        while True:
+            clientsocket, address = listener.accept()
+            Thread(target=handle_client, args=(clientsocket, address, received.append, log), daemon=True).start()
+    Thread(target=accept, daemon=True).start()
+    return listener.getsockname()
+
+class TestRelpSession:
+    def test_pipelined_send(self, sessions):
+        client, _, received = sessions
+        futures = [client.send_async('syslog', f"message #{index}") for index in range(100)]
+        acks = [future.result(timeout=5) for future in futures]
+        assert [ack.code for ack in acks] == [200] * 100
+        assert [ack.txnr for ack in acks] == list(range(2, 102))
+        assert received == [f"message #{index}" for index in range(100)]
+
+    def test_send_after_close(self, sessions):
+        client, _, _ = sessions
+        client.stop()
+        with pytest.raises(RelpSessionError):
+            client.send_async('syslog', 'too late')
+
+    def test_send_many(self, sessions):
+        client, _, received = sessions
+        messages = (f"message #{index}" for index in range(1000))
+        assert client.send_many('syslog', messages) == 1000
+        assert received == [f"message #{index}" for index in range(1000)]
+        assert client.window.inflight() == 0
+
+    def test_send_many_batch(self, sessions):
+        client, server, received = sessions
+        assert client.peer_commands == server.peer_commands == ['syslog', 'syslogbatch']
+        messages = [f"message #{index}" for index in range(5000)]
+        assert client.send_many('syslog', messages) == 5000
+        assert received == messages
+
+    def test_send_many_nack(self):
+        def handler(message):
+            if message == 'message #1500':
+                raise ValueError("refused")
+
+        client_sock, server_sock = socketpair()
+        thread = Thread(target=handle_client, args=(server_sock, 'socketpair', handler, log), daemon=True)
+        thread.start()
+        client = RelpSession(client_sock, 'client')
+        client.start()
+        client.offer()
+        with pytest.raises(AckError) as error:
+            client.send_many('syslog', (f"message #{index}" for index in range(3000)))
+        # The whole batch holding the refused message is NACKed, reported per message
+        batch = 1500 // MAX_BATCH_MESSAGES * MAX_BATCH_MESSAGES
+        assert error.value.nacked == list(range(batch, batch + MAX_BATCH_MESSAGES))
+        assert str(error.value) == f"{MAX_BATCH_MESSAGES} messages out of 3000 were NACKed"
+        with pytest.raises(AckError) as error:
+            client.send_many('syslog', ['first', 'message #1500', 'last'])
+        assert error.value.nacked == [0, 1, 2]
+        client.peer_commands = ['syslog']
+        with pytest.raises(AckError) as error:
+            client.send_many('syslog', ['first', 'message #1500', 'last'])
+        assert error.value.nacked == [1]
+        client.stop()
+        thread.join()
+
+    def test_batch_fallback(self):
+        '''A peer that only supports `syslog` (like rsyslog) gets one frame per message'''
+        client_sock, server_sock = socketpair()
+        commands = []
+
+        def serve_syslog_only():
+            parser = FrameParser()
+            while parser.read_from(server_sock):
+                for frame in parser.frames():
+                    commands.append(frame.command)
+                    if frame.command == 'open':
+                        message = '200 OK\nrelp_version=0\nrelp_software=rsyslog\ncommands=syslog'
+                        server_sock.sendall(Frame(frame.txnr, 'rsp', message).encode())
+                    else:
+                        server_sock.sendall(Ack(frame.txnr).to_frame().encode())
+        Thread(target=serve_syslog_only, daemon=True).start()
+        client = RelpSession(client_sock, 'client', close_timeout=1)
+        client.start()
+        client.offer()
+        assert client.peer_commands == ['syslog']
+        assert client.send_many('syslog', (f"message #{index}" for index in range(10))) == 10
+        client.stop()
+        assert commands == ['open'] + ['syslog'] * 10 + ['close']
+
+    def test_reconnect_resend(self):
+        received = []
+        address = flaky_server(received)
+        client = RelpSession(create_connection(address), 'client', window=16,
+                             reconnect=lambda: create_connection(address, 1))
+        client.start()
+        client.offer()
+        handles = [client.send_async('syslog', f"message #{index}") for index in range(50)]
+        acks = [handle.result(timeout=5) for handle in handles]
+        assert [ack.code for ack in acks] == [200] * 50
+        assert client.window.inflight() == 0
+        # The messages not acknowledged by the first connection are sent again, in order
+        # (an ACK lost with the connection makes its message sent again too)
+        assert len(received) >= 47
+        assert received == [f"message #{index}" for index in range(50 - len(received), 50)]
+        client.stop()
+
+    def test_close_timeout(self):
+        client_sock, server_sock = socketpair()
+        client = RelpSession(client_sock, 'client', close_timeout=0.1)
+        client.start()
+        # Nobody acknowledges the `close`
+        client.stop()
+        assert not client.running
+        server_sock.close()
+
+    def test_unknown_command(self):
+        '''An unknown command is NACKed, and the session goes on'''
+        client_sock, server_sock = socketpair()
+        received = []
+        thread = Thread(target=handle_client, args=(server_sock, 'socketpair', received.append, log), daemon=True)
+        thread.start()
+        client_sock.settimeout(5)
+        client_sock.sendall(b'1 open 0\n2 bogus 3 abc\n3 syslog 5 hello\n4 close 0\n')
+        parser = FrameParser()
+        frames = []
+        while parser.read_from(client_sock):
+            frames.extend(parser.frames())
+        acks = [Ack.from_frame(frame) for frame in frames if frame.command == 'rsp']
+        assert [(ack.txnr, ack.code) for ack in acks[1:]] == [(2, 500), (3, 200), (4, 200)]
+        assert received == ['hello']
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_malformed_rsp(self):
+        '''A garbage `rsp` closes the session, failing the messages waiting for their ACK'''
+        client_sock, server_sock = socketpair()
+
+        def serve_garbage():
+            parser = FrameParser()
+            while parser.read_from(server_sock):
+                for frame in parser.frames():
+                    if frame.command == 'open':
+                        server_sock.sendall(Ack(frame.txnr, message=Offer().message()).to_frame().encode())
+                    else:
+                        server_sock.sendall(Frame(frame.txnr, 'rsp', 'abc').encode())
+        Thread(target=serve_garbage, daemon=True).start()
+        client = RelpSession(client_sock, 'client', close_timeout=1)
+        client.start()
+        client.offer()
+        handle = client.send_async('syslog', 'message')
+        with pytest.raises(RelpSessionError):
+            handle.result(timeout=5)
+        assert not client.running
+        server_sock.close()
+
+class TestReceiveBudget:
+    def start(self, budget, overflow):
+        client_sock, server_sock = socketpair()
+        server = RelpSession(server_sock, 'server', budgets=[budget], overflow=overflow)
+        client = RelpSession(client_sock, 'client', window=16, close_timeout=1)
+        server.start()
+        client.start()
+        client.offer()
+        return client, server
+
+    def test_block(self):
+        budget = ReceiveBudget(max_messages=2)
+        client, server = self.start(budget, 'block')
+        handles = [client.send_async('syslog', f"message #{index}") for index in range(10)]
+        with pytest.raises(TimeoutError):
+            handles[-1].result(timeout=0.2)
+        # The `open` frame and the frames within the budget
+        assert server.recv_queue.qsize() == 3
+        assert server.recv().command == 'open'
+        assert [server.recv().message for _ in range(10)] == [f"message #{index}" for index in range(10)]
+        assert [handle.result(timeout=5).code for handle in handles] == [200] * 10
+        client.stop()
+        server.stop()
+        assert budget.messages == 0
+
+    def test_nack(self):
+        budget = ReceiveBudget(max_messages=1)
+        client, server = self.start(budget, 'nack')
+        handles = [client.send_async('syslog', f"message #{index}") for index in range(5)]
+        acks = [handle.result(timeout=5) for handle in handles]
+        assert [ack.code for ack in acks] == [200, 500, 500, 500, 500]
+        assert acks[1].message == 'server busy'
+        assert server.recv().command == 'open'
+        assert server.recv().message == 'message #0'
+        client.stop()
+        server.stop()
+        assert budget.messages == 0 and budget.bytes == 0
+
+class TestRateLimit:
+    def test_bucket(self):
+        limit = RateLimit(messages_rate=100, bytes_rate=1000)
+        # The burst of one second is available at once
+        assert all(limit.acquire(5, 0) for _ in range(100))
+        assert not limit.acquire(5, 0)
+        start = monotonic()
+        assert limit.acquire(5)
+        assert 0.005 < monotonic() - start < 0.5
+        # A batch takes one token per message
+        assert limit.acquire(5, 2, count=100)
+        assert not limit.acquire(5, 0)
+        # Larger than the bytes burst: waits for a full bucket
+        assert limit.acquire(5000, 2)
+
+    def test_nack(self):
+        client_sock, server_sock = socketpair()
+        server = RelpSession(server_sock, 'server', budgets=[RateLimit(messages_rate=3)], overflow='nack')
+        client = RelpSession(client_sock, 'client', window=16, close_timeout=1)
+        server.start()
+        client.start()
+        client.offer()
+        handles = [client.send_async('syslog', f"message #{index}") for index in range(5)]
+        assert [handle.result(timeout=5).code for handle in handles] == [200, 200, 200, 500, 500]
+        client.stop()
+        server.stop()
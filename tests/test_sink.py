@@ -0,0 +1,53 @@
+import gzip
+import os
+
+import pytest
+
+import relp.sink as sink_module
+
+from relp.metrics import MetricsRegistry
+from relp.sink import FileSink
+
+class TestFileSink:
+    def test_group_commit(self, tmp_path, send_to_handler):
+        path = tmp_path / 'messages.log'
+        metrics = MetricsRegistry()
+        messages = [f"message #{index}" for index in range(1000)]
+        with FileSink(str(path), commit_delay=0.01, metrics=metrics) as sink:
+            assert set(send_to_handler(sink, messages)) == {200}
+            # Acknowledged messages are already on disk
+            assert path.read_text().splitlines() == messages
+        stats = metrics.stats()
+        assert stats['relp_sink_messages_total'] == 1000
+        assert stats['relp_sink_commits_total'] < 100
+
+    def test_rotation(self, tmp_path):
+        path = tmp_path / 'messages.log'
+        messages = [f"message #{index:04}" for index in range(1000)]
+        with FileSink(str(path), max_group_messages=100, max_file_bytes=4096, compress='gzip') as sink:
+            sink.write_many(messages)
+        rotated = sorted(name for name in os.listdir(tmp_path) if name != 'messages.log')
+        assert rotated and all(name.endswith('.gz') for name in rotated)
+        lines = []
+        for name in rotated:
+            with gzip.open(tmp_path / name, 'rt') as rotated_file:
+                lines += rotated_file.read().splitlines()
+        lines += path.read_text().splitlines()
+        assert sorted(lines) == messages
+
+    def test_rotation_failure(self, tmp_path, monkeypatch):
+        '''A file that cannot be opened fails its group, and the sink keeps writing to the current file'''
+        path = tmp_path / 'messages.log'
+        with FileSink(str(path), max_file_bytes=10) as sink:
+            sink.write_many(['first'])
+            def fail(*args, **kwargs):
+                raise PermissionError("read-only")
+            monkeypatch.setattr(sink_module, 'open', fail, raising=False)
+            with pytest.raises(PermissionError):
+                sink.write_many(['second'])
+            monkeypatch.undo()
+            sink.write_many(['third'])
+        rotated = [name for name in os.listdir(tmp_path) if name != 'messages.log']
+        assert len(rotated) == 1
+        assert (tmp_path / rotated[0]).read_text().splitlines() == ['first']
+        assert path.read_text().splitlines() == ['third']
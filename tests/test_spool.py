@@ -0,0 +1,119 @@
+import logging
+
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+
+import pytest
+
+from relp.client import RelpClient
+from relp.exceptions import SpoolFullError
+from relp.protocol import Ack, FrameParser, Offer
+from relp.server import handle_client
+from relp.spool import Spool
+
+log = logging.getLogger('test-spool')
+
+def ack_offer_only(clientsocket, address):
+    '''Accept the RELP offer, then never acknowledge anything'''
+    parser = FrameParser()
+    while parser.read_from(clientsocket):
+        for frame in parser.frames():
+            if frame.command == 'open':
+                clientsocket.sendall(Ack(frame.txnr, message=Offer().message()).to_frame().encode())
+
+def read_all(spool):
+    messages = []
+    while True:
+        token, payload = spool.read(timeout=0)
+        if token is None:
+            return messages
+        messages.append((token, payload))
+
+class TestSpool:
+    def test_segments_and_trim(self, tmp_path):
+        spool = Spool(tmp_path, segment_size=64)
+        for index in range(20):
+            spool.append(f"message #{index}")
+        assert len(list(tmp_path.glob('segment-*'))) > 1
+        records = read_all(spool)
+        assert [payload for _, payload in records] == [f"message #{index}".encode() for index in range(20)]
+        for token, _ in records:
+            spool.ack(token)
+        assert not spool.pending()
+        assert len(list(tmp_path.glob('segment-*'))) == 1
+        spool.close()
+
+    def test_replay_after_restart(self, tmp_path):
+        spool = Spool(tmp_path, segment_size=64)
+        for index in range(10):
+            spool.append(f"message #{index}")
+        records = read_all(spool)
+        for token, _ in records[:4]:
+            spool.ack(token)
+        spool.close()
+
+        spool = Spool(tmp_path, segment_size=64)
+        assert [payload for _, payload in read_all(spool)] == [f"message #{index}".encode() for index in range(4, 10)]
+        spool.close()
+
+    def test_rewind(self, tmp_path):
+        spool = Spool(tmp_path)
+        spool.append('first')
+        spool.append('second')
+        (first, _), (second, _) = read_all(spool)
+        spool.ack(first)
+        spool.rewind()
+        spool.ack(second)
+        assert [payload for _, payload in read_all(spool)] == [b'second']
+
+    def test_full(self, tmp_path):
+        spool = Spool(tmp_path, segment_size=64, max_segments=2)
+        with pytest.raises(SpoolFullError):
+            for index in range(20):
+                spool.append(f"message #{index}")
+
+    def test_client_with_spool(self, tmp_path):
+        received = []
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+
+        spool = Spool(tmp_path)
+        client = RelpClient('127.0.0.1', port, spool=spool, retry_interval=0.05)
+        client.start()
+        # Server not listening yet: messages only go to the spool
+        for index in range(10):
+            client.syslog(f"message #{index}")
+
+        listener.listen()
+        def serve():
+            clientsocket, address = listener.accept()
+            handle_client(clientsocket, address, received.append, log)
+        thread = Thread(target=serve, daemon=True)
+        thread.start()
+        client.stop()
+        thread.join()
+        assert received == [f"message #{index}" for index in range(10)]
+        assert not spool.pending()
+
+    def test_stop_without_start(self, tmp_path):
+        spool = Spool(tmp_path)
+        spool.append('message')
+        client = RelpClient('127.0.0.1', 1, spool=spool)
+        client.stop()
+        # The spooled messages are kept for the next run
+        assert spool.pending()
+
+    def test_stop_without_acks(self, tmp_path, listen):
+        address = listen(ack_offer_only)
+        spool = Spool(tmp_path)
+        client = RelpClient(*address, spool=spool, window=4, drain_timeout=0.5, retry_interval=0.05)
+        client.start()
+        for index in range(10):
+            client.syslog(f"message #{index}")
+        # The window fills up, and stop gives up after `drain_timeout`
+        stopper = Thread(target=client.stop, daemon=True)
+        stopper.start()
+        stopper.join(5)
+        assert not stopper.is_alive()
+        assert spool.pending()
@@ -0,0 +1,50 @@
+from relp.syslog import SyslogMessage
+
+class TestSyslogMessage:
+    def test_rfc5424(self):
+        message = SyslogMessage(
+            b'<165>1 2003-10-11T22:14:15.003Z mymachine.example.com evntslog - ID47 '
+            b'[exampleSDID@32473 iut="3" eventID="1011" text="a \\] b"][other@1 x="y"] \xef\xbb\xbfAn application event'
+        )
+        assert message.rfc == 5424
+        assert (message.pri, message.facility, message.severity) == (165, 20, 5)
+        assert message.timestamp == '2003-10-11T22:14:15.003Z'
+        assert message.hostname == 'mymachine.example.com'
+        assert message.app_name == 'evntslog'
+        assert message.procid is None
+        assert message.msgid == 'ID47'
+        assert message.structured_data == '[exampleSDID@32473 iut="3" eventID="1011" text="a \\] b"][other@1 x="y"]'
+        assert message.msg == 'An application event'
+
+    def test_rfc5424_without_structured_data(self):
+        message = SyslogMessage(b'<34>1 2003-10-11T22:14:15.003Z host su 123 - - hello world')
+        assert message.procid == '123'
+        assert message.structured_data is None
+        assert message.msg == 'hello world'
+
+    def test_rfc3164(self):
+        message = SyslogMessage(b"<34>Oct 11 22:14:15 mymachine su[42]: 'su root' failed")
+        assert message.rfc == 3164
+        assert message.timestamp == 'Oct 11 22:14:15'
+        assert message.hostname == 'mymachine'
+        assert message.app_name == 'su'
+        assert message.procid == '42'
+        assert message.msg == "'su root' failed"
+
+    def test_unknown_format(self):
+        message = SyslogMessage('just text, é'.encode('utf-8'))
+        assert message.rfc is None
+        assert message.pri is None and message.hostname is None
+        assert message.msg == str(message) == 'just text, é'
+
+    def test_interned_fields(self):
+        first = SyslogMessage(b'<13>1 - web01 nginx - - - first')
+        second = SyslogMessage(b'<13>1 - web01 nginx - - - second')
+        assert first.hostname is second.hostname
+        assert first.app_name is second.app_name
+
+    def test_server_handler(self, send_to_handler):
+        received = []
+        messages = ['<13>1 - web01 nginx - - - first', '<13>1 - web02 nginx - - - second']
+        assert send_to_handler(received.append, messages, parse_syslog=True) == [200, 200]
+        assert [message.hostname for message in received] == ['web01', 'web02']
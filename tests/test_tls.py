@@ -0,0 +1,70 @@
+import logging
+import shutil
+import subprocess
+import ssl
+
+import pytest
+
+from relp.client import RelpClient
+from relp.exceptions import RelpSessionError
+from relp.server import RelpServer
+from relp.tls import client_context, server_context
+
+log = logging.getLogger('test-tls')
+
+pytestmark = pytest.mark.skipif(shutil.which('openssl') is None, reason="openssl is needed to create certificates")
+
+def openssl(*args, cwd):
+    subprocess.run(['openssl', *args], cwd=cwd, check=True, capture_output=True)
+
+@pytest.fixture(scope='module')
+def certs(tmp_path_factory):
+    '''A CA, and a server and a client certificates signed by it'''
+    path = tmp_path_factory.mktemp('certs')
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', 'ca.key', '-out', 'ca.pem',
+            '-days', '1', '-subj', '/CN=test-ca', cwd=path)
+    (path / 'san.ext').write_text('subjectAltName=DNS:localhost,IP:127.0.0.1\n')
+    for name in ('server', 'client'):
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-keyout', f'{name}.key', '-out', f'{name}.csr',
+                '-subj', f'/CN={name}', cwd=path)
+        openssl('x509', '-req', '-in', f'{name}.csr', '-CA', 'ca.pem', '-CAkey', 'ca.key', '-CAcreateserial',
+                '-out', f'{name}.pem', '-days', '1', '-extfile', 'san.ext', cwd=path)
+    return path
+
+def start_server(context, received):
+    server = RelpServer('127.0.0.1', 0, received.append, log, ssl_context=context, handshake_timeout=2)
+    server.main_thread.daemon = True
+    server.start()
+    return server.socket.getsockname()[1]
+
+class TestTls:
+    def test_mutual_tls(self, certs):
+        received = []
+        port = start_server(server_context(certs / 'server.pem', certs / 'server.key', cafile=certs / 'ca.pem'),
+                            received)
+        context = client_context(certs / 'ca.pem', certs / 'client.pem', certs / 'client.key')
+        with RelpClient('127.0.0.1', port, ssl_context=context) as client:
+            client.syslog('message #0')
+            assert client.syslog_many(f"message #{index}" for index in range(1, 1000)) == 999
+            handles = [client.syslog_async('x' * 65536) for _ in range(10)]
+            assert {handle.result(timeout=5).code for handle in handles} == {200}
+        assert received[:1000] == [f"message #{index}" for index in range(1000)]
+        assert len(received) == 1010
+
+    def test_client_certificate_required(self, certs):
+        port = start_server(server_context(certs / 'server.pem', certs / 'server.key', cafile=certs / 'ca.pem'), [])
+        with pytest.raises((ssl.SSLError, OSError, RelpSessionError)):
+            client = RelpClient('127.0.0.1', port, ssl_context=client_context(certs / 'ca.pem'), reconnect=False)
+            client.start()
+            client.syslog('refused')
+
+    def test_session_resumed_on_reconnect(self, certs):
+        received = []
+        port = start_server(server_context(certs / 'server.pem', certs / 'server.key'), received)
+        with RelpClient('127.0.0.1', port, ssl_context=client_context(certs / 'ca.pem')) as client:
+            client.syslog('before')
+            # Connection lost: the client reconnects with the TLS session of the first connection
+            client.session.socket.sock.shutdown(2)
+            client.syslog('after', timeout=5)
+            assert client.session.socket.session_reused
+        assert received == ['before', 'after']
@@ -0,0 +1,34 @@
+import os
+import signal
+import time
+
+from threading import Thread
+
+from relp.client import RelpClient
+from relp.workers import MultiProcessRelpServer
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout waiting for condition"
+        time.sleep(0.05)
+
+class TestMultiProcessRelpServer:
+    def test_workers_serve_and_restart(self):
+        server = MultiProcessRelpServer('127.0.0.1', 0, lambda message: None, workers=2,
+                                        reuse_port=False, stats_interval=0.1)
+        port = server.socket.getsockname()[1]
+        server.start()
+        supervisor = Thread(target=server.supervise, daemon=True)
+        supervisor.start()
+        try:
+            with RelpClient('127.0.0.1', port) as client:
+                client.syslog_many(f"message #{index}" for index in range(20))
+            wait_for(lambda: server.stats()['total'].get('relp_frames_received_total', {}).get('syslogbatch') == 1)
+
+            os.kill(server.processes[0].pid, signal.SIGKILL)
+            wait_for(lambda: server.stats()['restarts'][0] == 1)
+            wait_for(lambda: server.processes[0].is_alive())
+        finally:
+            server.stop()
+            supervisor.join()